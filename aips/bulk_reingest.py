@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+"""
+Bulk AIP reingest
+
+Reingests a list of AIPs, or all the AIPs in the Storage Service, keeping at
+most a given number of reingests in progress per pipeline. The AIPs are
+spread over the pipelines known to the Storage Service (or a subset of them)
+and the progress of each reingest is followed through the Archivematica API
+of its pipeline. The state of every AIP is saved in a JSON file after each
+change, so an interrupted run continues where it stopped when started again
+with the same state file.
+"""
+
+import argparse
+import json
+import logging
+import logging.config  # Has to be imported separately
+import os
+import sys
+import time
+
+from transfers import amclient
+
+THIS_DIR = os.path.abspath(os.path.dirname(__file__))
+LOGGER = logging.getLogger('bulk_reingest')
+
+PENDING = 'pending'
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+FAILED = 'failed'
+
+# Seconds a unit can go without progress, or wait for user input, before its
+# reingest is failed
+STALL_TIMEOUT = 6 * 3600
+# Status checks failing in a row before a reingest is failed
+MAX_STATUS_ERRORS = 10
+
+
+def setup_logger(log_file, log_level='INFO'):
+    """Configures the logger to output to console and log file"""
+    if not log_file:
+        log_file = os.path.join(THIS_DIR, 'bulk_reingest.log')
+
+    CONFIG = {
+        'version': 1,
+        'disable_existing_loggers': True,
+        'formatters': {
+            'default': {
+                'format': '%(levelname)-8s  %(asctime)s  %(message)s',
+                'datefmt': '%Y-%m-%d %H:%M:%S',
+            },
+        },
+        'handlers': {
+            'console': {
+                'class': 'logging.StreamHandler',
+                'formatter': 'default',
+            },
+            'file': {
+                'class': 'logging.handlers.RotatingFileHandler',
+                'formatter': 'default',
+                'filename': log_file,
+                'backupCount': 2,
+                'maxBytes': 10 * 1024,
+            },
+        },
+        'loggers': {
+            'bulk_reingest': {
+                'level': log_level,
+                'handlers': ['console', 'file'],
+            },
+        },
+    }
+
+    logging.config.dictConfig(CONFIG)
+
+
+def load_state(state_file):
+    """Return the state saved in state_file, or an empty one."""
+    if not os.path.isfile(state_file):
+        return {'aips': {}}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def save_state(state_file, state):
+    """Write state to state_file, atomically."""
+    tmp_file = '{}.tmp'.format(state_file)
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, state_file)
+
+
+def get_pipelines(ss_client, am_url=None, pipeline_uuids=None):
+    """
+    Get the pipelines to reingest to from the Storage Service.
+
+    :param ss_client: AMClient with the Storage Service details
+    :param str am_url: Archivematica URL used for the pipelines that have no
+        remote name in the Storage Service
+    :param list pipeline_uuids: Only use these pipelines if not empty
+    :returns: Dict of pipeline UUIDs to Archivematica URLs
+    """
+    response = ss_client.get_pipelines()
+    if not isinstance(response, dict):
+        LOGGER.error('Unable to get the pipelines from the Storage Service')
+        return {}
+    pipelines = {}
+    for pipeline in response.get('objects', []):
+        if pipeline_uuids and pipeline['uuid'] not in pipeline_uuids:
+            continue
+        url = pipeline.get('remote_name') or am_url
+        if not url:
+            LOGGER.warning('Skipping pipeline %s, which has no remote name',
+                           pipeline['uuid'])
+            continue
+        if '://' not in url:
+            url = 'http://{}'.format(url)
+        pipelines[pipeline['uuid']] = url.rstrip('/')
+    return pipelines
+
+
+def start_reingest(ss_client, aip_uuid, pipeline_uuid, reingest_type,
+                   processing_config):
+    """
+    Ask the Storage Service to reingest an AIP in a pipeline.
+
+    :returns: Tuple of the UUID of the unit started in the pipeline, or None,
+        and an error message
+    """
+    ss_client.aip_uuid = aip_uuid
+    ss_client.pipeline_uuid = pipeline_uuid
+    ss_client.reingest_type = reingest_type
+    ss_client.processing_config = processing_config
+    response = ss_client.reingest_aip()
+    if not isinstance(response, dict):
+        return None, 'Reingest request failed: {}'.format(response)
+    if response.get('error') or not response.get('reingest_uuid'):
+        return None, response.get('message', 'No reingest UUID returned')
+    return response['reingest_uuid'], None
+
+
+def check_reingest(am_client, entry, stall_timeout=STALL_TIMEOUT,
+                   max_status_errors=MAX_STATUS_ERRORS):
+    """
+    Update an in progress AIP entry with the status of its unit.
+
+    A full reingest starts a transfer, which is followed by its ingest; other
+    reingest types start an ingest. The entry records when its unit last made
+    progress, i.e. changed unit, status or microservice. A unit without
+    progress for stall_timeout seconds, including one awaiting user input
+    (e.g. the approval of a partial reingest), or whose status cannot be
+    read max_status_errors times in a row, is failed so that it does not
+    hold its slot forever and can be retried.
+
+    :returns: New state of the entry
+    """
+    now = time.time()
+    entry.setdefault('progress', now)
+    if entry['unit_type'] == 'transfer':
+        am_client.transfer_uuid = entry['unit_uuid']
+        info = am_client.get_transfer_status()
+    else:
+        am_client.sip_uuid = entry['unit_uuid']
+        info = am_client.get_ingest_status()
+    if not isinstance(info, dict) or 'status' not in info:
+        entry['status_errors'] = entry.get('status_errors', 0) + 1
+        LOGGER.debug('No status for %s %s: %s', entry['unit_type'],
+                     entry['unit_uuid'], info)
+        if entry['status_errors'] >= max_status_errors:
+            entry['error'] = 'No status for {} {} after {} checks: {}'.format(
+                entry['unit_type'], entry['unit_uuid'],
+                entry['status_errors'], info)
+            return FAILED
+        return _check_stall(entry, now, stall_timeout)
+    entry['status_errors'] = 0
+    status = info['status']
+    if status in ('FAILED', 'REJECTED'):
+        entry['error'] = '{} {} {}'.format(entry['unit_type'],
+                                           entry['unit_uuid'], status)
+        return FAILED
+    if status == 'COMPLETE' and entry['unit_type'] == 'transfer':
+        if info.get('sip_uuid') not in (None, 'BACKLOG'):
+            entry['unit_type'] = 'ingest'
+            entry['unit_uuid'] = info['sip_uuid']
+            entry['progress'] = now
+            entry.pop('last_status', None)
+            return IN_PROGRESS
+    elif status == 'COMPLETE':
+        return DONE
+    if status == 'USER_INPUT':
+        LOGGER.warning('%s %s awaits user input', entry['unit_type'],
+                       entry['unit_uuid'])
+    last_status = '{} {}'.format(status, info.get('microservice', ''))
+    if last_status != entry.get('last_status'):
+        entry['last_status'] = last_status
+        if status != 'USER_INPUT':
+            entry['progress'] = now
+    return _check_stall(entry, now, stall_timeout)
+
+
+def _check_stall(entry, now, stall_timeout):
+    """Return FAILED if the unit of entry has not made progress for
+    stall_timeout seconds, IN_PROGRESS otherwise."""
+    if stall_timeout is None or now - entry['progress'] < stall_timeout:
+        return IN_PROGRESS
+    entry['error'] = '{} {} stalled for {:.0f} s: {}'.format(
+        entry['unit_type'], entry['unit_uuid'], now - entry['progress'],
+        entry.get('last_status') or 'no status')
+    return FAILED
+
+
+def reingest(ss_client, am_clients, aip_uuids, state_file, max_in_progress=1,
+             reingest_type='FULL', processing_config='default',
+             poll_interval=30, retry_failed=False, stall_timeout=STALL_TIMEOUT,
+             max_status_errors=MAX_STATUS_ERRORS):
+    """
+    Reingest aip_uuids, with at most max_in_progress reingests per pipeline.
+
+    :param ss_client: AMClient with the Storage Service details
+    :param dict am_clients: Pipeline UUIDs to AMClients with the details of
+        their Archivematica
+    :param aip_uuids: Iterable of AIP UUIDs to add to the state
+    :param str state_file: Path to the JSON file with the state of the run
+    :param bool retry_failed: Reingest again the AIPs that failed before
+    :param stall_timeout: Seconds without progress before a reingest is
+        failed, or None to wait forever
+    :param int max_status_errors: Status checks failing in a row before a
+        reingest is failed
+    :returns: Dict with the number of AIPs per state
+    """
+    state = load_state(state_file)
+    aips = state['aips']
+    for aip_uuid in aip_uuids:
+        aips.setdefault(aip_uuid, {'state': PENDING})
+    for entry in aips.values():
+        if retry_failed and entry['state'] == FAILED:
+            entry.clear()
+            entry['state'] = PENDING
+    save_state(state_file, state)
+
+    pending = sorted(u for u, e in aips.items() if e['state'] == PENDING)
+    pending.reverse()  # Popped from the end
+    start = time.time()
+    finished = 0
+    while True:
+        in_progress = {pipeline: [] for pipeline in am_clients}
+        changed = False
+        for aip_uuid, entry in aips.items():
+            if entry['state'] != IN_PROGRESS:
+                continue
+            if entry['pipeline'] not in am_clients:
+                LOGGER.warning('AIP %s is being reingested in pipeline %s,'
+                               ' which is not used in this run',
+                               aip_uuid, entry['pipeline'])
+                continue
+            before = dict(entry)
+            new_state = check_reingest(
+                am_clients[entry['pipeline']], entry,
+                stall_timeout=stall_timeout,
+                max_status_errors=max_status_errors)
+            if new_state == IN_PROGRESS:
+                in_progress[entry['pipeline']].append(aip_uuid)
+                changed |= before != entry
+                continue
+            entry['state'] = new_state
+            entry['finished'] = time.time()
+            finished += 1
+            changed = True
+            if new_state == DONE:
+                LOGGER.info('Reingested AIP %s', aip_uuid)
+            else:
+                LOGGER.error('Reingest of AIP %s failed: %s', aip_uuid,
+                             entry.get('error'))
+
+        # Fill the free slots, least busy pipelines first
+        for pipeline in sorted(in_progress, key=lambda p: len(in_progress[p])):
+            while pending and len(in_progress[pipeline]) < max_in_progress:
+                aip_uuid = pending.pop()
+                entry = aips[aip_uuid]
+                entry['pipeline'] = pipeline
+                entry['started'] = time.time()
+                unit_uuid, error = start_reingest(
+                    ss_client, aip_uuid, pipeline, reingest_type,
+                    processing_config)
+                changed = True
+                if unit_uuid is None:
+                    LOGGER.error('Unable to reingest AIP %s in pipeline %s:'
+                                 ' %s', aip_uuid, pipeline, error)
+                    entry.update(state=FAILED, error=error,
+                                 finished=time.time())
+                    continue
+                LOGGER.info('Started reingest of AIP %s in pipeline %s',
+                            aip_uuid, pipeline)
+                entry.update(state=IN_PROGRESS, unit_uuid=unit_uuid,
+                             progress=time.time(),
+                             unit_type='transfer' if reingest_type == 'FULL'
+                             else 'ingest')
+                in_progress[pipeline].append(aip_uuid)
+        if changed:
+            save_state(state_file, state)
+
+        running = sum(len(uuids) for uuids in in_progress.values())
+        elapsed = time.time() - start
+        LOGGER.info('%s AIPs finished in %.0f s (%.1f per hour), %s in'
+                    ' progress, %s pending', finished, elapsed,
+                    finished * 3600 / max(elapsed, 1), running, len(pending))
+        if not running and not pending:
+            break
+        time.sleep(poll_interval)
+
+    summary = {}
+    for entry in aips.values():
+        summary[entry['state']] = summary.get(entry['state'], 0) + 1
+    return summary
+
+
+def main(ss_url, ss_user, ss_api_key, am_user, am_api_key, state_file,
+         aip_uuids_file=None, all_aips=False, pipelines=None, am_url=None,
+         max_in_progress=1, reingest_type='FULL',
+         processing_config='default', poll_interval=30, retry_failed=False,
+         stall_timeout=STALL_TIMEOUT, max_status_errors=MAX_STATUS_ERRORS):
+    ss_client = amclient.AMClient(
+        ss_url=ss_url,
+        ss_user_name=ss_user,
+        ss_api_key=ss_api_key)
+
+    aip_uuids = []
+    if aip_uuids_file:
+        with open(aip_uuids_file) as f:
+            aip_uuids = [line.strip() for line in f if line.strip()]
+    elif all_aips:
+        aip_uuids = [aip['uuid'] for aip in
+                     ss_client.iter_aips({'status': 'UPLOADED'})]
+    LOGGER.info('%s AIPs to reingest', len(aip_uuids))
+
+    pipeline_urls = get_pipelines(ss_client, am_url, pipelines)
+    if not pipeline_urls:
+        LOGGER.error('No pipeline to reingest to')
+        return 1
+    am_clients = {
+        pipeline: amclient.AMClient(
+            am_url=url,
+            am_user_name=am_user,
+            am_api_key=am_api_key)
+        for pipeline, url in pipeline_urls.items()}
+
+    summary = reingest(
+        ss_client, am_clients, aip_uuids, state_file,
+        max_in_progress=max_in_progress,
+        reingest_type=reingest_type,
+        processing_config=processing_config,
+        poll_interval=poll_interval,
+        retry_failed=retry_failed,
+        stall_timeout=stall_timeout,
+        max_status_errors=max_status_errors)
+    LOGGER.info('Bulk reingest finished: %s', summary)
+    return 2 if summary.get(FAILED) else 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ss-url', metavar='URL', help='Storage Service URL. Default: http://127.0.0.1:8000', default='http://127.0.0.1:8000')
+    parser.add_argument('--ss-user', metavar='USERNAME', required=True, help='Username of the Storage Service user to authenticate as.')
+    parser.add_argument('--ss-api-key', metavar='KEY', required=True, help='API key of the Storage Service user.')
+    parser.add_argument('--am-user', metavar='USERNAME', required=True, help='Username of the Archivematica dashboard user to authenticate as, in all pipelines.')
+    parser.add_argument('--am-api-key', metavar='KEY', required=True, help='API key of the Archivematica dashboard user, in all pipelines.')
+    parser.add_argument('--am-url', metavar='URL', help='Archivematica URL for the pipelines without remote name in the Storage Service.', default=None)
+    parser.add_argument('--state-file', metavar='PATH', required=True, help='JSON file where the progress is saved. Run again with the same file to resume.')
+    aips = parser.add_mutually_exclusive_group()
+    aips.add_argument('--aip-uuids-file', metavar='PATH', help='File with the UUIDs of the AIPs to reingest, one per line.')
+    aips.add_argument('--all-aips', action='store_true', help='Reingest all the stored AIPs in the Storage Service.')
+    parser.add_argument('--pipeline', metavar='UUID', action='append', dest='pipelines', help='Pipeline to reingest to. Can be used multiple times. Default: all pipelines in the Storage Service')
+    parser.add_argument('--max-in-progress', metavar='N', type=int, default=1, help='Maximum number of reingests in progress per pipeline. Default: 1')
+    parser.add_argument('--reingest-type', choices=['FULL', 'OBJECTS', 'METADATA_ONLY'], default='FULL', help='Type of reingest. Default: FULL')
+    parser.add_argument('--processing-config', metavar='NAME', default='default', help='Processing configuration to use. Default: default')
+    parser.add_argument('--poll-interval', metavar='SECONDS', type=float, default=30, help='Seconds between two status checks. Default: 30')
+    parser.add_argument('--retry-failed', action='store_true', help='Reingest again the AIPs that failed in a previous run with the same state file.')
+    parser.add_argument('--stall-timeout', metavar='SECONDS', type=float, default=STALL_TIMEOUT, help='Fail a reingest whose unit makes no progress, or awaits user input, for this many seconds. 0 to wait forever. Default: %(default)s')
+    parser.add_argument('--max-status-errors', metavar='N', type=int, default=MAX_STATUS_ERRORS, help='Fail a reingest whose status cannot be read this many times in a row. Default: %(default)s')
+
+    # Logging
+    parser.add_argument('--log-file', metavar='FILE', help='Location of log file', default=None)
+    parser.add_argument('--verbose', '-v', action='count', default=0, help='Increase the debugging output.')
+    parser.add_argument('--quiet', '-q', action='count', default=0, help='Decrease the debugging output')
+    parser.add_argument('--log-level', choices=['ERROR', 'WARNING', 'INFO', 'DEBUG'], default=None, help='Set the debugging output level. This will override -q and -v')
+
+    args = parser.parse_args()
+
+    log_levels = {
+        2: 'ERROR',
+        1: 'WARNING',
+        0: 'INFO',
+        -1: 'DEBUG',
+    }
+    if args.log_level is None:
+        level = args.quiet - args.verbose
+        level = max(level, -1)  # No smaller than -1
+        level = min(level, 2)  # No larger than 2
+        log_level = log_levels[level]
+    else:
+        log_level = args.log_level
+
+    setup_logger(args.log_file, log_level)
+
+    sys.exit(main(
+        ss_url=args.ss_url,
+        ss_user=args.ss_user,
+        ss_api_key=args.ss_api_key,
+        am_user=args.am_user,
+        am_api_key=args.am_api_key,
+        state_file=args.state_file,
+        aip_uuids_file=args.aip_uuids_file,
+        all_aips=args.all_aips,
+        pipelines=args.pipelines,
+        am_url=args.am_url,
+        max_in_progress=args.max_in_progress,
+        reingest_type=args.reingest_type,
+        processing_config=args.processing_config,
+        poll_interval=args.poll_interval,
+        retry_failed=args.retry_failed,
+        stall_timeout=args.stall_timeout or None,
+        max_status_errors=args.max_status_errors,
+    ))
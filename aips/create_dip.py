@@ -13,21 +13,43 @@ generated alongside the objects folder containing only a reference to the ZIP fi
 """
 
 import argparse
+import hashlib
+import json
 import logging
 import logging.config  # Has to be imported separately
 import os
 import sys
 import subprocess
 import shutil
+import threading
+import time
 import uuid
+from multiprocessing.pool import ThreadPool
 
 import metsrw
 
+from aips import mets_index
+from aips import zip_writer
 from transfers import amclient
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 LOGGER = logging.getLogger('create_dip')
 
+# Temporary space reserved per AIP in batch mode, as a multiple of its size:
+# the downloaded package and the extracted AIP
+TMP_SPACE_FACTOR = 2
+
+# Stages of the DIP creation recorded in the workspace directory, in order
+STAGES = ['downloaded', 'extracted', 'indexed', 'zipped']
+CHECKPOINT_FILE = 'checkpoints.json'
+
+# Version of the DIPs created by this script, recorded in the DIP manifests.
+# Increase it when the content or layout of the DIPs changes, so existing
+# DIPs are created again
+DIP_VERSION = 1
+# Package details compared to tell if an AIP changed since its DIP was created
+PACKAGE_FINGERPRINT_FIELDS = ['current_full_path', 'size', 'stored_date']
+
 
 def setup_logger(log_file, log_level='INFO'):
     """Configures the logger to output to console and log file"""
@@ -67,7 +89,75 @@ def setup_logger(log_file, log_level='INFO'):
     logging.config.dictConfig(CONFIG)
 
 
-def main(ss_url, ss_user, ss_api_key, aip_uuid, tmp_dir, output_dir):
+class TmpBudget(object):
+    """
+    Space reserved in the temporary directory by the AIPs being processed.
+    An AIP is admitted only while its reservation fits in the limit, or when
+    nothing else is reserved so an AIP larger than the limit runs alone.
+    """
+
+    def __init__(self, limit=0):
+        """
+        :param int limit: bytes available in the temporary directory, 0 for
+                          no limit
+        """
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while (self.limit and self.used and
+                   self.used + size > self.limit):
+                self.condition.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+def parse_size(size):
+    """Return the bytes of a size like 1024, 500M or 1.5T."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def local_aip_path(package):
+    """
+    Returns the current_full_path of an AIP if it can be read on this host,
+    when the AIP storage is mounted locally, or None.
+
+    :param dict package: package details from the Storage Service
+    """
+    path = (package.get('current_full_path') or '').rstrip('/')
+    if not path:
+        return
+    if os.path.isdir(path) and os.access(path, os.R_OK | os.X_OK):
+        return path
+    if os.path.isfile(path) and os.access(path, os.R_OK):
+        return path
+
+
+def tmp_space_needed(package, use_local=True):
+    """Return the bytes of temporary space reserved for a package: the
+    downloaded package and its extracted copy, only the extracted copy for a
+    local compressed AIP and nothing for a local uncompressed AIP."""
+    size = int(package.get('size') or 0)
+    local_path = local_aip_path(package) if use_local else None
+    if not local_path:
+        return size * TMP_SPACE_FACTOR
+    if os.path.isdir(local_path):
+        return 0
+    return size
+
+
+def main(ss_url, ss_user, ss_api_key, aip_uuid, tmp_dir, output_dir,
+         use_local=True, force=False):
     LOGGER.info('Starting DIP creation from AIP: %s', aip_uuid)
 
     if not os.path.isdir(tmp_dir):
@@ -78,60 +168,577 @@ def main(ss_url, ss_user, ss_api_key, aip_uuid, tmp_dir, output_dir):
         LOGGER.error('%s is not a valid output directory', output_dir)
         return 2
 
-    # Create empty workspace directory
-    tmp_dir = os.path.join(tmp_dir, aip_uuid)
-    if os.path.exists(tmp_dir):
-        LOGGER.warning('Workspace directory already exists, overwriting')
-        shutil.rmtree(tmp_dir)
+    return process_aip(ss_url, ss_user, ss_api_key, aip_uuid, tmp_dir,
+                       output_dir, use_local=use_local, force=force)
+
+
+def load_checkpoints(workspace_dir):
+    """Return the stage checkpoints saved in a workspace directory."""
+    checkpoint_file = os.path.join(workspace_dir, CHECKPOINT_FILE)
+    if not os.path.isfile(checkpoint_file):
+        return {}
     try:
-        os.makedirs(tmp_dir)
-    except OSError:
-        LOGGER.error('Could not create workspace directory: %s', tmp_dir)
-        return 3
+        with open(checkpoint_file) as f:
+            return json.load(f)
+    except ValueError:
+        LOGGER.warning('Ignoring unreadable checkpoint file: %s', checkpoint_file)
+        return {}
+
+
+def save_checkpoint(workspace_dir, checkpoints, stage, data):
+    """Record a completed stage, dropping the checkpoints of the stages after
+    it, and write the checkpoints to the workspace directory atomically."""
+    for later_stage in STAGES[STAGES.index(stage):]:
+        checkpoints.pop(later_stage, None)
+    checkpoints[stage] = data
+    checkpoint_file = os.path.join(workspace_dir, CHECKPOINT_FILE)
+    tmp_file = '{}.tmp'.format(checkpoint_file)
+    with open(tmp_file, 'w') as f:
+        json.dump(checkpoints, f)
+    os.rename(tmp_file, checkpoint_file)
+
+
+def checkpoint_valid(checkpoints, stage):
+    """
+    Checks cheaply that the output of a completed stage is still there: the
+    size of the downloaded AIP, of the extracted AIP METS file and of the ZIP
+    file. The METS index is valid as long as the extraction is.
+    """
+    data = checkpoints.get(stage)
+    if data is None:
+        return False
+    if stage == 'downloaded':
+        return (os.path.isfile(data['path']) and
+                os.path.getsize(data['path']) == data['size'])
+    if stage == 'extracted':
+        return (os.path.isfile(data['mets_file']) and
+                os.path.getsize(data['mets_file']) == data['mets_size'])
+    if stage == 'indexed':
+        return checkpoint_valid(checkpoints, 'extracted')
+    if stage == 'zipped':
+        return (os.path.isfile(data['zip_file']) and
+                os.path.getsize(data['zip_file']) == data['zip_size'])
+    return False
+
+
+def file_checksum(path):
+    """Return the SHA-256 checksum of a file."""
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def manifest_path(output_dir, aip_uuid):
+    """Return the path of the manifest of the DIP of an AIP."""
+    return os.path.join(output_dir, '{}.dip-manifest.json'.format(aip_uuid))
+
+
+def package_fingerprint(package):
+    """Return the package details that change when an AIP changes."""
+    return {field: package.get(field) for field in PACKAGE_FINGERPRINT_FIELDS}
+
+
+def write_manifest(output_dir, aip_uuid, dip_dir, zip_file, package=None,
+                   mets_checksum=None):
+    """
+    Writes the manifest of a DIP next to it, recording what it was created
+    from: the AIP UUID, the AIP details from the Storage Service, the
+    checksum of the AIP METS file and the DIP version.
+    """
+    manifest = {
+        'aip_uuid': aip_uuid,
+        'aip_mets_checksum': mets_checksum,
+        'package': package_fingerprint(package) if package else None,
+        'dip_version': DIP_VERSION,
+        'dip_dir': dip_dir,
+        'zip_file': zip_file,
+        'zip_size': os.path.getsize(zip_file),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    path = manifest_path(output_dir, aip_uuid)
+    tmp_file = '{}.tmp'.format(path)
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, path)
 
-    LOGGER.info('Downloading AIP from Storage Service')
+
+def dip_up_to_date(output_dir, package):
+    """
+    Checks if the DIP of an AIP in output_dir was created from the same AIP,
+    according to its details in the Storage Service, by the same DIP version,
+    and is still in place. When the AIP is uncompressed and readable on this
+    host, the checksum of its METS file is compared too.
+
+    :param dict package: package details of the AIP from the Storage Service
+    :returns: True if the DIP does not need to be created again
+    """
+    path = manifest_path(output_dir, package['uuid'])
+    if not os.path.isfile(path):
+        return False
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except ValueError:
+        return False
+    if (manifest.get('dip_version') != DIP_VERSION or
+            manifest.get('package') != package_fingerprint(package)):
+        return False
+    zip_file = manifest.get('zip_file') or ''
+    if (not os.path.isfile(zip_file) or
+            os.path.getsize(zip_file) != manifest.get('zip_size')):
+        return False
+    local_path = local_aip_path(package)
+    if local_path and os.path.isdir(local_path):
+        mets_file = '{}/data/METS.{}.xml'.format(local_path, package['uuid'])
+        if (not os.path.isfile(mets_file) or
+                file_checksum(mets_file) != manifest.get('aip_mets_checksum')):
+            return False
+    return True
+
+
+def process_aip(ss_url, ss_user, ss_api_key, aip_uuid, tmp_dir, output_dir,
+                timings=None, package=None, use_local=True, force=False):
+    """
+    Downloads an AIP, extracts it and creates its DIP, in a workspace
+    directory named after the AIP UUID inside tmp_dir. When the AIP storage
+    is mounted locally, the AIP is not downloaded: a compressed AIP is
+    extracted from its current_full_path and an uncompressed AIP is read in
+    place.
+
+    Each completed stage is recorded in the workspace (see STAGES), which is
+    only removed once the DIP is created. Running again after a failure or a
+    crash resumes from the last stage whose output is still valid, and an
+    interrupted download resumes from the partial file.
+
+    A manifest is written next to the DIP, see write_manifest, and the AIP
+    is skipped when its DIP is up to date, see dip_up_to_date.
+
+    :param dict timings: if given, filled with the seconds spent in each step
+                         and skipped=True for AIPs with an up to date DIP
+    :param dict package: package details of the AIP from the Storage Service,
+                         fetched when needed if not given
+    :param bool use_local: read the AIP from its current_full_path if it is
+                           readable on this host
+    :param bool force: create the DIP even if it is up to date
+    :returns: None on success, or the error code for the script
+    """
+    if timings is None:
+        timings = {}
 
     am_client = amclient.AMClient(
         aip_uuid=aip_uuid,
+        package_uuid=aip_uuid,
         ss_url=ss_url,
         ss_user_name=ss_user,
         ss_api_key=ss_api_key,
-        directory=tmp_dir)
+        directory=os.path.join(tmp_dir, aip_uuid))
 
-    aip_file = am_client.download_aip()
+    if package is None and (use_local or not force):
+        package = am_client.get_package_details()
+    if not isinstance(package, dict) or 'uuid' not in package:
+        package = None
 
-    if not aip_file:
-        LOGGER.error('Unable to download AIP')
-        return 4
+    if not force and package and dip_up_to_date(output_dir, package):
+        LOGGER.info('DIP of AIP %s is up to date, skipping', aip_uuid)
+        timings['skipped'] = True
+        return
 
-    LOGGER.info('Extracting AIP')
-    aip_dir = extract_aip(aip_file, aip_uuid, tmp_dir)
+    workspace_dir = os.path.join(tmp_dir, aip_uuid)
+    checkpoints = load_checkpoints(workspace_dir)
+    if checkpoints:
+        LOGGER.info('Resuming from workspace directory: %s', workspace_dir)
+    elif not os.path.isdir(workspace_dir):
+        try:
+            os.makedirs(workspace_dir)
+        except OSError:
+            LOGGER.error('Could not create workspace directory: %s', workspace_dir)
+            return 3
+
+    if checkpoint_valid(checkpoints, 'zipped'):
+        zipped = checkpoints['zipped']
+        LOGGER.info('DIP already created in: %s', zipped['dip_dir'])
+        write_manifest(output_dir, aip_uuid, zipped['dip_dir'],
+                       zipped['zip_file'], package,
+                       checkpoints.get('extracted', {}).get('mets_checksum'))
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+        return
 
-    if not aip_dir:
-        return 5
+    if checkpoint_valid(checkpoints, 'extracted'):
+        aip_dir = checkpoints['extracted']['aip_dir']
+        LOGGER.info('Using extracted AIP: %s', aip_dir)
+    else:
+        local_path = None
+        if use_local and package:
+            local_path = local_aip_path(package)
+
+        # A directory is an uncompressed AIP, whatever its name, as in
+        # tmp_space_needed
+        if local_path and os.path.isdir(local_path):
+            LOGGER.info('Reading uncompressed AIP in place: %s', local_path)
+            aip_dir = local_path
+        else:
+            if local_path:
+                LOGGER.info('Extracting AIP from local storage: %s', local_path)
+                aip_file = local_path
+            elif checkpoint_valid(checkpoints, 'downloaded'):
+                aip_file = checkpoints['downloaded']['path']
+                LOGGER.info('Using downloaded AIP: %s', aip_file)
+            else:
+                LOGGER.info('Downloading AIP from Storage Service')
+                start = time.time()
+                aip_file = am_client.download_aip()
+                timings['download'] = time.time() - start
+
+                if not aip_file:
+                    LOGGER.error('Unable to download AIP')
+                    return 4
+                save_checkpoint(workspace_dir, checkpoints, 'downloaded', {
+                    'path': aip_file, 'size': os.path.getsize(aip_file)})
+
+            LOGGER.info('Extracting AIP')
+            start = time.time()
+            aip_dir = extract_aip(aip_file, aip_uuid, workspace_dir,
+                                  remove_source=not local_path)
+            timings['extract'] = time.time() - start
+
+            if not aip_dir:
+                return 5
+
+        mets_file = '{}/data/METS.{}.xml'.format(aip_dir, aip_uuid)
+        if os.path.isfile(mets_file):
+            save_checkpoint(workspace_dir, checkpoints, 'extracted', {
+                'aip_dir': aip_dir, 'mets_file': mets_file,
+                'mets_size': os.path.getsize(mets_file),
+                'mets_checksum': file_checksum(mets_file)})
 
     LOGGER.info('Creating DIP')
-    dip_dir = create_dip(aip_dir, aip_uuid, output_dir)
+    start = time.time()
+    if checkpoint_valid(checkpoints, 'indexed'):
+        zip_entries = checkpoints['indexed']['zip_entries']
+    else:
+        zip_entries = get_zip_entries(aip_dir, aip_uuid)
+        if zip_entries is not None:
+            save_checkpoint(workspace_dir, checkpoints, 'indexed', {
+                'zip_entries': zip_entries})
+    dip_dir = None
+    if zip_entries is not None:
+        dip_dir = create_dip(aip_dir, aip_uuid, output_dir,
+                             zip_entries=zip_entries)
+    timings['create'] = time.time() - start
 
     if not dip_dir:
         LOGGER.error('Unable to create DIP')
         return 6
 
+    zip_file = os.path.join(dip_dir, 'objects', '{}.zip'.format(
+        os.path.basename(aip_dir)[:-37]))
+    save_checkpoint(workspace_dir, checkpoints, 'zipped', {
+        'dip_dir': dip_dir, 'zip_file': zip_file,
+        'zip_size': os.path.getsize(zip_file)})
+    write_manifest(output_dir, aip_uuid, dip_dir, zip_file, package,
+                   checkpoints.get('extracted', {}).get('mets_checksum'))
+    LOGGER.info('DIP created in: %s', dip_dir)
+
     # Remove workspace directory
-    shutil.rmtree(tmp_dir)
+    shutil.rmtree(workspace_dir, ignore_errors=True)
 
-    LOGGER.info('DIP created in: %s', dip_dir)
 
+def get_packages(ss_client, aip_uuids=None, aip_uuids_file=None,
+                 all_aips=False, aip_filters=None):
+    """
+    Yields the AIPs to create DIPs from, as package details from the Storage
+    Service. The details of AIPs given by UUID are fetched one by one, as they
+    are needed.
+
+    :param list aip_uuids: AIP UUIDs
+    :param str aip_uuids_file: file with AIP UUIDs, one per line
+    :param bool all_aips: all the stored AIPs in the Storage Service
+    :param dict aip_filters: Storage Service package filters for all_aips
+    """
+    if all_aips:
+        params = {'status': 'UPLOADED'}
+        params.update(aip_filters or {})
+        for package in ss_client.iter_aips(params):
+            yield package
+        return
+    aip_uuids = list(aip_uuids or [])
+    if aip_uuids_file:
+        with open(aip_uuids_file) as f:
+            aip_uuids.extend(line.strip() for line in f if line.strip())
+    for aip_uuid in aip_uuids:
+        ss_client.package_uuid = aip_uuid
+        package = ss_client.get_package_details()
+        if not isinstance(package, dict):
+            LOGGER.warning('Could not get the details of AIP %s', aip_uuid)
+            package = {'uuid': aip_uuid}
+        yield package
+
+
+def create_dips(ss_url, ss_user, ss_api_key, packages, tmp_dir, output_dir,
+                workers=1, tmp_budget=0, use_local=True, force=False):
+    """
+    Creates the DIPs of many AIPs with a pool of workers, each one
+    downloading, extracting and zipping an AIP, so the steps of different
+    AIPs overlap. A new AIP is started only when a worker is free and its
+    temporary space fits in the budget.
+
+    :param packages: iterable of package details from the Storage Service
+    :param int workers: number of AIPs processed at the same time
+    :param int tmp_budget: bytes available in tmp_dir, 0 for no limit
+    :param bool use_local: read the AIPs from their current_full_path if it
+                           is readable on this host, see process_aip
+    :param bool force: create the DIPs even if they are up to date
+    :returns: dict with the UUIDs of the created, skipped (up to date) and
+              failed DIPs and the timings of each AIP
+    """
+    budget = TmpBudget(tmp_budget)
+    slots = threading.BoundedSemaphore(workers)
+    summary = {'created': [], 'skipped': [], 'failed': [], 'timings': {}}
+    lock = threading.Lock()
+
+    def worker(package, reserved):
+        aip_uuid = package['uuid']
+        timings = {}
+        start = time.time()
+        try:
+            error = process_aip(ss_url, ss_user, ss_api_key, aip_uuid, tmp_dir,
+                                output_dir, timings, package=package,
+                                use_local=use_local, force=force)
+        except Exception:
+            LOGGER.exception('Unexpected error creating the DIP of %s', aip_uuid)
+            error = -1
+        finally:
+            budget.release(reserved)
+            slots.release()
+        timings['total'] = time.time() - start
+        if error:
+            result = 'failed'
+        elif timings.get('skipped'):
+            result = 'skipped'
+        else:
+            result = 'created'
+        LOGGER.info(
+            'AIP %s: %s in %.1fs (download %.1fs, extract %.1fs, create %.1fs)',
+            aip_uuid, result, timings['total'], timings.get('download', 0),
+            timings.get('extract', 0), timings.get('create', 0))
+        with lock:
+            summary[result].append(aip_uuid)
+            summary['timings'][aip_uuid] = timings
+
+    start = time.time()
+    pool = ThreadPool(workers)
+    try:
+        for package in packages:
+            reserved = tmp_space_needed(package, use_local)
+            slots.acquire()
+            budget.acquire(reserved)
+            pool.apply_async(worker, (package, reserved))
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+    elapsed = time.time() - start
+    timings = summary['timings'].values()
+    LOGGER.info(
+        'Batch finished in %.1fs: %s DIPs created, %s up to date, %s failed. '
+        'Time spent downloading %.1fs, extracting %.1fs, creating DIPs %.1fs',
+        elapsed, len(summary['created']), len(summary['skipped']),
+        len(summary['failed']),
+        sum(t.get('download', 0) for t in timings),
+        sum(t.get('extract', 0) for t in timings),
+        sum(t.get('create', 0) for t in timings))
+    if summary['failed']:
+        LOGGER.warning('Failed AIPs: %s', ', '.join(summary['failed']))
+    return summary
+
+
+def batch_main(ss_url, ss_user, ss_api_key, tmp_dir, output_dir,
+               aip_uuids=None, aip_uuids_file=None, all_aips=False,
+               aip_filters=None, workers=1, tmp_budget=0, use_local=True,
+               force=False):
+    if not os.path.isdir(tmp_dir):
+        LOGGER.error('%s is not a valid temporary directory', tmp_dir)
+        return 1
+
+    if not os.path.isdir(output_dir):
+        LOGGER.error('%s is not a valid output directory', output_dir)
+        return 2
+
+    ss_client = amclient.AMClient(
+        ss_url=ss_url,
+        ss_user_name=ss_user,
+        ss_api_key=ss_api_key)
+    packages = get_packages(ss_client, aip_uuids, aip_uuids_file, all_aips,
+                            aip_filters)
+    summary = create_dips(ss_url, ss_user, ss_api_key, packages, tmp_dir,
+                          output_dir, workers, tmp_budget, use_local, force)
+    return 7 if summary['failed'] else 0
+
+
+def parse_7z_listing(output):
+    """
+    Parses the output of `7z l -slt`.
+
+    :param str output: listing of an archive in technical format
+    :returns: list of the paths of the files in the archive, without folders
+    """
+    paths = []
+    entry = {}
+    started = False
+    for line in output.splitlines() + ['']:
+        if line.startswith('----------'):
+            started = True
+            continue
+        if not started:
+            continue
+        if line.strip():
+            key, _, value = line.partition(' = ')
+            entry[key.strip()] = value
+            continue
+        if 'Path' in entry and not (entry.get('Folder') == '+' or
+                                    entry.get('Attributes', '').startswith('D')):
+            paths.append(entry['Path'])
+        entry = {}
+    return paths
 
-def extract_aip(aip_file, aip_uuid, tmp_dir):
+
+def list_archive(archive):
+    """
+    Lists the files in an archive.
+
+    :param str archive: absolute path to the archive
+    :returns: list of the paths of the files in the archive or None
+    """
+    command = ['7z', 'l', '-slt', archive]
+    try:
+        output = subprocess.check_output(command, stderr=subprocess.STDOUT)
+        return parse_7z_listing(output.decode('utf-8'))
+    except (subprocess.CalledProcessError, OSError, UnicodeDecodeError) as e:
+        LOGGER.debug('Could not list archive %s, error: %s', archive, e)
+        return None
+
+
+def extract_paths(archive, paths, tmp_dir):
+    """
+    Extracts some files from an archive, keeping their paths.
+
+    :param str archive: absolute path to the archive
+    :param list paths: paths of the files in the archive
+    :param str tmp_dir: absolute path to a directory to extract them to
+    :returns: True if the files were extracted
     """
-    Extracts an AIP to a folder.
+    list_file = os.path.join(tmp_dir, '.extract-{}.txt'.format(uuid.uuid4()))
+    with open(list_file, 'wb') as f:
+        f.write('\n'.join(paths).encode('utf-8'))
+    command = ['7z', 'x', '-bd', '-y', '-scsUTF-8', '-o{0}'.format(tmp_dir),
+               archive, '@{0}'.format(list_file)]
+    try:
+        subprocess.check_output(command, stderr=subprocess.STDOUT)
+        return True
+    except subprocess.CalledProcessError as e:
+        LOGGER.warning('Could not extract files from %s, error: %s', archive, e.output)
+        return False
+    finally:
+        os.remove(list_file)
+
+
+def get_original_paths(mets_file):
+    """
+    Gets the paths of the original files from an AIP METS file.
+
+    :param str mets_file: absolute path to the AIP METS file
+    :returns: set of paths relative to the AIP data folder
+    """
+    return {f.path for f in mets_index.index_mets(mets_file).files if f.path}
+
+
+def select_paths(paths, aip_dirname, original_paths):
+    """
+    Selects the archive paths needed to create the DIP: the original files
+    and the submission documentation.
+
+    :param list paths: paths of the files in the AIP archive
+    :param str aip_dirname: name of the top folder of the AIP
+    :param set original_paths: paths of the original files relative to the
+                               AIP data folder
+    :returns: list of archive paths
+    """
+    data_dir = '{}/data/'.format(aip_dirname)
+    sub_doc_dir = '{}objects/submissionDocumentation/'.format(data_dir)
+    return [path for path in paths if path.startswith(sub_doc_dir) or
+            (path.startswith(data_dir) and path[len(data_dir):] in original_paths)]
+
+
+def extract_aip_selectively(aip_file, aip_uuid, tmp_dir, remove_source=True):
+    """
+    Extracts only the METS file, the original files and the submission
+    documentation of an AIP, in two steps: the METS file first, to find the
+    original files, and those files next.
+
+    :param str aip_file: absolute path to an AIP
+    :param str aip_uuid: UUID from the AIP
+    :param str tmp_dir: absolute path to a directory to place the extracted AIP
+    :param bool remove_source: remove aip_file once extracted
+    :returns: absolute path to the extracted AIP folder or None if the AIP
+              could not be extracted this way
+    """
+    paths = list_archive(aip_file)
+    if not paths:
+        return
+    mets_name = '/data/METS.{}.xml'.format(aip_uuid)
+    mets_paths = [path for path in paths
+                  if path.endswith(mets_name) and path.count('/') == 2]
+    if len(mets_paths) != 1:
+        return
+    aip_dirname = mets_paths[0][:-len(mets_name)]
+
+    LOGGER.info('Extracting AIP METS file')
+    if not extract_paths(aip_file, mets_paths, tmp_dir):
+        return
+    try:
+        original_paths = get_original_paths(os.path.join(tmp_dir, mets_paths[0]))
+    except Exception as e:
+        LOGGER.warning('Could not parse AIP METS file, error: %s', e)
+        return
+    selected = select_paths(paths, aip_dirname, original_paths)
+    # Paths with wildcard characters would be expanded by 7z
+    if any('*' in path or '?' in path for path in selected):
+        return
+
+    LOGGER.info('Extracting %s of %s files from AIP', len(selected), len(paths))
+    if selected and not extract_paths(aip_file, selected, tmp_dir):
+        return
+
+    # Remove extracted file to avoid multiple entries with the same UUID
+    if remove_source:
+        try:
+            os.remove(aip_file)
+        except OSError:
+            pass
+
+    return os.path.join(tmp_dir, aip_dirname)
+
+
+def extract_aip(aip_file, aip_uuid, tmp_dir, remove_source=True):
+    """
+    Extracts an AIP to a folder. Only the files needed to create the DIP are
+    extracted when possible, see extract_aip_selectively, otherwise the full
+    AIP is.
 
     :param str aip_file: absolute path to an AIP
     :param str aip_uuid: UUID from the AIP
     :param str tmp_dir: absolute path to a directory to place the extracted AIP
+    :param bool remove_source: remove aip_file once extracted, disable it for
+                               AIPs read from the AIP storage
     :returns: absolute path to the extracted AIP folder
     """
+    aip_dir = extract_aip_selectively(aip_file, aip_uuid, tmp_dir, remove_source)
+    if aip_dir:
+        return aip_dir
+
     command = ['7z', 'x', '-bd', '-y', '-o{0}'.format(tmp_dir), aip_file]
     try:
         subprocess.check_output(command, stderr=subprocess.STDOUT)
@@ -140,14 +747,16 @@ def extract_aip(aip_file, aip_uuid, tmp_dir):
         return
 
     # Remove extracted file to avoid multiple entries with the same UUID
-    try:
-        os.remove(aip_file)
-    except OSError:
-        pass
+    if remove_source:
+        try:
+            os.remove(aip_file)
+        except OSError:
+            pass
 
     # Find extracted entry. Assuming it contains the AIP UUID
+    extracted_entry = None
     for entry in os.listdir(tmp_dir):
-        if aip_uuid in entry:
+        if aip_uuid in entry and os.path.join(tmp_dir, entry) != aip_file:
             extracted_entry = os.path.join(tmp_dir, entry)
 
     if not extracted_entry:
@@ -162,72 +771,56 @@ def extract_aip(aip_file, aip_uuid, tmp_dir):
     return extract_aip(extracted_entry, aip_uuid, tmp_dir)
 
 
-def create_dip(aip_dir, aip_uuid, output_dir):
+def get_zip_entries(aip_dir, aip_uuid):
     """
-    Creates a DIP from an uncompressed AIP.
+    Lists the files of an uncompressed AIP that go in the DIP ZIP file: the
+    submissionDocumentation folder, the AIP METS file and the original files
+    with their original names, found through the METS file.
 
     :param str aip_dir: absolute path to an uncompressed AIP
     :param str aip_uuid: UUID from the AIP
-    :param str output_dir: absolute path to a directory to place the DIP
-    :returns: absolute path to the created DIP folder
+    :returns: list of (path, name in the ZIP file, modification timestamp or
+              None to keep the one of the file, premis:fixity algorithm and
+              checksum of the original files or None), or None if the METS
+              file can not be found
     """
     aip_name = os.path.basename(aip_dir)[:-37]
-    dip_dir = os.path.join(output_dir, '{}_{}_DIP'.format(aip_name, aip_uuid))
-    objects_dir = os.path.join(dip_dir, 'objects')
-    to_zip_dir = os.path.join(objects_dir, aip_name)
-
-    if os.path.exists(dip_dir):
-        LOGGER.warning('DIP folder already exists, overwriting')
-        shutil.rmtree(dip_dir)
-    os.makedirs(to_zip_dir)
+    zip_entries = []
 
-    LOGGER.info('Moving submissionDocumentation folder')
+    LOGGER.info('Adding submissionDocumentation folder')
     aip_sub_doc = '{}/data/objects/submissionDocumentation'.format(aip_dir)
     if os.path.exists(aip_sub_doc):
-        to_zip_sub_doc = os.path.join(to_zip_dir, 'submissionDocumentation')
-        shutil.move(aip_sub_doc, to_zip_sub_doc)
+        for dirpath, _, filenames in os.walk(aip_sub_doc):
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                zip_entries.append((path, '{}/submissionDocumentation/{}'.format(
+                    aip_name, os.path.relpath(path, aip_sub_doc)), None, None, None))
     else:
         LOGGER.warning('submissionDocumentation folder not found')
 
-    LOGGER.info('Moving METS file')
+    LOGGER.info('Adding METS file')
     aip_mets_file = '{}/data/METS.{}.xml'.format(aip_dir, aip_uuid)
     if not os.path.exists(aip_mets_file):
         LOGGER.error('Could not find AIP METS file')
         return
-    to_zip_mets_file = '{}/METS.{}.xml'.format(to_zip_dir, aip_uuid)
-    shutil.move(aip_mets_file, to_zip_mets_file)
+    zip_entries.append((aip_mets_file, '{}/METS.{}.xml'.format(
+        aip_name, aip_uuid), None, None, None))
 
-    mets = metsrw.METSDocument.fromfile(to_zip_mets_file)
-    fsentries = mets.all_files()
-    for fsentry in fsentries:
-        if fsentry.use != 'original' or not fsentry.path or not fsentry.file_uuid:
+    for original in mets_index.index_mets(aip_mets_file).files:
+        if not original.path:
             continue
 
-        LOGGER.info('Moving file: %s', fsentry.path)
-        aip_file_path = os.path.join(os.path.join(aip_dir, 'data'), fsentry.path)
+        LOGGER.info('Adding file: %s', original.path)
+        aip_file_path = os.path.join(os.path.join(aip_dir, 'data'), original.path)
         if not os.path.exists(aip_file_path):
             LOGGER.warning('Could not find file in AIP')
             continue
 
-        if not len(fsentry.amdsecs):
+        if not original.amd_id:
             LOGGER.warning('Missing amdSec in METS file')
             continue
 
-        amdsec = fsentry.amdsecs[0]
-        for item in amdsec.subsections:
-            if item.subsection == 'techMD':
-                techmd = item
-        if not techmd:
-            LOGGER.warning('techMD section could not be found')
-            continue
-
-        if techmd.contents.mdtype != 'PREMIS:OBJECT':
-            LOGGER.warning('premis:object could not be found')
-            continue
-
-        premis = techmd.contents.document
-        original_name = premis.findtext('premis:originalName',
-                                        namespaces=metsrw.utils.NAMESPACES)
+        original_name = original.original_name
         if not original_name:
             LOGGER.warning('premis:originalName could not be found')
             continue
@@ -237,42 +830,125 @@ def create_dip(aip_dir, aip_uuid, output_dir):
             LOGGER.warning('premis:originalName not starting with %s', string_start)
             continue
 
-        # Move original file with original name and create parent folders
-        dip_file_path = os.path.join(to_zip_dir, original_name[27:])
-        dip_dir_path = os.path.dirname(dip_file_path)
-        if not os.path.exists(dip_dir_path):
-            os.makedirs(dip_dir_path)
+        # Add original file with original name and the fslastmodified date
+        timestamp = None
+        if original.fslastmodified:
+            # Convert from miliseconds to seconds
+            timestamp = int(original.fslastmodified) // 1000
+        else:
+            LOGGER.warning('fits/fileinfo/fslastmodified not found')
+        zip_entries.append((aip_file_path, '{}/{}'.format(
+            aip_name, original_name[27:]), timestamp, original.checksum_type,
+            original.checksum))
 
-        shutil.move(aip_file_path, dip_file_path)
+    return zip_entries
 
-        # Obtain and set the fslastmodified date to the moved files
-        fslastmodified = premis.findtext('premis:objectCharacteristics/premis:objectCharacteristicsExtension/fits:fits/fits:fileinfo/fits:fslastmodified', namespaces=metsrw.utils.NAMESPACES)
-        if not fslastmodified:
-            LOGGER.warning('fits/fileinfo/fslastmodified not found')
-            continue
 
-        # Convert from miliseconds to seconds
-        timestamp = int(fslastmodified) // 1000
-        os.utime(dip_file_path, (timestamp, timestamp))
+def hash_algorithm(checksum_type):
+    """Return the hashlib name of a premis:messageDigestAlgorithm, like
+    sha256 for SHA-256, or None if it is not available."""
+    if not checksum_type:
+        return
+    name = checksum_type.lower().replace('-', '')
+    try:
+        hashlib.new(name)
+    except ValueError:
+        return
+    return name
+
 
-    # Modify METS file for DIP
-    objects_entry = None
-    for fsentry in fsentries:
-        # Do not delete AIP entry
-        if fsentry.label == os.path.basename(aip_dir) and fsentry.type.lower() == 'directory':
-            continue
+def fixity_report_path(output_dir, aip_uuid):
+    """Return the path of the fixity report of the DIP of an AIP."""
+    return os.path.join(output_dir, '{}.fixity-report.json'.format(aip_uuid))
 
-        # Do not delete objects entry and save it for parenting
-        if fsentry.label == 'objects' and fsentry.type.lower() == 'directory':
-            objects_entry = fsentry
+
+def verify_fixity(zip_entries, digests, output_dir, aip_uuid):
+    """
+    Compares the digests of the zipped files with their premis:fixity
+    checksums and writes a JSON report next to the DIP with the number of
+    files verified, the mismatches and the files that could not be verified.
+
+    :param list zip_entries: files zipped, see get_zip_entries
+    :param dict digests: digests computed while zipping, by name in the ZIP
+    :returns: True if no file has a mismatching checksum
+    """
+    report = {
+        'aip_uuid': aip_uuid,
+        'verified': 0,
+        'mismatches': [],
+        'unverified': [],
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    for path, arcname, _, checksum_type, checksum in zip_entries:
+        if not checksum:
             continue
+        digest = digests.get(arcname)
+        if digest is None:
+            report['unverified'].append({
+                'path': path,
+                'name': arcname,
+                'algorithm': checksum_type,
+            })
+        elif digest.lower() == checksum.lower():
+            report['verified'] += 1
+        else:
+            LOGGER.error('Checksum mismatch for file: %s', path)
+            report['mismatches'].append({
+                'path': path,
+                'name': arcname,
+                'algorithm': checksum_type,
+                'expected': checksum,
+                'actual': digest,
+            })
+    if report['unverified']:
+        LOGGER.warning('%s files could not be verified, unknown algorithm',
+                       len(report['unverified']))
+    LOGGER.info('%s files verified, %s mismatches', report['verified'],
+                len(report['mismatches']))
+
+    path = fixity_report_path(output_dir, aip_uuid)
+    tmp_file = '{}.tmp'.format(path)
+    with open(tmp_file, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, path)
+    return not report['mismatches']
+
+
+def create_dip(aip_dir, aip_uuid, output_dir, zip_workers=zip_writer.WORKERS,
+               zip_entries=None):
+    """
+    Creates a DIP from an uncompressed AIP. The original files are checked
+    against their premis:fixity checksums while they are zipped, see
+    verify_fixity, and the DIP is not created if any of them does not match.
 
-        # Delete all the others
-        mets.remove_entry(fsentry)
+    :param str aip_dir: absolute path to an uncompressed AIP
+    :param str aip_uuid: UUID from the AIP
+    :param str output_dir: absolute path to a directory to place the DIP
+    :param int zip_workers: number of files compressed in parallel
+    :param list zip_entries: files to zip, from get_zip_entries if not given
+    :returns: absolute path to the created DIP folder
+    """
+    if zip_entries is None:
+        zip_entries = get_zip_entries(aip_dir, aip_uuid)
+        if zip_entries is None:
+            return
 
-    if not objects_entry:
-        LOGGER.error('Could not find objects entry in METS file')
-        return
+    aip_name = os.path.basename(aip_dir)[:-37]
+    dip_dir = os.path.join(output_dir, '{}_{}_DIP'.format(aip_name, aip_uuid))
+    objects_dir = os.path.join(dip_dir, 'objects')
+
+    if os.path.exists(dip_dir):
+        LOGGER.warning('DIP folder already exists, overwriting')
+        shutil.rmtree(dip_dir)
+    os.makedirs(objects_dir)
+
+    # Create a METS file for the DIP with the AIP and objects directories and
+    # the ZIP file, without AMD or DMD sections
+    objects_entry = metsrw.FSEntry(label='objects', type='Directory')
+    aip_entry = metsrw.FSEntry(label=os.path.basename(aip_dir), type='Directory',
+                               children=[objects_entry])
+    mets = metsrw.METSDocument()
+    mets.append_file(aip_entry)
 
     # Create new entry for ZIP file
     entry = metsrw.FSEntry(
@@ -293,16 +969,24 @@ def create_dip(aip_dir, aip_uuid, output_dir):
         LOGGER.error('Could not create DIP METS file')
         return
 
-    # Compress to_zip_dir inside the DIP objects folder
-    LOGGER.info('Compressing ZIP folder inside objects')
-    command = ['7z', 'a', '-tzip', '{0}.zip'.format(to_zip_dir), to_zip_dir]
+    # Create the ZIP file inside the DIP objects folder, hashing the original
+    # files with their premis:fixity algorithm in the same read
+    LOGGER.info('Creating ZIP file inside objects')
+    zip_path = os.path.join(objects_dir, '{}.zip'.format(aip_name))
+    digests = {}
     try:
-        subprocess.check_output(command, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        LOGGER.error('Could not compress ZIP folder, error: %s', e.output)
+        zip_writer.write_zip(
+            zip_path,
+            [(path, arcname, timestamp, hash_algorithm(checksum_type))
+             for path, arcname, timestamp, checksum_type, _ in zip_entries],
+            workers=zip_workers, digests=digests)
+    except (IOError, OSError) as e:
+        LOGGER.error('Could not create ZIP file, error: %s', e)
         return
 
-    shutil.rmtree(to_zip_dir)
+    if not verify_fixity(zip_entries, digests, output_dir, aip_uuid):
+        shutil.rmtree(dip_dir)
+        return
 
     return dip_dir
 
@@ -313,9 +997,17 @@ if __name__ == '__main__':
     parser.add_argument('--ss-url', metavar='URL', help='Storage Service URL. Default: http://127.0.0.1:8000', default='http://127.0.0.1:8000')
     parser.add_argument('--ss-user', metavar='USERNAME', required=True, help='Username of the Storage Service user to authenticate as.')
     parser.add_argument('--ss-api-key', metavar='KEY', required=True, help='API key of the Storage Service user.')
-    parser.add_argument('--aip-uuid', metavar='UUID', required=True, help='UUID of the AIP in the Storage Service')
+    aips = parser.add_mutually_exclusive_group(required=True)
+    aips.add_argument('--aip-uuid', metavar='UUID', action='append', dest='aip_uuids', help='UUID of the AIP in the Storage Service. Can be used multiple times.')
+    aips.add_argument('--aip-uuids-file', metavar='PATH', help='File with the UUIDs of the AIPs, one per line.')
+    aips.add_argument('--all-aips', action='store_true', help='Create the DIPs of all the stored AIPs in the Storage Service.')
+    parser.add_argument('--aip-filter', metavar='FIELD=VALUE', action='append', default=[], help='Storage Service package filter for --all-aips, e.g. current_location=<URI>. Can be used multiple times.')
+    parser.add_argument('--workers', metavar='N', type=int, default=1, help='Number of AIPs processed at the same time. Default: 1')
+    parser.add_argument('--tmp-budget', metavar='SIZE', type=parse_size, default=0, help='Space available in the temporary directory, in bytes or with a K, M, G or T suffix. New AIPs are started only while their download and extraction fit. Default: no limit')
     parser.add_argument('--tmp-dir', metavar='PATH', help='Absolute path to the directory used for temporary files. Default: /tmp', default='/tmp')
     parser.add_argument('--output-dir', metavar='PATH', help='Absolute path to the directory used to place the final DIP. Default: /tmp', default='/tmp')
+    parser.add_argument('--force', action='store_true', help='Create the DIPs even if they are up to date with their AIPs.')
+    parser.add_argument('--always-download', action='store_true', help='Download the AIPs from the Storage Service even when their storage is readable on this host.')
 
     # Logging
     parser.add_argument('--log-file', metavar='FILE', help='Location of log file', default=None)
@@ -341,11 +1033,30 @@ if __name__ == '__main__':
 
     setup_logger(args.log_file, log_level)
 
-    sys.exit(main(
+    if args.aip_uuids and len(args.aip_uuids) == 1:
+        sys.exit(main(
+            ss_url=args.ss_url,
+            ss_user=args.ss_user,
+            ss_api_key=args.ss_api_key,
+            aip_uuid=args.aip_uuids[0],
+            tmp_dir=args.tmp_dir,
+            output_dir=args.output_dir,
+            use_local=not args.always_download,
+            force=args.force,
+        ))
+
+    sys.exit(batch_main(
         ss_url=args.ss_url,
         ss_user=args.ss_user,
         ss_api_key=args.ss_api_key,
-        aip_uuid=args.aip_uuid,
         tmp_dir=args.tmp_dir,
-        output_dir=args.output_dir
+        output_dir=args.output_dir,
+        aip_uuids=args.aip_uuids,
+        aip_uuids_file=args.aip_uuids_file,
+        all_aips=args.all_aips,
+        aip_filters=dict(f.split('=', 1) for f in args.aip_filter),
+        workers=args.workers,
+        tmp_budget=args.tmp_budget,
+        use_local=not args.always_download,
+        force=args.force,
     ))
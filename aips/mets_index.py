@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+METS index
+
+Reads an Archivematica AIP METS file in one streaming pass and keeps only a
+compact table of the original files: IDs, path in the AIP, original name,
+size, fixity and the dates reported by the characterization tools, plus the
+original names of the directories. The XML elements are discarded as soon
+as they have been read, so memory use depends on the number of files and not
+on the size of the METS file, which can be gigabytes for large AIPs.
+
+Archivematica writes the amdSecs before the fileSec, so the premis:object of
+every amdSec is kept (as a few strings) until the fileSec tells which ones
+belong to original files.
+"""
+
+from collections import namedtuple
+from xml.etree import ElementTree
+
+FITS_NS = 'http://hul.harvard.edu/ois/xml/ns/fits/fits_output'
+MEDIAINFO_NS = 'https://mediaarea.net/mediainfo'
+METS_NS = 'http://www.loc.gov/METS/'
+PREMIS_NS = 'info:lc/xmlns/premis-v2'
+PREMIS_V3_NS = 'http://www.loc.gov/premis/v3'
+SYSTEM_NS = 'http://ns.exiftool.ca/File/System/1.0/'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+METS_AMDSEC = '{%s}amdSec' % METS_NS
+METS_DMDSEC = '{%s}dmdSec' % METS_NS
+METS_FILEGRP = '{%s}fileGrp' % METS_NS
+METS_FILE = '{%s}file' % METS_NS
+METS_FLOCAT = '{%s}FLocat' % METS_NS
+METS_TECHMD = '{%s}techMD' % METS_NS
+METS_SECTIONS = {METS_AMDSEC, METS_DMDSEC, '{%s}fileSec' % METS_NS,
+                 '{%s}structMap' % METS_NS, '{%s}metsHdr' % METS_NS}
+XLINK_HREF = '{%s}href' % XLINK_NS
+
+OriginalFile = namedtuple('OriginalFile', [
+    'file_id',
+    'amd_id',
+    'path',
+    'original_name',
+    'size',
+    'checksum_type',
+    'checksum',
+    'fslastmodified',
+    'exif_access_date',
+    'exif_modify_date',
+    'mediainfo_modify_date',
+])
+
+MetsIndex = namedtuple('MetsIndex', ['files', 'directories'])
+
+# premis:object fields kept per amdSec, in OriginalFile order
+_PREMIS_FIELDS = OriginalFile._fields[3:]
+
+
+def _findtext(element, path):
+    """Return the stripped text of the first match of path, or None."""
+    text = element.findtext(path)
+    return text.strip() if text else None
+
+
+def _find_premis_object(amdsec):
+    """Return the premis:object of the current techMD of an amdSec and its
+    namespace, or (None, None).
+
+    A reingested AIP keeps the superseded techMDs, so the one with
+    STATUS="current" is used, falling back to the last one."""
+    techmds = amdsec.findall(METS_TECHMD)
+    current = [t for t in techmds if t.get('STATUS') == 'current']
+    for techmd in current[-1:] + techmds[::-1]:
+        for ns in (PREMIS_NS, PREMIS_V3_NS):
+            obj = techmd.find('.//{%s}object' % ns)
+            if obj is not None:
+                return obj, ns
+    return None, None
+
+
+def _read_premis_object(amdsec):
+    """Return the tuple of _PREMIS_FIELDS of the premis:object in the current
+    techMD of an amdSec, or None if there is none."""
+    obj, ns = _find_premis_object(amdsec)
+    if obj is None:
+        return None
+    characteristics = '{%s}objectCharacteristics' % ns
+    fixity = '%s/{%s}fixity' % (characteristics, ns)
+    exif = characteristics + '//{%s}%s'
+    return (
+        _findtext(obj, '{%s}originalName' % ns),
+        _findtext(obj, '%s/{%s}size' % (characteristics, ns)),
+        _findtext(obj, '%s/{%s}messageDigestAlgorithm' % (fixity, ns)),
+        _findtext(obj, '%s/{%s}messageDigest' % (fixity, ns)),
+        _findtext(obj, '%s//{%s}fileinfo/{%s}fslastmodified' % (characteristics, FITS_NS, FITS_NS)),
+        (_findtext(obj, exif % (SYSTEM_NS, 'FileAccessDate')) or
+         _findtext(obj, characteristics + '//FileAccessDate')),
+        (_findtext(obj, exif % (SYSTEM_NS, 'FileModifyDate')) or
+         _findtext(obj, characteristics + '//FileModifyDate')),
+        _findtext(obj, '%s//{%s}File_Modified_Date' % (characteristics, MEDIAINFO_NS)),
+    )
+
+
+def _read_directory_name(dmdsec):
+    """Return the premis:originalName of a directory dmdSec, or None."""
+    return _findtext(dmdsec, './/{%s}object/{%s}originalName' % (PREMIS_V3_NS, PREMIS_V3_NS))
+
+
+def index_mets(mets_file, use='original'):
+    """
+    Index the files of a METS file.
+
+    :param str mets_file: absolute path to the METS file
+    :param str use: fileGrp USE of the files to index
+    :returns: MetsIndex with the list of OriginalFile of the files in the
+              fileGrp, in document order, and the list of original names of
+              the directories
+    """
+    premis_objects = {}
+    files = []
+    directories = []
+    file_grp_use = None
+    root = None
+    for event, elem in ElementTree.iterparse(mets_file, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            elif elem.tag == METS_FILEGRP:
+                file_grp_use = elem.get('USE')
+            continue
+        if elem.tag == METS_AMDSEC:
+            premis_object = _read_premis_object(elem)
+            if premis_object:
+                premis_objects[elem.get('ID')] = premis_object
+        elif elem.tag == METS_DMDSEC:
+            name = _read_directory_name(elem)
+            if name:
+                directories.append(name)
+        elif elem.tag == METS_FILE:
+            if file_grp_use == use:
+                flocat = elem.find(METS_FLOCAT)
+                amd_id = elem.get('ADMID')
+                premis_object = premis_objects.get(amd_id) or (None,) * len(_PREMIS_FIELDS)
+                files.append(OriginalFile(
+                    elem.get('ID'),
+                    amd_id,
+                    flocat.get(XLINK_HREF) if flocat is not None else None,
+                    *premis_object))
+            elem.clear()
+            continue
+        elif elem.tag == METS_FILEGRP:
+            file_grp_use = None
+        if elem.tag in METS_SECTIONS:
+            # Drop the section from the tree, it has been read
+            root.clear()
+    return MetsIndex(files, directories)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""
+ZIP writer
+
+Writes a ZIP file from files on disk, compressing the entries in parallel
+threads (zlib releases the GIL while compressing). Already compressed formats
+are stored as they are and the rest is deflated, falling back to storing the
+entries that do not shrink. Each entry is compressed by a worker into a
+temporary file next to the ZIP file and copied into the ZIP file in order by
+the calling thread; stored entries are copied straight from their source.
+
+The ZIP format is written directly because the zipfile module can only
+compress the entries itself, one at a time. ZIP64 records are added when the
+sizes, offsets or number of entries require them. Modification times are
+kept as the DOS date and time, in local time like zipfile and 7z, and as an
+extended timestamp extra field. Times outside the range of either are
+clamped in the DOS date and left out of the extra field.
+
+Entries can also be hashed with a hashlib algorithm in the same read, to
+check their fixity without reading the files again.
+"""
+
+from collections import deque
+import hashlib
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+
+STORED = 0
+DEFLATED = 8
+
+# Extensions of formats that do not compress further
+COMPRESSED_EXTENSIONS = {
+    '.7z', '.aac', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz', '.jp2',
+    '.jpeg', '.jpg', '.m4a', '.m4v', '.mkv', '.mov', '.mp3', '.mp4', '.mpeg',
+    '.mpg', '.odp', '.ods', '.odt', '.ogg', '.pdf', '.png', '.pptx', '.rar',
+    '.tgz', '.webm', '.webp', '.xlsx', '.xz', '.zip',
+}
+WORKERS = 4
+CHUNK_SIZE = 1024 * 1024
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+FLAG_UTF8 = 0x800
+UNIX_FILE_ATTRIBUTES = (0o100644 << 16)
+TIMESTAMP_MIN = -2 ** 31
+TIMESTAMP_MAX = 2 ** 31 - 1
+
+
+def compression_method(path):
+    """Return STORED for already compressed formats, DEFLATED otherwise."""
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return STORED
+    return DEFLATED
+
+
+def _dos_date_time(timestamp):
+    """Return the DOS date and time of a timestamp, in local time, clamped to
+    the years DOS dates can hold, 1980 to 2107."""
+    try:
+        t = time.localtime(timestamp)
+        year = t.tm_year
+    except (ValueError, OverflowError, OSError):
+        year = 9999 if timestamp > 0 else 0
+    if year > 2107:
+        return (127 << 9) | (12 << 5) | 31, (23 << 11) | (59 << 5) | 29
+    if year < 1980:
+        return (1 << 5) | 1, 0
+    date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    time_ = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return date, time_
+
+
+class _Entry(object):
+    """An entry ready to be copied into the ZIP file."""
+
+    def __init__(self, source, arcname, mtime, algorithm=None):
+        self.source = source
+        self.arcname = arcname
+        self.mtime = mtime
+        self.algorithm = algorithm
+        self.digest = None
+        self.method = compression_method(source)
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.data = None  # Temporary file with the deflated data
+        self.offset = None
+
+
+def _prepare(entry, tmp_dir, level):
+    """Compute the CRC, sizes and digest of an entry, deflating it to a
+    temporary file unless it is stored."""
+    hash_ = hashlib.new(entry.algorithm) if entry.algorithm else None
+    compressor = None
+    if entry.method == DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        entry.data = tempfile.TemporaryFile(dir=tmp_dir)
+    crc = 0
+    with open(entry.source, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            entry.size += len(chunk)
+            if hash_:
+                hash_.update(chunk)
+            if compressor:
+                entry.data.write(compressor.compress(chunk))
+    entry.crc = crc & 0xFFFFFFFF
+    if hash_:
+        entry.digest = hash_.hexdigest()
+    if compressor:
+        entry.data.write(compressor.flush())
+        entry.compressed_size = entry.data.tell()
+        if entry.compressed_size >= entry.size:
+            # Not worth it, store the entry instead
+            entry.data.close()
+            entry.data = None
+            entry.method = STORED
+    if entry.method == STORED:
+        entry.compressed_size = entry.size
+    return entry
+
+
+def _timestamp_extra(mtime):
+    """Return the extended timestamp extra field of a modification time, or
+    nothing if it does not fit in its signed 32 bits, e.g. after 2038."""
+    mtime = int(mtime)
+    if not TIMESTAMP_MIN <= mtime <= TIMESTAMP_MAX:
+        return b''
+    return struct.pack('<HHBl', 0x5455, 5, 1, mtime)
+
+
+def _local_header(entry, name, flags, date, time_):
+    zip64 = entry.size >= ZIP64_LIMIT or entry.compressed_size >= ZIP64_LIMIT
+    extra = _timestamp_extra(entry.mtime)
+    if zip64:
+        extra += struct.pack('<HHQQ', 0x0001, 16, entry.size,
+                             entry.compressed_size)
+    return struct.pack(
+        '<LHHHHHLLLHH', 0x04034b50,
+        VERSION_ZIP64 if zip64 else VERSION_DEFAULT, flags, entry.method,
+        time_, date, entry.crc,
+        ZIP64_LIMIT if zip64 else entry.compressed_size,
+        ZIP64_LIMIT if zip64 else entry.size,
+        len(name), len(extra)) + name + extra
+
+
+def _central_header(entry, name, flags, date, time_):
+    zip64_fields = []
+    size, compressed_size, offset = (
+        entry.size, entry.compressed_size, entry.offset)
+    if size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT:
+        # Both are in the extra field when either is, like the local header
+        zip64_fields += [size, compressed_size]
+        size = compressed_size = ZIP64_LIMIT
+    if offset >= ZIP64_LIMIT:
+        zip64_fields.append(offset)
+        offset = ZIP64_LIMIT
+    extra = _timestamp_extra(entry.mtime)
+    if zip64_fields:
+        extra += struct.pack('<HH', 0x0001, 8 * len(zip64_fields))
+        extra += struct.pack('<%dQ' % len(zip64_fields), *zip64_fields)
+    version = VERSION_ZIP64 if zip64_fields else VERSION_DEFAULT
+    return struct.pack(
+        '<LHHHHHHLLLHHHHHLL', 0x02014b50, (3 << 8) | version, version, flags,
+        entry.method, time_, date, entry.crc, compressed_size, size,
+        len(name), len(extra), 0, 0, 0, UNIX_FILE_ATTRIBUTES,
+        offset) + name + extra
+
+
+def _encode_name(arcname):
+    if isinstance(arcname, bytes):
+        name = arcname
+    else:
+        name = arcname.encode('utf-8')
+    try:
+        name.decode('ascii')
+        return name, 0
+    except UnicodeDecodeError:
+        return name, FLAG_UTF8
+
+
+def write_zip(zip_path, entries, workers=WORKERS, level=6, digests=None):
+    """
+    Write a ZIP file.
+
+    :param str zip_path: absolute path to the ZIP file to create
+    :param entries: iterable of (source path, name in the ZIP file,
+                    modification timestamp or None for the one of the source)
+                    and optionally a hashlib algorithm to hash the source with
+    :param int workers: number of entries compressed in parallel
+    :param int level: zlib compression level of the deflated entries
+    :param dict digests: if given, filled with the hex digests of the hashed
+                         entries, by name in the ZIP file
+    :returns: number of entries written
+    """
+    tmp_dir = os.path.dirname(os.path.abspath(zip_path))
+    workers = max(workers, 1)
+    pool = ThreadPool(workers)
+    written = []
+    try:
+        with open(zip_path, 'wb') as zip_file:
+            pending = deque()
+
+            def write(entry):
+                name, flags = _encode_name(entry.arcname)
+                date, time_ = _dos_date_time(entry.mtime)
+                entry.offset = zip_file.tell()
+                zip_file.write(_local_header(entry, name, flags, date, time_))
+                if entry.data:
+                    entry.data.seek(0)
+                    shutil.copyfileobj(entry.data, zip_file, CHUNK_SIZE)
+                    entry.data.close()
+                    entry.data = None
+                else:
+                    with open(entry.source, 'rb') as f:
+                        shutil.copyfileobj(f, zip_file, CHUNK_SIZE)
+                written.append(entry)
+                if digests is not None and entry.digest:
+                    digests[entry.arcname] = entry.digest
+
+            for item in entries:
+                source, arcname, mtime = item[:3]
+                if mtime is None:
+                    mtime = os.path.getmtime(source)
+                entry = _Entry(source, arcname, mtime, *item[3:4])
+                pending.append(
+                    pool.apply_async(_prepare, (entry, tmp_dir, level)))
+                # Bound the temporary files waiting to be written
+                if len(pending) >= 2 * workers:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+
+            central_directory_offset = zip_file.tell()
+            for entry in written:
+                name, flags = _encode_name(entry.arcname)
+                date, time_ = _dos_date_time(entry.mtime)
+                zip_file.write(_central_header(entry, name, flags, date, time_))
+            central_directory_size = zip_file.tell() - central_directory_offset
+
+            count = len(written)
+            if (count >= ZIP64_COUNT_LIMIT or
+                    central_directory_offset >= ZIP64_LIMIT or
+                    central_directory_size >= ZIP64_LIMIT):
+                zip64_end_offset = zip_file.tell()
+                zip_file.write(struct.pack(
+                    '<LQHHLLQQQQ', 0x06064b50, 44, (3 << 8) | VERSION_ZIP64,
+                    VERSION_ZIP64, 0, 0, count, count, central_directory_size,
+                    central_directory_offset))
+                zip_file.write(struct.pack(
+                    '<LLQL', 0x07064b50, 0, zip64_end_offset, 1))
+            zip_file.write(struct.pack(
+                '<LHHHHLLH', 0x06054b50, 0, 0,
+                min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+                min(central_directory_size, ZIP64_LIMIT),
+                min(central_directory_offset, ZIP64_LIMIT), 0))
+    finally:
+        pool.terminate()
+    return len(written)
@@ -5,21 +5,47 @@ Uploads a DIP to AtoM
 Sends the DIP to the AtoM host using rsync and executes a deposit request to the
 AtoM instance. A passwordless SSH connection is required to the AtoM host for the
 user running this script and it must be already added to the list of known hosts.
+
+Many DIPs can be uploaded at once: they are sent with one rsync per parent
+folder over a single multiplexed SSH connection, and the deposit requests are
+made concurrently. They can also go through a durable queue, see
+dips/upload_queue.py, which records the stage of each DIP and retries only
+the stage that failed.
 """
 
 import argparse
+from collections import defaultdict, OrderedDict
 import logging
 import logging.config  # Has to be imported separately
+from multiprocessing.pool import ThreadPool
 import os
+import shutil
 import subprocess
+import json
 import sys
+import tempfile
+import time
 
 import requests
 
+from dips import upload_queue
+
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 LOGGER = logging.getLogger('atom_upload')
 
+DEPOSIT_WORKERS = 4
+# Keep the shared SSH connection open between the rsync runs of a batch
+SSH_CONTROL_PERSIST = 60
+
+# Outcomes of the DIPs in a batch upload
+DEPOSITED = 'deposited'
+TRANSFER_FAILED = 'transfer_failed'
+DEPOSIT_FAILED = 'deposit_failed'
+
+# Longest sleep between two runs of the queue worker in wait mode
+QUEUE_POLL_INTERVAL = 60
+
 
 def setup_logger(log_file, log_level='INFO'):
     """Configures the logger to output to console and log file"""
@@ -80,19 +106,263 @@ def main(atom_url, atom_email, atom_password, atom_slug, rsync_target, dip_path)
     LOGGER.info('DIP deposited in AtoM')
 
 
-def rsync(rsync_target, dip_path):
+def ssh_command(control_path):
+    """Return the SSH command for rsync sharing one connection through a
+    control socket."""
+    return 'ssh -o ControlMaster=auto -o ControlPath={} -o ControlPersist={}'.format(
+        control_path, SSH_CONTROL_PERSIST)
+
+
+def rsync(rsync_target, dip_path, ssh_control_path=None):
     """
     Build and launch rsync command.
 
     :param str rsync_target: host and path target for rsync
     :param str dip_path: absolute path to the folder to rsync
+    :param str ssh_control_path: SSH control socket to share the connection
     :returns: None
     """
-    command = ['rsync', '--protect-args', '-rltz', '-P', '--chmod=ugo=rwX', dip_path, rsync_target]
+    command = ['rsync', '--protect-args', '-rltz', '-P', '--chmod=ugo=rwX']
+    if ssh_control_path:
+        command += ['-e', ssh_command(ssh_control_path)]
+    command += [dip_path, rsync_target]
     subprocess.check_output(command, stderr=subprocess.STDOUT)
 
 
-def deposit(atom_url, atom_email, atom_password, atom_slug, dip_path):
+def rsync_batch(rsync_target, dip_paths, ssh_control_path=None):
+    """
+    Sends many DIPs with one rsync per parent folder, using a list of the
+    DIP folders in it. When a run fails, its DIPs are sent again one by one
+    to find out which ones failed.
+
+    :param str rsync_target: host and path target for rsync
+    :param list dip_paths: absolute paths to the folders to rsync
+    :param str ssh_control_path: SSH control socket to share the connection
+    :returns: dict with the rsync output of the failed DIPs, by path as
+              given in dip_paths
+    """
+    # Without the trailing slash, rsync sends the folder and not its contents
+    paths_given = {}
+    groups = defaultdict(list)
+    for dip_path in dip_paths:
+        path = dip_path.rstrip('/')
+        if path not in paths_given:
+            groups[os.path.dirname(path)].append(path)
+        paths_given.setdefault(path, []).append(dip_path)
+
+    errors = {}
+    for parent, paths in groups.items():
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as files_from:
+            files_from.write(''.join(
+                '{}\n'.format(os.path.basename(path)) for path in paths))
+            files_from.flush()
+            command = ['rsync', '--protect-args', '-rltz', '--partial',
+                       '--chmod=ugo=rwX', '--files-from', files_from.name]
+            if ssh_control_path:
+                command += ['-e', ssh_command(ssh_control_path)]
+            command += ['{}/'.format(parent), rsync_target]
+            try:
+                subprocess.check_output(command, stderr=subprocess.STDOUT)
+                continue
+            except subprocess.CalledProcessError as e:
+                LOGGER.warning('Rsync of %s DIPs ended unexpectedly, sending '
+                               'them one by one: %s', len(paths), e.output)
+        for path in paths:
+            try:
+                rsync(rsync_target, path, ssh_control_path)
+            except subprocess.CalledProcessError as e:
+                for dip_path in paths_given[path]:
+                    errors[dip_path] = e.output
+    return errors
+
+
+def close_ssh_connection(rsync_target, ssh_control_path):
+    """Close the shared SSH connection to the host of rsync_target, if any."""
+    if ':' not in rsync_target or not os.path.exists(ssh_control_path):
+        return
+    host = rsync_target.split(':', 1)[0]
+    command = ['ssh', '-o', 'ControlPath={}'.format(ssh_control_path), '-O', 'exit', host]
+    try:
+        subprocess.check_output(command, stderr=subprocess.STDOUT)
+    except (subprocess.CalledProcessError, OSError):
+        pass
+
+
+def send_dips(rsync_target, dip_paths):
+    """
+    Sends many DIPs to the AtoM host over a single SSH connection, see
+    rsync_batch.
+
+    :returns: dict with the rsync output of the failed DIPs, by path
+    """
+    LOGGER.info('Sending %s DIPs to: %s', len(dip_paths), rsync_target)
+    control_dir = tempfile.mkdtemp(prefix='atom_upload-')
+    ssh_control_path = os.path.join(control_dir, 'ssh')
+    try:
+        errors = rsync_batch(rsync_target, dip_paths, ssh_control_path)
+    finally:
+        close_ssh_connection(rsync_target, ssh_control_path)
+        shutil.rmtree(control_dir, ignore_errors=True)
+    for dip_path, error in errors.items():
+        LOGGER.error('Rsync of %s ended unexpectedly: %s', dip_path, error)
+    return errors
+
+
+def deposit_dips(atom_url, atom_email, atom_password, dips,
+                 deposit_workers=DEPOSIT_WORKERS):
+    """
+    Makes the deposit requests of many DIPs with up to deposit_workers
+    requests at a time over a shared HTTP session.
+
+    :param list dips: (dip_path, atom_slug) of the DIPs to deposit
+    :returns: iterator of (dip_path, exception or None, response info), in
+              the order the requests finish, see deposit
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=deposit_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def deposit_dip(dip):
+        dip_path, atom_slug = dip
+        response_info = {}
+        try:
+            deposit(atom_url, atom_email, atom_password, atom_slug, dip_path,
+                    session=session, response_info=response_info)
+        except Exception as e:
+            return dip_path, e, response_info
+        return dip_path, None, response_info
+
+    pool = ThreadPool(deposit_workers)
+    try:
+        for dip_path, error, response_info in pool.imap_unordered(deposit_dip, dips):
+            if error:
+                LOGGER.error('Deposit request of %s to AtoM failed: %s', dip_path, error)
+            else:
+                LOGGER.info('DIP deposited in AtoM: %s', dip_path)
+            yield dip_path, error, response_info
+    finally:
+        pool.terminate()
+        session.close()
+
+
+def upload_dips(atom_url, atom_email, atom_password, atom_slug, rsync_target,
+                dip_paths, deposit_workers=DEPOSIT_WORKERS):
+    """
+    Sends many DIPs to the AtoM host, see rsync_batch, and makes the deposit
+    requests of the DIPs sent with up to deposit_workers requests at a time
+    over a shared HTTP session.
+
+    :returns: OrderedDict with the outcome of each DIP, by path without
+              trailing slash: a dict with
+              the status (DEPOSITED, TRANSFER_FAILED or DEPOSIT_FAILED) and
+              the error, if any
+    """
+    results = OrderedDict(
+        (dip_path.rstrip('/'), {'status': None, 'error': None})
+        for dip_path in dip_paths)
+
+    errors = send_dips(rsync_target, list(results))
+    for dip_path, error in errors.items():
+        results[dip_path].update(status=TRANSFER_FAILED, error=str(error))
+
+    sent = [(path, atom_slug) for path, result in results.items()
+            if not result['status']]
+    for dip_path, error, _ in deposit_dips(
+            atom_url, atom_email, atom_password, sent, deposit_workers):
+        if error:
+            results[dip_path].update(status=DEPOSIT_FAILED, error=str(error))
+        else:
+            results[dip_path]['status'] = DEPOSITED
+
+    counts = defaultdict(int)
+    for result in results.values():
+        counts[result['status']] += 1
+    LOGGER.info('%s DIPs deposited, %s failed to transfer, %s failed to deposit',
+                counts[DEPOSITED], counts[TRANSFER_FAILED], counts[DEPOSIT_FAILED])
+    return results
+
+
+def process_queue(queue, atom_url, atom_email, atom_password, rsync_target,
+                  deposit_workers=DEPOSIT_WORKERS,
+                  max_attempts=upload_queue.MAX_ATTEMPTS, wait=False):
+    """
+    Works through the DIPs of an upload queue: sends the queued ones, see
+    send_dips, and deposits the transferred ones, see deposit_dips, only when
+    their next attempt is due. Failures are recorded in the queue to be
+    retried after a backoff, so a failed deposit does not send the DIP again.
+
+    :param UploadQueue queue: upload queue
+    :param int max_attempts: attempts of a stage before the DIP is failed
+    :param bool wait: keep running, sleeping until the next retry is due,
+                      until no DIP is pending, instead of a single pass
+    :returns: queue stats after the last pass, see UploadQueue.stats
+    """
+    while True:
+        transfers = [dip_path for dip_path, _ in queue.due(upload_queue.QUEUED)]
+        if transfers:
+            errors = send_dips(rsync_target, transfers)
+            for dip_path in transfers:
+                if dip_path in errors:
+                    queue.mark_failure(dip_path, str(errors[dip_path]),
+                                       max_attempts)
+                else:
+                    queue.mark_transferred(dip_path)
+
+        deposits = queue.due(upload_queue.TRANSFERRED)
+        for dip_path, error, response_info in deposit_dips(
+                atom_url, atom_email, atom_password, deposits,
+                deposit_workers):
+            if error:
+                queue.mark_failure(dip_path, str(error), max_attempts,
+                                   response_info.get('status_code'))
+            else:
+                queue.mark_deposited(dip_path, response_info.get('status_code'),
+                                     response_info.get('location'))
+
+        stats = queue.stats()
+        LOGGER.info('Upload queue: %s queued, %s transferred, %s deposited, '
+                    '%s failed, depth %s, lag %.0fs', stats['queued'],
+                    stats['transferred'], stats['deposited'], stats['failed'],
+                    stats['depth'], stats['lag'])
+        if not wait or not stats['depth']:
+            return stats
+        if not transfers and not deposits:
+            next_attempt = queue.next_attempt() or 0
+            time.sleep(min(max(next_attempt - time.time(), 1),
+                           QUEUE_POLL_INTERVAL))
+
+
+def queue_main(atom_url, atom_email, atom_password, rsync_target, queue_file,
+               atom_slug=None, dip_paths=None, deposit_workers=DEPOSIT_WORKERS,
+               max_attempts=upload_queue.MAX_ATTEMPTS, retry_failed=False,
+               wait=False):
+    """Adds the DIPs to the upload queue and works through it, see
+    process_queue"""
+    queue = upload_queue.UploadQueue(queue_file)
+    if dip_paths:
+        LOGGER.info('%s DIPs added to the upload queue',
+                    queue.enqueue(dip_paths, atom_slug))
+    if retry_failed:
+        LOGGER.info('%s failed DIPs retried', queue.retry_failed())
+    stats = process_queue(queue, atom_url, atom_email, atom_password,
+                          rsync_target, deposit_workers, max_attempts, wait)
+    if stats['failed']:
+        return 3
+
+
+def batch_main(atom_url, atom_email, atom_password, atom_slug, rsync_target,
+               dip_paths, deposit_workers=DEPOSIT_WORKERS):
+    """Sends many DIPs to the AtoM host and deposit requests to the AtoM
+    instance, see upload_dips"""
+    results = upload_dips(atom_url, atom_email, atom_password, atom_slug,
+                          rsync_target, dip_paths, deposit_workers)
+    if any(result['status'] != DEPOSITED for result in results.values()):
+        return 3
+
+
+def deposit(atom_url, atom_email, atom_password, atom_slug, dip_path,
+            session=None, response_info=None):
     """
     Generate and make deposit request to AtoM.
 
@@ -101,6 +371,10 @@ def deposit(atom_url, atom_email, atom_password, atom_slug, dip_path):
     :param str atom_password: AtoM user password
     :param str atom_slug: target AtoM arch. description slug
     :param str dip_path: absolute path to a DIP folder
+    :param session: requests.Session to make the request with, to reuse its
+                    connections
+    :param dict response_info: if given, filled with the status_code and the
+                               location of the response
     :raises Exception: if the AtoM response is not expected
     :returns: None
     """
@@ -111,7 +385,7 @@ def deposit(atom_url, atom_email, atom_password, atom_slug, dip_path):
     headers['Content-Type'] = 'application/zip'
     headers['X-No-Op'] = 'false'
     headers['X-Verbose'] = 'false'
-    headers['Content-Location'] = 'file:///{}'.format(os.path.basename(dip_path))
+    headers['Content-Location'] = 'file:///{}'.format(os.path.basename(dip_path.rstrip('/')))
 
     # Build URL and auth
     url = '{}/sword/deposit/{}'.format(atom_url, atom_slug)
@@ -119,12 +393,16 @@ def deposit(atom_url, atom_email, atom_password, atom_slug, dip_path):
 
     # Make request (disable redirects)
     LOGGER.info('Making deposit request to: %s', url)
-    response = requests.request('POST', url, auth=auth, headers=headers, allow_redirects=False)
+    response = (session or requests).request(
+        'POST', url, auth=auth, headers=headers, allow_redirects=False)
 
     # AtoM returns 302 instead of 202, but Location header field is valid
     LOGGER.debug('Response code: %s', response.status_code)
     LOGGER.debug('Response location: %s', response.headers.get('Location'))
     LOGGER.debug('Response content:\n%s', response.content)
+    if response_info is not None:
+        response_info['status_code'] = response.status_code
+        response_info['location'] = response.headers.get('Location')
 
     # Check response status code
     if response.status_code not in [200, 201, 202, 302]:
@@ -138,11 +416,21 @@ def deposit(atom_url, atom_email, atom_password, atom_slug, dip_path):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('--atom-url', metavar='URL', help='AtoM instance URL. Default: http://192.168.168.193', default='http://192.168.168.193')
-    parser.add_argument('--atom-email', metavar='EMAIL', required=True, help='Email of the AtoM user to authenticate as.')
-    parser.add_argument('--atom-password', metavar='PASSWORD', required=True, help='Password of the AtoM user.')
-    parser.add_argument('--atom-slug', metavar='SLUG', required=True, help='AtoM archival description slug to target the upload.')
+    parser.add_argument('--atom-email', metavar='EMAIL', help='Email of the AtoM user to authenticate as.')
+    parser.add_argument('--atom-password', metavar='PASSWORD', help='Password of the AtoM user.')
+    parser.add_argument('--atom-slug', metavar='SLUG', help='AtoM archival description slug to target the upload.')
     parser.add_argument('--rsync-target', metavar='HOST:PATH', help='Destination value passed to Rsync. Default: 192.168.168.193:/tmp.', default='192.168.168.193:/tmp')
-    parser.add_argument('--dip-path', metavar='PATH', required=True, help='Absolute path to the DIP to upload.')
+    dips = parser.add_mutually_exclusive_group()
+    dips.add_argument('--dip-path', metavar='PATH', action='append', dest='dip_paths', help='Absolute path to the DIP to upload. Can be used multiple times.')
+    dips.add_argument('--dip-paths-file', metavar='PATH', help='File with the absolute paths to the DIPs to upload, one per line.')
+    parser.add_argument('--deposit-workers', metavar='N', type=int, default=DEPOSIT_WORKERS, help='Maximum number of deposit requests made at a time. Default: {}'.format(DEPOSIT_WORKERS))
+
+    # Upload queue
+    parser.add_argument('--queue', metavar='PATH', help='SQLite file of the upload queue. The DIPs given are added to the queue and the queue is worked through.')
+    parser.add_argument('--queue-stats', action='store_true', help='Print the number of DIPs in each stage of the queue, its depth and lag, as JSON, and exit.')
+    parser.add_argument('--retry-failed', action='store_true', help='Retry the failed stage of the DIPs failed in the queue.')
+    parser.add_argument('--max-attempts', metavar='N', type=int, default=upload_queue.MAX_ATTEMPTS, help='Attempts of a stage before a DIP of the queue is failed. Default: {}'.format(upload_queue.MAX_ATTEMPTS))
+    parser.add_argument('--wait', action='store_true', help='Keep working through the queue, waiting for the retries, until no DIP is pending.')
 
     # Logging
     parser.add_argument('--log-file', metavar='FILE', help='Location of log file', default=None)
@@ -152,6 +440,18 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    if args.queue_stats:
+        if not args.queue:
+            parser.error('--queue-stats requires --queue')
+        print(json.dumps(upload_queue.UploadQueue(args.queue).stats(), indent=4))
+        sys.exit(0)
+    if not args.atom_email or not args.atom_password:
+        parser.error('--atom-email and --atom-password are required')
+    if not args.queue and not (args.dip_paths or args.dip_paths_file):
+        parser.error('one of --dip-path, --dip-paths-file or --queue is required')
+    if (args.dip_paths or args.dip_paths_file) and not args.atom_slug:
+        parser.error('--atom-slug is required to upload DIPs')
+
     log_levels = {
         2: 'ERROR',
         1: 'WARNING',
@@ -168,11 +468,43 @@ if __name__ == '__main__':
 
     setup_logger(args.log_file, log_level)
 
-    sys.exit(main(
+    dip_paths = args.dip_paths
+    if args.dip_paths_file:
+        with open(args.dip_paths_file) as f:
+            dip_paths = [line.strip() for line in f if line.strip()]
+    dip_paths = [dip_path.rstrip('/') for dip_path in dip_paths or []]
+
+    if args.queue:
+        sys.exit(queue_main(
+            atom_url=args.atom_url,
+            atom_email=args.atom_email,
+            atom_password=args.atom_password,
+            rsync_target=args.rsync_target,
+            queue_file=args.queue,
+            atom_slug=args.atom_slug,
+            dip_paths=dip_paths,
+            deposit_workers=args.deposit_workers,
+            max_attempts=args.max_attempts,
+            retry_failed=args.retry_failed,
+            wait=args.wait,
+        ))
+
+    if len(dip_paths) == 1:
+        sys.exit(main(
+            atom_url=args.atom_url,
+            atom_email=args.atom_email,
+            atom_password=args.atom_password,
+            atom_slug=args.atom_slug,
+            rsync_target=args.rsync_target,
+            dip_path=dip_paths[0]
+        ))
+
+    sys.exit(batch_main(
         atom_url=args.atom_url,
         atom_email=args.atom_email,
         atom_password=args.atom_password,
         atom_slug=args.atom_slug,
         rsync_target=args.rsync_target,
-        dip_path=args.dip_path
+        dip_paths=dip_paths,
+        deposit_workers=args.deposit_workers,
     ))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Durable queue of DIP uploads to AtoM.
+
+Each DIP goes through two stages, the rsync transfer to the AtoM host and
+the SWORD deposit request, and the queue records in a SQLite file which ones
+are done, with their timestamps and the deposit response. A failed stage is
+retried on its own after an exponential backoff, so a failed deposit does
+not send the DIP again, until the maximum number of attempts is reached and
+the DIP is marked as failed.
+"""
+
+from __future__ import print_function, unicode_literals
+
+from collections import OrderedDict
+import logging
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy import Column, Float, Integer, String, Text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+LOGGER = logging.getLogger('atom_upload')
+
+Base = declarative_base()
+
+QUEUED = 'queued'
+TRANSFERRED = 'transferred'
+DEPOSITED = 'deposited'
+FAILED = 'failed'
+STAGES = [QUEUED, TRANSFERRED, DEPOSITED, FAILED]
+# Stages waiting for work
+PENDING = [QUEUED, TRANSFERRED]
+
+MAX_ATTEMPTS = 5
+BACKOFF = 60
+MAX_BACKOFF = 3600
+
+
+class Upload(Base):
+    __tablename__ = 'upload'
+    dip_path = Column(String(4096), primary_key=True)
+    atom_slug = Column(String(255))
+    stage = Column(String(20), index=True)
+    # Stage the DIP was in when it was marked as failed
+    failed_stage = Column(String(20), nullable=True)
+    attempts = Column(Integer, default=0)
+    next_attempt = Column(Float, default=0)
+    error = Column(Text, nullable=True)
+    response_status = Column(Integer, nullable=True)
+    response_location = Column(String(1024), nullable=True)
+    queued = Column(Float)
+    transferred = Column(Float, nullable=True)
+    deposited = Column(Float, nullable=True)
+    updated = Column(Float)
+
+    def __repr__(self):
+        return "<Upload(dip_path={s.dip_path}, atom_slug={s.atom_slug}, stage={s.stage}, attempts={s.attempts})>".format(s=self)
+
+
+def backoff(attempts, base=BACKOFF, maximum=MAX_BACKOFF):
+    """Return the seconds to wait before the next attempt of a stage."""
+    return min(base * 2 ** (attempts - 1), maximum)
+
+
+class UploadQueue(object):
+    """SQLite queue of DIP uploads."""
+
+    def __init__(self, path):
+        engine = create_engine('sqlite:///{}'.format(path), echo=False)
+        Base.metadata.create_all(engine)
+        self.Session = sessionmaker(bind=engine)
+
+    def _update(self, dip_path, **values):
+        session = self.Session()
+        try:
+            upload = session.query(Upload).get(dip_path)
+            for key, value in values.items():
+                setattr(upload, key, value)
+            upload.updated = time.time()
+            session.commit()
+        finally:
+            session.close()
+
+    def enqueue(self, dip_paths, atom_slug):
+        """
+        Add DIPs to the queue. DIPs already deposited or failed are queued
+        again from the start, DIPs pending keep their progress. Paths are
+        stored without trailing slash, so a DIP is queued once however its
+        path is given.
+
+        :returns: number of DIPs queued from the start
+        """
+        now = time.time()
+        queued = 0
+        session = self.Session()
+        try:
+            for dip_path in OrderedDict.fromkeys(
+                    path.rstrip('/') for path in dip_paths):
+                upload = session.query(Upload).get(dip_path)
+                if upload is None:
+                    upload = Upload(dip_path=dip_path)
+                    session.add(upload)
+                elif upload.stage in PENDING:
+                    upload.atom_slug = atom_slug
+                    continue
+                upload.atom_slug = atom_slug
+                upload.stage = QUEUED
+                upload.failed_stage = None
+                upload.attempts = 0
+                upload.next_attempt = 0
+                upload.error = None
+                upload.response_status = None
+                upload.response_location = None
+                upload.queued = now
+                upload.transferred = None
+                upload.deposited = None
+                upload.updated = now
+                queued += 1
+            session.commit()
+        finally:
+            session.close()
+        return queued
+
+    def due(self, stage, now=None):
+        """Return the (dip_path, atom_slug) of the DIPs in a stage whose next
+        attempt is due, oldest first."""
+        now = time.time() if now is None else now
+        session = self.Session()
+        try:
+            return session.query(Upload.dip_path, Upload.atom_slug).filter(
+                Upload.stage == stage, Upload.next_attempt <= now).order_by(
+                Upload.queued).all()
+        finally:
+            session.close()
+
+    def mark_transferred(self, dip_path):
+        now = time.time()
+        self._update(dip_path, stage=TRANSFERRED, transferred=now, attempts=0,
+                     next_attempt=0, error=None)
+
+    def mark_deposited(self, dip_path, response_status=None,
+                       response_location=None):
+        now = time.time()
+        self._update(dip_path, stage=DEPOSITED, deposited=now, attempts=0,
+                     next_attempt=0, error=None,
+                     response_status=response_status,
+                     response_location=response_location)
+
+    def mark_failure(self, dip_path, error, max_attempts=MAX_ATTEMPTS,
+                     response_status=None):
+        """
+        Record a failed attempt of the current stage of a DIP, to be retried
+        after a backoff, or mark the DIP as failed after max_attempts.
+
+        :returns: True if the stage will be retried
+        """
+        session = self.Session()
+        try:
+            upload = session.query(Upload).get(dip_path)
+            upload.attempts = (upload.attempts or 0) + 1
+            upload.error = error
+            upload.response_status = response_status
+            upload.updated = time.time()
+            retry = upload.attempts < max_attempts
+            if retry:
+                upload.next_attempt = upload.updated + backoff(upload.attempts)
+            else:
+                upload.failed_stage = upload.stage
+                upload.stage = FAILED
+            session.commit()
+            return retry
+        finally:
+            session.close()
+
+    def retry_failed(self):
+        """Put the failed DIPs back in the stage that failed.
+
+        :returns: number of DIPs retried
+        """
+        session = self.Session()
+        try:
+            retried = session.query(Upload).filter(Upload.stage == FAILED).update(
+                {Upload.stage: Upload.failed_stage, Upload.failed_stage: None,
+                 Upload.attempts: 0, Upload.next_attempt: 0,
+                 Upload.updated: time.time()},
+                synchronize_session=False)
+            session.commit()
+            return retried
+        finally:
+            session.close()
+
+    def next_attempt(self):
+        """Return the time of the next attempt due of the pending DIPs, or
+        None if there is none."""
+        session = self.Session()
+        try:
+            return session.query(func.min(Upload.next_attempt)).filter(
+                Upload.stage.in_(PENDING)).scalar()
+        finally:
+            session.close()
+
+    def stats(self, now=None):
+        """
+        Return the number of DIPs in each stage, the queue depth (DIPs not
+        deposited yet and not failed) and the lag: seconds since the oldest
+        pending DIP was queued, 0 if there is none.
+        """
+        now = time.time() if now is None else now
+        session = self.Session()
+        try:
+            stats = {stage: 0 for stage in STAGES}
+            stats.update(session.query(Upload.stage, func.count()).group_by(
+                Upload.stage))
+            oldest = session.query(func.min(Upload.queued)).filter(
+                Upload.stage.in_(PENDING)).scalar()
+        finally:
+            session.close()
+        stats['depth'] = sum(stats[stage] for stage in PENDING)
+        stats['lag'] = now - oldest if oldest is not None else 0
+        return stats
@@ -2,10 +2,13 @@
 # create_dip script example
 # /etc/archivematica/automation-tools/create_dip_script.sh
 cd /usr/lib/archivematica/automation-tools/
+# Use --aip-uuid <uuid> for a single AIP, or --aip-uuids-file <path> for a list
 /usr/share/python/automation-tools/bin/python -m aips.create_dip \
   --ss-user <username> \
   --ss-api-key <api_key> \
-  --aip-uuid <uuid> \
+  --all-aips \
+  --workers 4 \
+  --tmp-budget 500G \
   --tmp-dir <path> \
   --output-dir <path> \
   --log-file <path>
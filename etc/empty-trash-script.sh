@@ -0,0 +1,5 @@
+#!/bin/bash
+# empty trash script example, for remove_folder with trash = True
+# /etc/archivematica/automation-tools/empty-trash-script.sh
+cd /usr/lib/archivematica/automation-tools/
+/usr/share/python/automation-tools/bin/python -m transfers.remove_folder --empty-trash --user <user> --api-key <apikey> --ss-user <user> --ss-api-key <apikey> --transfer-source <transfer_source_uuid> --config-file <config_file> --trash-max-mb-per-second 100
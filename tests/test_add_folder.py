@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from transfers import add_folder
+from transfers import models
+
+engine = create_engine('sqlite:///:memory:')
+models.Base.metadata.create_all(engine)
+Session = sessionmaker(bind=engine)
+session = Session()
+
+COLLECTIONS = ['ARCH12345.dig1', 'ARCH12345.dig2', 'COLL00001.dig1', 'ARCH12345.dig1']
+
+
+class TestAddFolder(unittest.TestCase):
+    def setUp(self):
+        session.query(models.Folder).delete()
+        session.commit()
+        self.source_location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.source_location)
+
+    def test_sync_folders(self):
+        summary = add_folder.sync_folders(session, self.source_location, COLLECTIONS, workers=2)
+        assert summary == {'created': 3, 'existing': 0, 'failed': 0}
+        assert os.path.isdir(os.path.join(self.source_location, 'ARCH12345', 'dig2'))
+        assert session.query(models.Folder).count() == 3
+
+        # Recorded accessions are not checked again, even if their folder is gone
+        shutil.rmtree(os.path.join(self.source_location, 'COLL00001'))
+        summary = add_folder.sync_folders(session, self.source_location, COLLECTIONS + ['COLL00002.dig1'])
+        assert summary == {'created': 1, 'existing': 0, 'failed': 0}
+        assert not os.path.exists(os.path.join(self.source_location, 'COLL00001'))
+
+        # Unless a full run is requested
+        summary = add_folder.sync_folders(session, self.source_location, COLLECTIONS, full=True)
+        assert summary == {'created': 1, 'existing': 2, 'failed': 0}
+
+    def test_diff_report(self):
+        session.add(models.Folder(accession_number='COLL99999.dig1'))
+        session.commit()
+        os.makedirs(os.path.join(self.source_location, 'ARCH12345', 'dig2'))
+        report = add_folder.diff_report(session, self.source_location, COLLECTIONS)
+        assert report == {
+            'create': ['ARCH12345.dig1', 'COLL00001.dig1'],
+            'exists': ['ARCH12345.dig2'],
+            'removed': ['COLL99999.dig1'],
+        }
+        assert not os.path.exists(os.path.join(self.source_location, 'COLL00001'))
+        assert session.query(models.Folder).count() == 1
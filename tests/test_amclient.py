@@ -4,12 +4,22 @@
     $ python -m unittest tests.test_amclient
 
 """
+import base64
+import hashlib
+import json
 import os
 import shutil
 import unittest
 
+import requests
+import six
 import vcr
 
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
 from transfers import amclient
 
 
@@ -80,6 +90,60 @@ class TestAMClient(unittest.TestCase):
         for item in close_succeeded:
             assert amclient.is_uuid(item)
 
+    def test_close_completed_units_concurrent(self):
+        """Test that completed units are closed concurrently, up to the
+        limit, with a timeout per request, and that requests which fail are
+        reported as failed to close and those which time out as unknown.
+        """
+        uuids = ['uuid-{}'.format(i) for i in range(5)]
+
+        def hide_unit(unit_uuid, unit_type, timeout=None):
+            if unit_uuid == 'uuid-1':
+                raise requests.exceptions.ReadTimeout('Read timed out')
+            if unit_uuid == 'uuid-2':
+                return 1  # Error code
+            return {'removed': True}
+
+        client = amclient.AMClient(
+            am_api_key=AM_API_KEY,
+            am_user_name=AM_USER_NAME,
+            am_url=AM_URL,
+            close_workers=3,
+            close_timeout=0.2,
+            close_limit=4)
+        with mock.patch.object(client, 'completed_transfers',
+                               return_value={'results': uuids}), \
+                mock.patch.object(client, 'hide_unit',
+                                  side_effect=hide_unit) as hide:
+            response = client.close_completed_transfers()
+        assert response['completed_transfers'] == uuids[:4]
+        assert response['close_succeeded'] == ['uuid-0', 'uuid-3']
+        assert response['close_failed'] == ['uuid-2']
+        assert response['close_unknown'] == ['uuid-1']
+        assert hide.call_count == 4
+        assert all(c[1] == {'timeout': 0.2} for c in hide.call_args_list)
+
+    def test_hide_unit_timeout(self):
+        """Test that the timeout is passed on to the request."""
+        client = amclient.AMClient(
+            am_api_key=AM_API_KEY,
+            am_user_name=AM_USER_NAME,
+            am_url=AM_URL)
+        response = mock.Mock(ok=True)
+        response.json.return_value = {'removed': True}
+        with mock.patch.object(amclient.requests, 'delete',
+                               return_value=response) as delete:
+            assert client.hide_unit('uuid-0', 'transfer', timeout=5) == {
+                'removed': True}
+        assert delete.call_args[0][0] == (
+            '{}/api/transfer/uuid-0/delete/'.format(AM_URL))
+        assert delete.call_args[1]['timeout'] == 5
+        response.ok = False
+        response.status_code = 500
+        with mock.patch.object(amclient.requests, 'delete',
+                               return_value=response):
+            assert client.hide_unit('uuid-0', 'transfer', timeout=5) == 500
+
     @vcr.use_cassette(
         'fixtures/vcr_cassettes/completed_transfers_no_transfers.yaml')
     def test_completed_transfers_no_transfers(self):
@@ -172,6 +236,27 @@ class TestAMClient(unittest.TestCase):
         assert 'properties' in transferables
         assert transferables['directories'] == ['ubuntu', 'vagrant']
 
+    def test_b64decode_ts_location_browse(self):
+        """Test that the browse results are filtered and paged while they are
+        decoded, and that the encoding guessed for a name that is not UTF-8
+        is reused for its siblings.
+        """
+        def b64(name, encoding='utf8'):
+            return base64.b64encode(name.encode(encoding)).decode('ascii')
+
+        names = [u'caf\xe9-{}.tif'.format(i) for i in range(5)]
+        raw = [b64(name, 'latin-1') for name in names] + [b64('notes.txt')]
+        result = {'entries': raw, 'directories': [raw[2]],
+                  'properties': {r: {'size': 1} for r in raw}}
+        guess = mock.Mock(return_value='latin-1')
+        with mock.patch.object(amclient._NameDecoder, 'guess', guess):
+            decoded = amclient.b64decode_ts_location_browse(
+                result, limit=2, offset=1, pattern='*.tif')
+        assert decoded['entries'] == names[1:3]
+        assert decoded['directories'] == [names[2]]
+        assert sorted(decoded['properties']) == names[1:3]
+        assert guess.call_count == 1
+
     @vcr.use_cassette('fixtures/vcr_cassettes/transferables_path.yaml')
     def test_transferables_path(self):
         """Test that we can get all transferable entities in the Storage
@@ -230,6 +315,27 @@ class TestAMClient(unittest.TestCase):
             assert aip['package_type'] == 'AIP'
             assert 'AIPsStore' in aip['current_full_path']
 
+    def test_iter_package_pages(self):
+        """Test that pages are followed without recursion and that the page
+        size is sent with the first request.
+        """
+        pages = [{'meta': {'next': '/api/v2/file/?offset={}'.format(i + 1)},
+                  'objects': [{'uuid': str(i)}]} for i in range(1500)]
+        pages[-1]['meta']['next'] = None
+        client = amclient.AMClient(
+            ss_url=SS_URL,
+            ss_user_name=SS_USER_NAME,
+            ss_api_key=SS_API_KEY,
+            package_page_size=1)
+        with mock.patch.object(client, 'get_package',
+                               return_value=pages[0]) as get_package, \
+                mock.patch.object(client, 'get_next_package_page',
+                                  side_effect=pages[1:]):
+            packages = client.get_all_packages({'package_type': 'AIP'})
+        get_package.assert_called_once_with(
+            {'limit': 1, 'package_type': 'AIP'})
+        assert [p['uuid'] for p in packages] == [str(i) for i in range(1500)]
+
     @vcr.use_cassette('fixtures/vcr_cassettes/dips_dips.yaml')
     def test_dips_dips(self):
         """Test that we can get all DIPs in the Storage Service."""
@@ -275,6 +381,97 @@ class TestAMClient(unittest.TestCase):
         assert (aips2dips['99bb20ee-69c6-43d0-acf0-c566020357d2'] ==
                 ['7e49afa4-116b-4650-8bbb-9341906bdb21'])
 
+    def test_dip_index_cache(self):
+        """Test that the AIP to DIPs index is built from the DIP paths and
+        reused from its cache file instead of listing the DIPs again.
+        """
+        aip_uuid = '721b98b9-b894-4cfb-80ab-624e52263300'
+        dips = [
+            {'uuid': 'c0e37bab-e51e-482d-a066-a277330de9a7',
+             'current_path': 'c0e3/7bab/make_dips_2-{}'.format(aip_uuid)},
+            {'uuid': '7e49afa4-116b-4650-8bbb-9341906bdb21',
+             'current_path': '7e49/afa4/no_aip_uuid'},
+        ]
+        with TmpDir(TMP_DIR):
+            client = amclient.AMClient(
+                aip_uuid=aip_uuid,
+                ss_url=SS_URL,
+                ss_user_name=SS_USER_NAME,
+                ss_api_key=SS_API_KEY,
+                dip_index_cache=os.path.join(TMP_DIR, 'dip_index.json'))
+            with mock.patch.object(client, 'iter_packages',
+                                   return_value=iter(dips)) as iter_packages:
+                assert client.aip2dips() == [dips[0]]
+                assert client.aip2dips() == [dips[0]]
+            iter_packages.assert_called_once_with({'package_type': 'DIP'})
+
+    def test_package_mirror(self):
+        """Test that package queries are answered from the local mirror,
+        which is only synced again once it is stale, and that changed and
+        deleted packages are picked up by the sync.
+        """
+        aip = {'uuid': '721b98b9-b894-4cfb-80ab-624e52263300',
+               'package_type': 'AIP', 'status': 'UPLOADED',
+               'origin_pipeline': '/api/v2/pipeline/'
+                                  '88050c7f-36a3-4900-9294-5a0411d69303/'}
+        dip = {'uuid': 'c0e37bab-e51e-482d-a066-a277330de9a7',
+               'package_type': 'DIP', 'status': 'UPLOADED',
+               'origin_pipeline': None}
+        with TmpDir(TMP_DIR):
+            client = amclient.AMClient(
+                ss_url=SS_URL,
+                ss_user_name=SS_USER_NAME,
+                ss_api_key=SS_API_KEY,
+                package_mirror=os.path.join(TMP_DIR, 'packages.db'))
+            with mock.patch.object(client, 'iter_packages',
+                                   return_value=iter([aip, dip])) as ss:
+                assert client.aips() == [aip]
+                assert client.dips() == [dip]
+                assert client.get_all_packages(
+                    {'origin_pipeline': aip['origin_pipeline']}) == [aip]
+            ss.assert_called_once_with()
+            # Queries the mirror cannot answer go to the SS
+            with mock.patch.object(client, 'iter_packages',
+                                   return_value=iter([aip])) as ss:
+                client.get_all_packages({'current_path__endswith': '.7z'})
+            ss.assert_called_once_with({'current_path__endswith': '.7z'})
+            deleted = dict(aip, status='DELETED')
+            with mock.patch.object(client, 'iter_packages',
+                                   return_value=iter([deleted])):
+                mirror = client.sync_package_mirror(force=True)
+                assert client.aips() == [deleted]
+                assert client.dips() == []
+            assert mirror.is_fresh(client.package_mirror_max_age)
+
+    def test_jsonl_output(self):
+        """Test that in JSON lines mode the package listings are printed
+        one record per line as they are yielded, without building the list.
+        """
+        aip_uuid = '721b98b9-b894-4cfb-80ab-624e52263300'
+        aips = [{'uuid': aip_uuid, 'package_type': 'AIP'},
+                {'uuid': 'a1b2', 'package_type': 'AIP'}]
+        dips = [{'uuid': 'c0e37bab-e51e-482d-a066-a277330de9a7',
+                 'current_path': 'c0e3/7bab/make_dips_2-{}'.format(aip_uuid)}]
+        client = amclient.AMClient(
+            ss_url=SS_URL,
+            ss_user_name=SS_USER_NAME,
+            ss_api_key=SS_API_KEY,
+            output_mode='jsonl')
+        stdout = six.StringIO()
+
+        def iter_packages(params):
+            return iter(aips if params['package_type'] == 'AIP' else dips)
+
+        with mock.patch.object(client, 'iter_packages',
+                               side_effect=iter_packages), \
+                mock.patch.object(client, 'get_all_packages') as get_all, \
+                mock.patch.object(amclient.sys, 'stdout', stdout):
+            getattr(client, 'print_aips')
+            getattr(client, 'print_aips2dips')
+        get_all.assert_not_called()
+        lines = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        assert lines == aips + [{aip_uuid: [dips[0]['uuid']]}, {'a1b2': []}]
+
     @vcr.use_cassette('fixtures/vcr_cassettes/aip2dips_dip.yaml')
     def test_aip2dips_dips(self):
         """Test that we can get all of the DIPs from the Storage Service for a
@@ -356,6 +553,124 @@ class TestAMClient(unittest.TestCase):
                         TMP_DIR, transfer_name, aip_uuid))
             assert os.path.isfile(aip_path)
 
+    def test_download_package_resume(self):
+        """Test that an interrupted download resumes with a Range request,
+        that the checksum covers the whole package and that the package is
+        only renamed to its final name once complete.
+        """
+        uuid = '216dd8a6-c366-41f8-b11e-0c70814b3992'
+        content = b'0123456789' * 10
+        with TmpDir(TMP_DIR):
+            client = amclient.AMClient(
+                ss_url=SS_URL,
+                ss_user_name=SS_USER_NAME,
+                ss_api_key=SS_API_KEY,
+                directory=TMP_DIR,
+                download_chunk_size=16)
+            part = os.path.join(TMP_DIR, '.{}.part'.format(uuid))
+            with open(part, 'wb') as file_:
+                file_.write(content[:30])
+            response = mock.Mock(status_code=206, headers={
+                'content-disposition': 'attachment; filename="aip.7z"',
+                'content-length': '70',
+                'content-range': 'bytes 30-99/100'})
+            response.iter_content.return_value = [
+                content[30:46], content[46:62], content[62:78],
+                content[78:94], content[94:]]
+            progress = mock.Mock()
+            with mock.patch.object(amclient.requests, 'get',
+                                   return_value=response) as get:
+                path = client.download_package(
+                    uuid, checksum=hashlib.sha256(content).hexdigest(),
+                    progress=progress)
+            assert get.call_args[1]['headers'] == {'Range': 'bytes=30-'}
+            assert path == os.path.join(TMP_DIR, 'aip.7z')
+            assert not os.path.exists(part)
+            with open(path, 'rb') as file_:
+                assert file_.read() == content
+            assert progress.call_count == 5
+            assert progress.call_args[0][:3] == (uuid, 100, 100)
+
+            # A checksum mismatch discards the download
+            response.status_code = 200
+            response.headers = {'content-length': '100'}
+            response.iter_content.return_value = [content]
+            with mock.patch.object(amclient.requests, 'get',
+                                   return_value=response):
+                assert client.download_package(uuid, checksum='0' * 64) is None
+            assert not os.path.exists(part)
+
+    def test_download_packages(self):
+        """Test that a batch download skips the packages downloaded by a
+        previous batch, stays within its size budget and records the result
+        of each package in its manifest.
+        """
+        packages = [{'uuid': 'uuid-{}'.format(i), 'package_type': 'DIP',
+                     'status': 'UPLOADED', 'size': 10} for i in range(4)]
+
+        def download_package(uuid):
+            # Streamed as tar, so not the size reported by the SS
+            path = os.path.join(TMP_DIR, uuid)
+            with open(path, 'wb') as file_:
+                file_.write(b'x' * 12)
+            return path
+
+        with TmpDir(TMP_DIR):
+            client = amclient.AMClient(
+                ss_url=SS_URL,
+                ss_user_name=SS_USER_NAME,
+                ss_api_key=SS_API_KEY,
+                directory=TMP_DIR,
+                batch_package_type='DIP',
+                batch_workers=2,
+                batch_max_bytes=30)
+            with mock.patch.object(client, 'iter_packages',
+                                   side_effect=lambda *a: iter(packages)), \
+                    mock.patch.object(client, 'download_package',
+                                      side_effect=download_package) as dl:
+                assert client.download_packages() == {'downloaded': 3,
+                                                      'over_budget': 1}
+                assert client.download_packages() == {'skipped': 3,
+                                                      'downloaded': 1}
+            assert dl.call_count == 4
+            with open(os.path.join(TMP_DIR,
+                                   'download-manifest.jsonl')) as file_:
+                results = [json.loads(line) for line in file_]
+            assert len(results) == 8
+            assert {r['uuid'] for r in results
+                    if r['status'] == 'downloaded'} == {
+                        p['uuid'] for p in packages}
+
+    def test_download_packages_failed(self):
+        """Test that failed downloads give back their share of the size
+        budget to the packages over it.
+        """
+        packages = [{'uuid': 'uuid-{}'.format(i), 'package_type': 'DIP',
+                     'status': 'UPLOADED', 'size': 10} for i in range(3)]
+
+        def download_package(uuid):
+            if uuid == 'uuid-0':
+                return None
+            path = os.path.join(TMP_DIR, uuid)
+            with open(path, 'wb') as file_:
+                file_.write(b'x' * 10)
+            return path
+
+        with TmpDir(TMP_DIR):
+            client = amclient.AMClient(
+                ss_url=SS_URL,
+                ss_user_name=SS_USER_NAME,
+                ss_api_key=SS_API_KEY,
+                directory=TMP_DIR,
+                batch_package_type='DIP',
+                batch_max_bytes=20)
+            with mock.patch.object(client, 'iter_packages',
+                                   side_effect=lambda *a: iter(packages)), \
+                    mock.patch.object(client, 'download_package',
+                                      side_effect=download_package):
+                assert client.download_packages() == {'downloaded': 2,
+                                                      'failed': 1}
+
     @vcr.use_cassette('fixtures/vcr_cassettes/download_aip_fail.yaml')
     def test_download_aip_fail(self):
         """Test that we can try to download an AIP that does not exist."""
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the asyncio Archivematica Client."""
+
+import sys
+import threading
+import time
+import unittest
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+if sys.version_info < (3, 6):
+    raise unittest.SkipTest('amclient_async requires Python 3.6+')
+
+from transfers import amclient_async  # noqa: E402
+
+AM_URL = 'http://192.168.168.192'
+SS_URL = 'http://192.168.168.192:8000'
+
+
+def json_response(data):
+    return mock.Mock(ok=True, json=mock.Mock(return_value=data))
+
+
+class TestAsyncAMClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = amclient_async.AsyncAMClient(
+            workers=4, am_url=AM_URL, am_user_name='test', am_api_key='key',
+            ss_url=SS_URL, ss_user_name='test', ss_api_key='key')
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_statuses_concurrent(self):
+        """Test that status requests run concurrently over the shared
+        session and that results keep the order of the UUIDs.
+        """
+        active = []
+        peak = [0]
+        lock = threading.Lock()
+
+        def request(method, url, **kwargs):
+            with lock:
+                active.append(url)
+                peak[0] = max(peak[0], len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(url)
+            return json_response({'uuid': url.rstrip('/').rsplit('/', 1)[1]})
+
+        uuids = ['uuid-{}'.format(i) for i in range(8)]
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=request):
+            statuses = amclient_async.run(
+                self.client.get_transfer_statuses(uuids))
+        assert [s['uuid'] for s in statuses] == uuids
+        assert peak[0] == 4
+
+    def test_get_all_packages(self):
+        """Test that listings follow the pagination trail."""
+        pages = {
+            None: {'meta': {'next': '/api/v2/file/?offset=1'},
+                   'objects': [{'uuid': 'a'}]},
+            '/api/v2/file/?offset=1': {'meta': {'next': None},
+                                       'objects': [{'uuid': 'b'}]},
+        }
+
+        def request(method, url, params=None, **kwargs):
+            if params:
+                assert params['package_type'] == 'AIP'
+                return json_response(pages[None])
+            return json_response(pages[url[len(SS_URL):]])
+
+        with mock.patch.object(self.client.session, 'request',
+                               side_effect=request):
+            aips = amclient_async.run(self.client.aips())
+        assert aips == [{'uuid': 'a'}, {'uuid': 'b'}]
+
+    def test_request_error(self):
+        """Test that failed requests return None like AMClient."""
+        with mock.patch.object(
+                self.client.session, 'request',
+                side_effect=amclient_async.requests.exceptions.Timeout):
+            assert amclient_async.run(
+                self.client.get_ingest_status('uuid')) is None
@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 
+import os
+import shutil
 import subprocess
+import tempfile
+import threading
 import unittest
 import vcr
 
+from six.moves import BaseHTTPServer
+
 try:
     import mock
 except ImportError:
     from unittest import mock
 
 from dips import atom_upload
+from dips import upload_queue
 
 ATOM_URL = 'http://192.168.168.193'
 ATOM_EMAIL = 'demo@example.com'
@@ -101,3 +108,156 @@ class TestAtomUpload(unittest.TestCase):
             )
 
         assert ret is None
+
+    def test_rsync_batch(self):
+        """Test that DIPs are sent with one rsync per parent folder over the
+        shared SSH connection, and one by one when a run fails."""
+        commands = []
+
+        def check_output(command, stderr=None):
+            files_from = None
+            if '--files-from' in command:
+                with open(command[command.index('--files-from') + 1]) as f:
+                    files_from = f.read().split()
+            commands.append((command, files_from))
+            if command[-2] == '/tmp/b/':
+                raise subprocess.CalledProcessError(23, command, 'failed')
+            if command[-2] == '/tmp/b/dip_3':
+                raise subprocess.CalledProcessError(23, command, 'failed')
+
+        dip_paths = ['/tmp/a/dip_1', '/tmp/a/dip_2/', '/tmp/b/dip_3/', '/tmp/b/dip_4']
+        with mock.patch('subprocess.check_output', side_effect=check_output):
+            errors = atom_upload.rsync_batch(RSYNC_TARGET, dip_paths, '/tmp/ssh')
+
+        # Errors are keyed by the paths as given
+        assert errors == {'/tmp/b/dip_3/': 'failed'}
+        assert [(c[-2], files_from) for c, files_from in commands] == [
+            ('/tmp/a/', ['dip_1', 'dip_2']),
+            ('/tmp/b/', ['dip_3', 'dip_4']),
+            ('/tmp/b/dip_3', None),
+            ('/tmp/b/dip_4', None),
+        ]
+        for command, _ in commands:
+            assert command[-1] == RSYNC_TARGET
+            assert 'ControlPath=/tmp/ssh' in command[command.index('-e') + 1]
+
+    def test_upload_dips(self):
+        """Test that deposits are made against an AtoM stand-in for the DIPs
+        sent, and that the outcome of each DIP is tracked."""
+        deposits = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                location = self.headers.get('Content-Location')
+                deposits.append((self.path, location))
+                if location.endswith('dip_3'):
+                    self.send_response(500)
+                else:
+                    self.send_response(302)
+                    self.send_header('Location', '/test')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        atom_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+        dip_paths = ['/tmp/dip_{}'.format(i) for i in range(1, 6)]
+        rsync_errors = {'/tmp/dip_2': 'failed'}
+        try:
+            with mock.patch('dips.atom_upload.rsync_batch', return_value=rsync_errors):
+                results = atom_upload.upload_dips(
+                    atom_url, ATOM_EMAIL, ATOM_PASSWORD, ATOM_SLUG,
+                    RSYNC_TARGET, dip_paths, deposit_workers=2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert list(results) == dip_paths
+        assert [r['status'] for r in results.values()] == [
+            atom_upload.DEPOSITED, atom_upload.TRANSFER_FAILED,
+            atom_upload.DEPOSIT_FAILED, atom_upload.DEPOSITED,
+            atom_upload.DEPOSITED]
+        assert results['/tmp/dip_2']['error'] == 'failed'
+        assert sorted(deposits) == [
+            ('/sword/deposit/test', 'file:///dip_{}'.format(i)) for i in (1, 3, 4, 5)]
+
+    def test_upload_dips_trailing_slash(self):
+        """Test that DIP paths given with a trailing slash are tracked
+        when their transfer fails."""
+        effect = subprocess.CalledProcessError(1, [], 'failed')
+        with mock.patch('subprocess.check_output', side_effect=effect), \
+                mock.patch('dips.atom_upload.deposit') as deposit:
+            results = atom_upload.upload_dips(
+                ATOM_URL, ATOM_EMAIL, ATOM_PASSWORD, ATOM_SLUG, RSYNC_TARGET,
+                ['/tmp/a/dip_1/', '/tmp/a/dip_2'])
+
+        assert list(results) == ['/tmp/a/dip_1', '/tmp/a/dip_2']
+        assert [r['status'] for r in results.values()] == [
+            atom_upload.TRANSFER_FAILED, atom_upload.TRANSFER_FAILED]
+        assert deposit.call_count == 0
+
+    def test_process_queue(self):
+        """Test that the queue worker records each stage and that only the
+        failed stage is done again on retry."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            queue = upload_queue.UploadQueue(os.path.join(tmp_dir, 'queue.db'))
+            dip_paths = ['/tmp/dip_1', '/tmp/dip_2', '/tmp/dip_3']
+            queue.enqueue(dip_paths, ATOM_SLUG)
+
+            def deposit(atom_url, atom_email, atom_password, atom_slug,
+                        dip_path, session, response_info):
+                if dip_path == '/tmp/dip_3' and deposit.fail:
+                    response_info['status_code'] = 500
+                    raise Exception('Response status code not expected')
+                response_info.update(status_code=302, location='/test')
+            deposit.fail = True
+
+            rsync = mock.patch('dips.atom_upload.rsync_batch',
+                               return_value={'/tmp/dip_2': 'failed'})
+            deposit_mock = mock.patch('dips.atom_upload.deposit', side_effect=deposit)
+            with rsync as rsync_batch, deposit_mock as deposits:
+                stats = atom_upload.process_queue(
+                    queue, ATOM_URL, ATOM_EMAIL, ATOM_PASSWORD, RSYNC_TARGET,
+                    max_attempts=1)
+                assert rsync_batch.call_args[0][1] == dip_paths
+                assert sorted(c[0][4] for c in deposits.call_args_list) == [
+                    '/tmp/dip_1', '/tmp/dip_3']
+                assert (stats['deposited'], stats['failed'], stats['depth']) == (1, 2, 0)
+
+                queue.retry_failed()
+                rsync_batch.return_value = {}
+                deposits.reset_mock()
+                deposit.fail = False
+                stats = atom_upload.process_queue(
+                    queue, ATOM_URL, ATOM_EMAIL, ATOM_PASSWORD, RSYNC_TARGET)
+                assert rsync_batch.call_args[0][1] == ['/tmp/dip_2']
+                assert sorted(c[0][4] for c in deposits.call_args_list) == [
+                    '/tmp/dip_2', '/tmp/dip_3']
+                assert (stats['deposited'], stats['failed'], stats['depth']) == (3, 0, 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_process_queue_trailing_slash(self):
+        """Test that a DIP queued with a trailing slash whose transfer fails
+        is not deposited."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            queue = upload_queue.UploadQueue(os.path.join(tmp_dir, 'queue.db'))
+            queue.enqueue(['/tmp/a/dip_1/'], ATOM_SLUG)
+            effect = subprocess.CalledProcessError(1, [], 'failed')
+            with mock.patch('subprocess.check_output', side_effect=effect), \
+                    mock.patch('dips.atom_upload.deposit') as deposit:
+                stats = atom_upload.process_queue(
+                    queue, ATOM_URL, ATOM_EMAIL, ATOM_PASSWORD, RSYNC_TARGET,
+                    max_attempts=1)
+            assert deposit.call_count == 0
+            assert (stats['transferred'], stats['failed']) == (0, 1)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+from aips import bulk_reingest
+
+AIP_UUIDS = ['aip-{}'.format(i) for i in range(5)]
+
+
+class FakePipeline(object):
+    """AMClient stand-in whose units complete after two status checks."""
+
+    def __init__(self, active, name):
+        self.active = active
+        self.name = name
+        self.checks = {}
+
+    def status(self, unit_uuid):
+        self.checks[unit_uuid] = self.checks.get(unit_uuid, 0) + 1
+        if self.checks[unit_uuid] < 2:
+            return {'status': 'PROCESSING'}
+        if unit_uuid.startswith('transfer-'):
+            return {'status': 'COMPLETE',
+                    'sip_uuid': unit_uuid.replace('transfer-', 'sip-')}
+        self.active.remove(unit_uuid.replace('sip-', ''))
+        return {'status': 'COMPLETE'}
+
+    def get_transfer_status(self):
+        return self.status(self.transfer_uuid)
+
+    def get_ingest_status(self):
+        return self.status(self.sip_uuid)
+
+
+class TestBulkReingest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp_dir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_pipelines(self):
+        ss_client = mock.Mock()
+        ss_client.get_pipelines.return_value = {'objects': [
+            {'uuid': 'p1', 'remote_name': '192.168.1.10'},
+            {'uuid': 'p2', 'remote_name': 'https://am.example.org/'},
+            {'uuid': 'p3', 'remote_name': ''},
+        ]}
+        assert bulk_reingest.get_pipelines(ss_client) == {
+            'p1': 'http://192.168.1.10', 'p2': 'https://am.example.org'}
+        assert bulk_reingest.get_pipelines(
+            ss_client, 'http://am', ['p3']) == {'p3': 'http://am'}
+
+    def test_reingest(self):
+        """Test that reingests are spread over the pipelines without
+        exceeding the limit, and that the state is saved for resuming."""
+        active = {'p1': [], 'p2': []}
+        am_clients = {p: FakePipeline(active[p], p) for p in active}
+        peak = [0]
+
+        def reingest_aip():
+            if ss_client.aip_uuid == 'aip-3':
+                return {'error': True, 'message': 'Package not found'}
+            pipeline = active[ss_client.pipeline_uuid]
+            pipeline.append(ss_client.aip_uuid)
+            peak[0] = max(peak[0], len(pipeline))
+            return {'error': False,
+                    'reingest_uuid': 'transfer-' + ss_client.aip_uuid}
+
+        ss_client = mock.Mock()
+        ss_client.reingest_aip.side_effect = reingest_aip
+        summary = bulk_reingest.reingest(
+            ss_client, am_clients, AIP_UUIDS, self.state_file,
+            max_in_progress=1, poll_interval=0)
+        assert summary == {'done': 4, 'failed': 1}
+        assert peak[0] == 1
+        assert active == {'p1': [], 'p2': []}
+        with open(self.state_file) as f:
+            aips = json.load(f)['aips']
+        assert {aips[u]['pipeline'] for u in AIP_UUIDS} == {'p1', 'p2'}
+        assert aips['aip-3']['error'] == 'Package not found'
+
+        # Finished AIPs are not reingested again, failed ones on demand
+        ss_client.reingest_aip.reset_mock()
+        bulk_reingest.reingest(ss_client, am_clients, AIP_UUIDS,
+                               self.state_file, poll_interval=0)
+        assert ss_client.reingest_aip.call_count == 0
+        bulk_reingest.reingest(ss_client, am_clients, AIP_UUIDS,
+                               self.state_file, poll_interval=0,
+                               retry_failed=True)
+        assert ss_client.reingest_aip.call_count == 1
+
+    def _reingest_stuck(self, status, **kwargs):
+        am_client = mock.Mock()
+        am_client.get_ingest_status.return_value = status
+        ss_client = mock.Mock()
+        ss_client.reingest_aip.side_effect = lambda: {
+            'error': False, 'reingest_uuid': 'sip-' + ss_client.aip_uuid}
+        summary = bulk_reingest.reingest(
+            ss_client, {'p1': am_client}, AIP_UUIDS[:2], self.state_file,
+            reingest_type='METADATA_ONLY', poll_interval=0, **kwargs)
+        with open(self.state_file) as f:
+            aips = json.load(f)['aips']
+        return summary, aips
+
+    def test_reingest_user_input(self):
+        """Test that units awaiting user input are failed after the stall
+        timeout, freeing their slot for the next AIP."""
+        summary, aips = self._reingest_stuck(
+            {'status': 'USER_INPUT', 'microservice': 'Approve AIP reingest'},
+            stall_timeout=0)
+        assert summary == {'failed': 2}
+        assert 'stalled' in aips['aip-0']['error']
+        assert 'Approve AIP reingest' in aips['aip-0']['error']
+
+    def test_reingest_status_errors(self):
+        """Test that units whose status cannot be read are failed after
+        max_status_errors checks."""
+        summary, aips = self._reingest_stuck(404, max_status_errors=3)
+        assert summary == {'failed': 2}
+        assert aips['aip-1']['error'] == (
+            'No status for ingest sip-aip-1 after 3 checks: 404')
+
+    def test_check_reingest_progress(self):
+        """Test that a unit moving through microservices is not stalled."""
+        am_client = mock.Mock()
+        entry = {'unit_type': 'ingest', 'unit_uuid': 'sip-1', 'progress': 0}
+        for microservice in ('Normalize', 'Store AIP'):
+            am_client.get_ingest_status.return_value = {
+                'status': 'PROCESSING', 'microservice': microservice}
+            assert bulk_reingest.check_reingest(
+                am_client, entry, stall_timeout=60) == 'in_progress'
+        assert bulk_reingest.check_reingest(
+            am_client, entry, stall_timeout=0) == 'failed'
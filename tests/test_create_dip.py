@@ -1,12 +1,21 @@
 #!/usr/bin/env python
+import hashlib
+import json
 import zipfile
 import os
+import threading
 import time
 import unittest
 import vcr
 
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
 from transfers import amclient
 from aips import create_dip
+from tests import test_mets_index
 from tests.test_amclient import TmpDir
 
 
@@ -21,6 +30,16 @@ TMP_DIR = os.path.join(THIS_DIR, '.tmp-create-dip')
 OUTPUT_DIR = os.path.join(TMP_DIR, 'output')
 
 
+def fake_create_dip(aip_dir, aip_uuid, output_dir, zip_entries):
+    """Create an empty DIP ZIP file where create_dip would."""
+    dip_dir = os.path.join(output_dir, '{}_{}_DIP'.format(TRANSFER_NAME, aip_uuid))
+    if not os.path.isdir(os.path.join(dip_dir, 'objects')):
+        os.makedirs(os.path.join(dip_dir, 'objects'))
+    zip_name = '{}.zip'.format(os.path.basename(aip_dir)[:-37])
+    open(os.path.join(dip_dir, 'objects', zip_name), 'w').close()
+    return dip_dir
+
+
 class TestCreateDip(unittest.TestCase):
     @vcr.use_cassette('fixtures/vcr_cassettes/download_aip_success.yaml')
     def test_extract_aip_success(self):
@@ -146,3 +165,280 @@ class TestCreateDip(unittest.TestCase):
         """Test that a DIP creation fails with a bad path."""
         dip_dir = create_dip.create_dip('bad_path', AIP_UUID, OUTPUT_DIR)
         assert dip_dir is None
+
+    def test_parse_7z_listing(self):
+        """Test that only the file paths are read from a 7z listing."""
+        output = '\n'.join([
+            '7-Zip [64] 16.02 : Copyright (c) 1999-2016 Igor Pavlov',
+            '',
+            '--',
+            'Path = /tmp/transfer.7z',
+            'Type = 7z',
+            '',
+            '----------',
+            'Path = transfer-{}'.format(AIP_UUID),
+            'Folder = +',
+            'Attributes = D_ drwxr-xr-x',
+            '',
+            'Path = transfer-{}/data/METS.{}.xml'.format(AIP_UUID, AIP_UUID),
+            'Folder = -',
+            'Size = 100',
+            '',
+            'Path = transfer-{}/data/objects/file.txt'.format(AIP_UUID),
+            'Attributes = A_ -rw-r--r--',
+        ])
+        assert create_dip.parse_7z_listing(output) == [
+            'transfer-{}/data/METS.{}.xml'.format(AIP_UUID, AIP_UUID),
+            'transfer-{}/data/objects/file.txt'.format(AIP_UUID),
+        ]
+
+    def test_select_paths(self):
+        """Test that only originals and submission documentation are
+        selected for extraction."""
+        aip_dirname = 'transfer-{}'.format(AIP_UUID)
+        paths = [
+            '{}/data/METS.{}.xml'.format(aip_dirname, AIP_UUID),
+            '{}/data/objects/file.txt'.format(aip_dirname),
+            '{}/data/objects/file-{}.mp4'.format(aip_dirname, AIP_UUID),
+            '{}/data/objects/submissionDocumentation/transfer/METS.xml'.format(aip_dirname),
+            '{}/data/logs/fileFormatIdentification.log'.format(aip_dirname),
+        ]
+        assert create_dip.select_paths(paths, aip_dirname, {'objects/file.txt'}) == [
+            paths[1], paths[3]]
+
+    def test_parse_size(self):
+        """Test that sizes are read in bytes or with a unit suffix."""
+        assert create_dip.parse_size('1024') == 1024
+        assert create_dip.parse_size('500M') == 500 * 1024 ** 2
+        assert create_dip.parse_size('1.5tb') == int(1.5 * 1024 ** 4)
+
+    def test_create_dips(self):
+        """Test that AIPs run in parallel only while their temporary space
+        fits in the budget, and that failures are summarised."""
+        running = []
+        peak = [0]
+        lock = threading.Lock()
+
+        def process_aip(ss_url, ss_user, ss_api_key, aip_uuid, tmp_dir,
+                        output_dir, timings, package, use_local, force):
+            assert package['uuid'] == aip_uuid
+            with lock:
+                running.append(aip_uuid)
+                peak[0] = max(peak[0], len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(aip_uuid)
+            timings['download'] = 1
+            return 4 if aip_uuid == 'aip-3' else None
+
+        # 100 bytes per AIP take 200 bytes of temporary space, the budget
+        # allows two AIPs at a time of the four workers
+        packages = [{'uuid': 'aip-{}'.format(i), 'size': 100} for i in range(6)]
+        with mock.patch.object(create_dip, 'process_aip', side_effect=process_aip):
+            summary = create_dip.create_dips(
+                SS_URL, SS_USER_NAME, SS_API_KEY, packages, TMP_DIR,
+                OUTPUT_DIR, workers=4, tmp_budget=400)
+        assert peak[0] == 2
+        assert summary['failed'] == ['aip-3']
+        assert sorted(summary['created']) == [
+            'aip-0', 'aip-1', 'aip-2', 'aip-4', 'aip-5']
+        assert summary['timings']['aip-0']['download'] == 1
+
+    def test_tmp_budget_oversized(self):
+        """Test that an AIP larger than the budget is admitted alone."""
+        budget = create_dip.TmpBudget(100)
+        budget.acquire(500)
+        assert budget.used == 500
+        budget.release(500)
+        budget.acquire(50)
+        budget.acquire(50)
+        assert budget.used == 100
+
+    def test_process_aip_resume(self):
+        """Test that a failed DIP creation keeps its workspace and resumes
+        from the last completed stage."""
+        with TmpDir(TMP_DIR):
+            workspace_dir = os.path.join(TMP_DIR, AIP_UUID)
+            aip_dir = os.path.join(workspace_dir, 'transfer-{}'.format(AIP_UUID))
+            entries = [[os.path.join(aip_dir, 'data', 'objects', 'file.txt'),
+                        'transfer/file.txt', 1510849451]]
+
+            def download_aip():
+                aip_file = '{}.7z'.format(aip_dir)
+                with open(aip_file, 'w') as f:
+                    f.write('7z')
+                return aip_file
+
+            def extract_aip(aip_file, aip_uuid, tmp_dir, remove_source):
+                os.makedirs(os.path.join(aip_dir, 'data'))
+                open(os.path.join(aip_dir, 'data', 'METS.{}.xml'.format(AIP_UUID)), 'w').close()
+                return aip_dir
+
+            def process_aip():
+                return create_dip.process_aip(
+                    SS_URL, SS_USER_NAME, SS_API_KEY, AIP_UUID, TMP_DIR,
+                    OUTPUT_DIR, package={'uuid': AIP_UUID}, use_local=False)
+
+            with mock.patch.object(amclient.AMClient, 'download_aip', side_effect=download_aip) as download, \
+                    mock.patch.object(create_dip, 'extract_aip', return_value=None) as extract, \
+                    mock.patch.object(create_dip, 'get_zip_entries', return_value=entries) as index, \
+                    mock.patch.object(create_dip, 'create_dip', return_value=None) as create:
+                # Extraction fails, the download is kept
+                assert process_aip() == 5
+                assert list(create_dip.load_checkpoints(workspace_dir)) == ['downloaded']
+                # Zipping fails, the extraction and index are kept
+                extract.side_effect = extract_aip
+                assert process_aip() == 6
+                assert download.call_count == 1
+                extract.assert_called_with(
+                    '{}.7z'.format(aip_dir), AIP_UUID, workspace_dir,
+                    remove_source=True)
+                assert sorted(create_dip.load_checkpoints(workspace_dir)) == [
+                    'downloaded', 'extracted', 'indexed']
+                # Success, only the DIP creation is run again
+                create.side_effect = fake_create_dip
+                assert process_aip() is None
+                assert download.call_count == 1
+                assert extract.call_count == 2
+                assert index.call_count == 1
+                create.assert_called_with(aip_dir, AIP_UUID, OUTPUT_DIR, zip_entries=entries)
+            assert not os.path.exists(workspace_dir)
+
+    def test_process_aip_local(self):
+        """Test that AIPs readable on this host are not downloaded, and that
+        uncompressed AIPs are read in place."""
+        with TmpDir(TMP_DIR):
+            storage_dir = os.path.join(TMP_DIR, 'storage')
+            aip_dir = os.path.join(storage_dir, 'transfer-{}'.format(AIP_UUID))
+            os.makedirs(aip_dir)
+            aip_file = '{}.7z'.format(aip_dir)
+            open(aip_file, 'w').close()
+            extracted_dir = os.path.join(TMP_DIR, AIP_UUID, 'transfer-{}'.format(AIP_UUID))
+
+            with mock.patch.object(create_dip, 'create_dip', side_effect=fake_create_dip) as create, \
+                    mock.patch.object(create_dip, 'extract_aip', return_value=extracted_dir) as extract, \
+                    mock.patch.object(create_dip, 'get_zip_entries', return_value=[]), \
+                    mock.patch.object(amclient.AMClient, 'download_aip') as download:
+                # Uncompressed, read in place
+                package = {'uuid': AIP_UUID, 'current_full_path': aip_dir + '/'}
+                assert create_dip.process_aip(
+                    SS_URL, SS_USER_NAME, SS_API_KEY, AIP_UUID, TMP_DIR,
+                    OUTPUT_DIR, package=package) is None
+                create.assert_called_with(aip_dir, AIP_UUID, OUTPUT_DIR, zip_entries=[])
+                assert not extract.called
+                # Even with a dot in its name
+                dotted_dir = os.path.join(storage_dir, 'report.v2-{}'.format(AIP_UUID))
+                os.makedirs(dotted_dir)
+                package['current_full_path'] = dotted_dir
+                assert create_dip.process_aip(
+                    SS_URL, SS_USER_NAME, SS_API_KEY, AIP_UUID, TMP_DIR,
+                    OUTPUT_DIR, package=package) is None
+                create.assert_called_with(dotted_dir, AIP_UUID, OUTPUT_DIR, zip_entries=[])
+                assert not extract.called
+                # Compressed, extracted from the storage and kept there
+                package['current_full_path'] = aip_file
+                assert create_dip.process_aip(
+                    SS_URL, SS_USER_NAME, SS_API_KEY, AIP_UUID, TMP_DIR,
+                    OUTPUT_DIR, package=package) is None
+                extract.assert_called_with(
+                    aip_file, AIP_UUID, os.path.join(TMP_DIR, AIP_UUID),
+                    remove_source=False)
+                create.assert_called_with(extracted_dir, AIP_UUID, OUTPUT_DIR, zip_entries=[])
+                assert not download.called
+                # Not readable on this host, downloaded
+                package['current_full_path'] = '/var/archivematica/missing.7z'
+                download.return_value = None
+                assert create_dip.process_aip(
+                    SS_URL, SS_USER_NAME, SS_API_KEY, AIP_UUID, TMP_DIR,
+                    OUTPUT_DIR, package=package) == 4
+                assert download.called
+            assert os.path.isfile(aip_file)
+
+    def test_tmp_space_needed(self):
+        """Test that local AIPs reserve less temporary space."""
+        with TmpDir(TMP_DIR):
+            aip_file = os.path.join(TMP_DIR, 'transfer-{}.7z'.format(AIP_UUID))
+            open(aip_file, 'w').close()
+            package = {'size': 100, 'current_full_path': TMP_DIR}
+            assert create_dip.tmp_space_needed(package) == 0
+            assert create_dip.tmp_space_needed(package, use_local=False) == 200
+            package['current_full_path'] = aip_file
+            assert create_dip.tmp_space_needed(package) == 100
+            package['current_full_path'] = '/var/archivematica/missing.7z'
+            assert create_dip.tmp_space_needed(package) == 200
+
+    def test_process_aip_up_to_date(self):
+        """Test that AIPs whose DIP is up to date are skipped unless forced
+        or changed."""
+        with TmpDir(TMP_DIR):
+            aip_dir = os.path.join(TMP_DIR, 'storage', 'transfer-{}'.format(AIP_UUID))
+            os.makedirs(os.path.join(aip_dir, 'data'))
+            mets_file = os.path.join(aip_dir, 'data', 'METS.{}.xml'.format(AIP_UUID))
+            with open(mets_file, 'w') as f:
+                f.write('<mets/>')
+            package = {'uuid': AIP_UUID, 'current_full_path': aip_dir, 'size': 100}
+
+            def process_aip(**kwargs):
+                timings = {}
+                assert create_dip.process_aip(
+                    SS_URL, SS_USER_NAME, SS_API_KEY, AIP_UUID, TMP_DIR,
+                    OUTPUT_DIR, timings, package=package, **kwargs) is None
+                return timings.get('skipped', False)
+
+            with mock.patch.object(create_dip, 'create_dip', side_effect=fake_create_dip), \
+                    mock.patch.object(create_dip, 'get_zip_entries', return_value=[]):
+                assert not process_aip()
+                manifest = json.load(open(create_dip.manifest_path(OUTPUT_DIR, AIP_UUID)))
+                assert manifest['aip_mets_checksum'] == hashlib.sha256(b'<mets/>').hexdigest()
+                assert manifest['dip_version'] == create_dip.DIP_VERSION
+                assert process_aip()
+                assert not process_aip(force=True)
+                # Changed in the Storage Service
+                package['size'] = 200
+                assert not process_aip()
+                assert process_aip()
+                # Changed METS file
+                with open(mets_file, 'w') as f:
+                    f.write('<mets></mets>')
+                assert not process_aip()
+                # DIP removed
+                os.remove(manifest['zip_file'])
+                assert not process_aip()
+
+    def test_create_dip_fixity(self):
+        """Test that originals are checked against their premis:fixity while
+        zipped, and that mismatches are reported and fail the DIP."""
+        content = b'file3'
+        with TmpDir(TMP_DIR):
+            aip_dir = os.path.join(TMP_DIR, 'transfer-{}'.format(AIP_UUID))
+            os.makedirs(os.path.join(aip_dir, 'data', 'objects', 'folder'))
+            with open(os.path.join(aip_dir, 'data', 'objects', 'folder', 'file3.txt'), 'wb') as f:
+                f.write(content)
+            mets_file = os.path.join(aip_dir, 'data', 'METS.{}.xml'.format(AIP_UUID))
+            report_file = create_dip.fixity_report_path(OUTPUT_DIR, AIP_UUID)
+            os.makedirs(OUTPUT_DIR)
+
+            with open(mets_file, 'w') as f:
+                f.write(test_mets_index.METS.replace(
+                    'abc123', hashlib.sha256(content).hexdigest()))
+            dip_dir = create_dip.create_dip(aip_dir, AIP_UUID, OUTPUT_DIR)
+            assert os.path.isdir(dip_dir)
+            report = json.load(open(report_file))
+            assert report['verified'] == 1
+            assert report['mismatches'] == []
+            zip_file = zipfile.ZipFile(os.path.join(dip_dir, 'objects', 'transfer.zip'))
+            assert zip_file.read('transfer/folder/file3.txt') == content
+
+            with open(mets_file, 'w') as f:
+                f.write(test_mets_index.METS)
+            assert create_dip.create_dip(aip_dir, AIP_UUID, OUTPUT_DIR) is None
+            assert not os.path.exists(dip_dir)
+            report = json.load(open(report_file))
+            assert report['verified'] == 0
+            assert report['mismatches'] == [{
+                'path': os.path.join(aip_dir, 'data', 'objects', 'folder', 'file3.txt'),
+                'name': 'transfer/folder/file3.txt',
+                'algorithm': 'sha256',
+                'expected': 'abc123',
+                'actual': hashlib.sha256(content).hexdigest(),
+            }]
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+import datetime
+import json
+import unittest
+
+from six import StringIO
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from transfers import list_db
+from transfers import models
+
+engine = create_engine('sqlite:///:memory:')
+models.Base.metadata.create_all(engine)
+Session = sessionmaker(bind=engine)
+session = Session()
+
+
+class TestListDb(unittest.TestCase):
+    def setUp(self):
+        session.query(models.Unit).delete()
+        session.add_all([
+            models.Unit(uuid='a', path=b'SampleTransfers/Images', unit_type='ingest', status='COMPLETE',
+                        current=False, updated=datetime.datetime(2018, 1, 1)),
+            models.Unit(uuid='b', path=b'SampleTransfers/Multimedia', unit_type='ingest', status='PROCESSING',
+                        current=True, updated=datetime.datetime(2018, 2, 1)),
+            models.Unit(uuid='c', path=b'Other/Images', unit_type='transfer', status='FAILED',
+                        current=False, updated=datetime.datetime(2018, 3, 1)),
+        ])
+        session.commit()
+
+    def test_stream_units_filters(self):
+        units = list(list_db.stream_units(session, batch_size=1, unit_type='ingest'))
+        assert [u.uuid for u in units] == ['a', 'b']
+        units = list(list_db.stream_units(session, current=False, path_prefix=b'SampleTransfers/'))
+        assert [u.uuid for u in units] == ['a']
+        units = list(list_db.stream_units(session, since=datetime.datetime(2018, 2, 1),
+                                          until=datetime.datetime(2018, 3, 1)))
+        assert [u.uuid for u in units] == ['b']
+
+    def test_write_units_jsonl(self):
+        out = StringIO()
+        written = list_db.write_units(list_db.stream_units(session, status='FAILED'), 'jsonl', out)
+        assert written == 1
+        record = json.loads(out.getvalue())
+        assert record['uuid'] == 'c'
+        assert record['path'] == 'Other/Images'
+        assert record['updated'] == '2018-03-01T00:00:00'
+
+    def test_write_units_csv(self):
+        out = StringIO()
+        list_db.write_units(list_db.stream_units(session), 'csv', out)
+        lines = out.getvalue().splitlines()
+        assert lines[0] == ','.join(list_db.FIELDS)
+        assert len(lines) == 4
+
+    def test_count_units(self):
+        counts = list_db.count_units(session, path_prefix=b'SampleTransfers')
+        assert sum(row['count'] for row in counts) == 2
+        assert {row['status'] for row in counts} == {'COMPLETE', 'PROCESSING'}
+
+    def test_write_counts_csv(self):
+        out = StringIO()
+        list_db.write_counts(list_db.count_units(session, status='FAILED'), 'csv', out)
+        assert out.getvalue().splitlines() == ['unit_type,status,current,count', 'transfer,FAILED,False,1']
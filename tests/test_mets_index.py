@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+
+from aips import mets_index
+
+FILE_UUID = 'ae8d4290-fe52-4954-b72a-0f591bee2e2f'
+PRESERVATION_UUID = '0b63be21-3ef6-4e6c-80d3-4bd0bf6ac431'
+
+METS = '''<?xml version='1.0' encoding='UTF-8'?>
+<mets:mets xmlns:mets="http://www.loc.gov/METS/"
+    xmlns:xlink="http://www.w3.org/1999/xlink"
+    xmlns:premis="info:lc/xmlns/premis-v2"
+    xmlns:premisv3="http://www.loc.gov/premis/v3"
+    xmlns:fits="http://hul.harvard.edu/ois/xml/ns/fits/fits_output"
+    xmlns:System="http://ns.exiftool.ca/File/System/1.0/">
+  <mets:metsHdr CREATEDATE="2017-11-16T16:30:00"/>
+  <mets:dmdSec ID="dmdSec_1">
+    <mets:mdWrap MDTYPE="PREMIS:OBJECT">
+      <mets:xmlData>
+        <premisv3:object>
+          <premisv3:originalName>%transferDirectory%objects/folder/</premisv3:originalName>
+        </premisv3:object>
+      </mets:xmlData>
+    </mets:mdWrap>
+  </mets:dmdSec>
+  <mets:amdSec ID="amdSec_1">
+    <mets:techMD ID="techMD_0" STATUS="superseded">
+      <mets:mdWrap MDTYPE="PREMIS:OBJECT">
+        <mets:xmlData>
+          <premis:object>
+            <premis:objectCharacteristics>
+              <premis:fixity>
+                <premis:messageDigestAlgorithm>md5</premis:messageDigestAlgorithm>
+                <premis:messageDigest>stale</premis:messageDigest>
+              </premis:fixity>
+              <premis:size>512</premis:size>
+            </premis:objectCharacteristics>
+            <premis:originalName>%transferDirectory%objects/folder/file3.txt</premis:originalName>
+          </premis:object>
+        </mets:xmlData>
+      </mets:mdWrap>
+    </mets:techMD>
+    <mets:techMD ID="techMD_1" STATUS="current">
+      <mets:mdWrap MDTYPE="PREMIS:OBJECT">
+        <mets:xmlData>
+          <premis:object>
+            <premis:objectCharacteristics>
+              <premis:fixity>
+                <premis:messageDigestAlgorithm>sha256</premis:messageDigestAlgorithm>
+                <premis:messageDigest>abc123</premis:messageDigest>
+              </premis:fixity>
+              <premis:size>1024</premis:size>
+              <premis:objectCharacteristicsExtension>
+                <fits:fits>
+                  <fits:fileinfo>
+                    <fits:fslastmodified>1510849507000</fits:fslastmodified>
+                  </fits:fileinfo>
+                </fits:fits>
+                <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+                  <System:FileModifyDate>2017:11:16 16:25:07+00:00</System:FileModifyDate>
+                </rdf:RDF>
+              </premis:objectCharacteristicsExtension>
+            </premis:objectCharacteristics>
+            <premis:originalName>%transferDirectory%objects/folder/file3.txt</premis:originalName>
+          </premis:object>
+        </mets:xmlData>
+      </mets:mdWrap>
+    </mets:techMD>
+  </mets:amdSec>
+  <mets:amdSec ID="amdSec_2">
+    <mets:techMD ID="techMD_2">
+      <mets:mdWrap MDTYPE="PREMIS:OBJECT">
+        <mets:xmlData>
+          <premis:object>
+            <premis:originalName>%SIPDirectory%objects/folder/file3-{p}.txt</premis:originalName>
+          </premis:object>
+        </mets:xmlData>
+      </mets:mdWrap>
+    </mets:techMD>
+  </mets:amdSec>
+  <mets:fileSec>
+    <mets:fileGrp USE="original">
+      <mets:file ID="file-{f}" GROUPID="Group-{f}" ADMID="amdSec_1">
+        <mets:FLocat xlink:href="objects/folder/file3.txt" LOCTYPE="OTHER"/>
+      </mets:file>
+    </mets:fileGrp>
+    <mets:fileGrp USE="preservation">
+      <mets:file ID="file-{p}" GROUPID="Group-{f}" ADMID="amdSec_2">
+        <mets:FLocat xlink:href="objects/folder/file3-{p}.txt" LOCTYPE="OTHER"/>
+      </mets:file>
+    </mets:fileGrp>
+  </mets:fileSec>
+  <mets:structMap TYPE="physical"/>
+</mets:mets>
+'''.format(f=FILE_UUID, p=PRESERVATION_UUID)
+
+
+class TestMetsIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mets_file = os.path.join(self.tmp_dir, 'METS.xml')
+        with open(self.mets_file, 'w') as f:
+            f.write(METS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index_mets(self):
+        """Test that the original files are indexed with their PREMIS
+        details from the current techMD, and the directories with their
+        original names."""
+        index = mets_index.index_mets(self.mets_file)
+        assert index.directories == ['%transferDirectory%objects/folder/']
+        assert index.files == [mets_index.OriginalFile(
+            file_id='file-{}'.format(FILE_UUID),
+            amd_id='amdSec_1',
+            path='objects/folder/file3.txt',
+            original_name='%transferDirectory%objects/folder/file3.txt',
+            size='1024',
+            checksum_type='sha256',
+            checksum='abc123',
+            fslastmodified='1510849507000',
+            exif_access_date=None,
+            exif_modify_date='2017:11:16 16:25:07+00:00',
+            mediainfo_modify_date=None,
+        )]
+
+    def test_index_mets_use(self):
+        """Test that other file groups can be indexed."""
+        index = mets_index.index_mets(self.mets_file, use='preservation')
+        assert [f.path for f in index.files] == [
+            'objects/folder/file3-{}.txt'.format(PRESERVATION_UUID)]
+
+    def test_index_mets_last_techmd(self):
+        """Test that the last techMD is used when none is marked current."""
+        with open(self.mets_file, 'w') as f:
+            f.write(METS.replace(' STATUS="current"', '').replace(
+                ' STATUS="superseded"', ''))
+        index = mets_index.index_mets(self.mets_file)
+        assert (index.files[0].size, index.files[0].checksum) == ('1024', 'abc123')
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import unittest
+from multiprocessing.pool import ThreadPool
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+from transfers import remove_folder
+
+AM_URL = 'http://127.0.0.1'
+USER = 'demo'
+API_KEY = '1c34274c0df0bca7edf9831dd838b4a6345ac2ef'
+
+COMPLETED = '0a3bd0c5-3c2d-4de8-a19c-4ac1e8ba4ac7'
+PROCESSING = '6fb6e2b6-2bd4-4d6b-9b46-e7fc9b0b4cb3'
+MISSING = 'deadc0de-c0de-c0de-c0de-deadc0dec0de'
+
+
+def fake_call_url_json(url, params):
+    if url.endswith('/api/ingest/completed'):
+        return {'message': 'Fetched completed ingests successfully.', 'results': [COMPLETED]}
+    if PROCESSING in url:
+        return {'status': 'PROCESSING', 'uuid': PROCESSING}
+    return None
+
+
+class TestRemoveFolder(unittest.TestCase):
+    def test_get_statuses(self):
+        pool = ThreadPool(2)
+        with mock.patch.object(remove_folder.utils, 'call_url_json', side_effect=fake_call_url_json) as call:
+            statuses = remove_folder.get_statuses(AM_URL, USER, API_KEY, [COMPLETED, PROCESSING, MISSING], pool)
+        pool.close()
+        assert statuses == {COMPLETED: 'COMPLETE', PROCESSING: 'PROCESSING'}
+        # One listing plus one status request per SIP not in it
+        assert call.call_count == 3
+        assert not any(COMPLETED in c[0][0] for c in call.call_args_list)
+
+    def test_get_statuses_no_listing(self):
+        pool = ThreadPool(2)
+        with mock.patch.object(remove_folder.utils, 'call_url_json', return_value=None):
+            statuses = remove_folder.get_statuses(AM_URL, USER, API_KEY, [COMPLETED, PROCESSING], pool)
+        pool.close()
+        assert statuses == {}
+
+    def test_trash_disabled_by_default(self):
+        with mock.patch.object(remove_folder.utils, 'get_setting', side_effect=lambda setting, default=None: default):
+            assert not remove_folder.trash_enabled()
+        with mock.patch.object(remove_folder.utils, 'get_setting', return_value='True'):
+            assert remove_folder.trash_enabled()
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
 
 from sqlalchemy import create_engine
@@ -165,3 +168,20 @@ class TestAutomateTransfers(unittest.TestCase):
         path = transfer.get_next_transfer(SS_URL, ss_user, ss_key, TS_LOCATION_UUID, PATH_PREFIX, DEPTH, COMPLETED, FILES)
         # Verify
         assert path is None
+
+    def test_models_init_wal(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            databasefile = os.path.join(tmp_dir, 'transfers.db')
+            models.init(databasefile, timeout=1)
+            db_session = models.Session()
+            db_session.add(models.Unit(uuid='x', path=b'foo', unit_type='ingest', current=True))
+            db_session.commit()
+            db_session.close()
+            models.maintain()
+            connection = sqlite3.connect(databasefile)
+            assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            assert connection.execute('SELECT count(*) FROM unit').fetchone()[0] == 1
+            connection.close()
+        finally:
+            shutil.rmtree(tmp_dir)
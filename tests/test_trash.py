@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from transfers import models
+from transfers import remove_folder
+from transfers import trash
+
+engine = create_engine('sqlite:///:memory:')
+models.Base.metadata.create_all(engine)
+Session = sessionmaker(bind=engine)
+session = Session()
+
+
+def make_package(path, files=3):
+    os.makedirs(os.path.join(path, 'sub'))
+    for i in range(files):
+        with open(os.path.join(path, 'sub', 'file{}'.format(i)), 'w') as f:
+            f.write('x' * 10)
+    os.symlink('sub', os.path.join(path, 'link'))
+
+
+class TestTrash(unittest.TestCase):
+    def setUp(self):
+        session.query(models.Deletion).delete()
+        session.commit()
+        self.source_location = tempfile.mkdtemp()
+        self.trash_dir = trash.get_trash_dir(self.source_location)
+
+    def tearDown(self):
+        shutil.rmtree(self.source_location)
+
+    def test_remove_folder_moves_to_trash(self):
+        package = os.path.join(self.source_location, 'ARCH12345', 'dig1')
+        make_package(package)
+        assert remove_folder.remove_folder(package, 2, self.trash_dir)
+        assert not os.path.exists(package)
+        entries = os.listdir(self.trash_dir)
+        assert len(entries) == 1
+        assert os.listdir(os.path.join(self.trash_dir, entries[0])) == ['dig1']
+
+    def test_purge(self):
+        for name in ('a', 'b'):
+            package = os.path.join(self.source_location, name)
+            make_package(package)
+            trash.move_to_trash(package, self.trash_dir)
+        summary = trash.purge(session, self.trash_dir, workers=2)
+        assert summary == {'deleted': 2, 'failed': 0}
+        assert os.listdir(self.trash_dir) == []
+        deletions = session.query(models.Deletion).all()
+        assert len(deletions) == 2
+        for deletion in deletions:
+            assert deletion.files == 4
+            assert deletion.bytes >= 30
+            assert deletion.finished is not None
+
+    def test_purge_resumes(self):
+        package = os.path.join(self.source_location, 'a')
+        make_package(package)
+        trash_path = trash.move_to_trash(package, self.trash_dir)
+        name = os.path.basename(os.path.dirname(trash_path))
+        # Interrupted run: some files already deleted and recorded
+        os.remove(os.path.join(trash_path, 'sub', 'file0'))
+        session.add(models.Deletion(name=name, files=1, bytes=10))
+        session.commit()
+        assert trash.purge(session, self.trash_dir) == {'deleted': 1, 'failed': 0}
+        deletion = session.query(models.Deletion).get(name)
+        assert deletion.files == 4
+        assert deletion.finished is not None
+
+    def test_throttle(self):
+        throttle = trash.Throttle(100)
+        start = time.time()
+        for _ in range(3):
+            throttle.consume(10)
+        assert time.time() - start >= 0.2
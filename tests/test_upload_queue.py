@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from dips import upload_queue
+
+
+class TestUploadQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = upload_queue.UploadQueue(os.path.join(self.tmp_dir, 'queue.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stages(self):
+        """Test that DIPs go through the stages and that the queue depth
+        and lag follow the pending DIPs."""
+        assert self.queue.enqueue(['/tmp/dip_1', '/tmp/dip_2'], 'slug') == 2
+        assert self.queue.due(upload_queue.QUEUED) == [
+            ('/tmp/dip_1', 'slug'), ('/tmp/dip_2', 'slug')]
+        self.queue.mark_transferred('/tmp/dip_1')
+        assert self.queue.due(upload_queue.TRANSFERRED) == [('/tmp/dip_1', 'slug')]
+        stats = self.queue.stats(now=time.time() + 10)
+        assert stats['queued'] == 1
+        assert stats['transferred'] == 1
+        assert stats['depth'] == 2
+        assert stats['lag'] >= 10
+
+        self.queue.mark_deposited('/tmp/dip_1', 302, '/slug')
+        self.queue.mark_deposited('/tmp/dip_2', 302, '/slug')
+        stats = self.queue.stats()
+        assert stats['deposited'] == 2
+        assert stats['depth'] == 0
+        assert stats['lag'] == 0
+        # Deposited DIPs are queued again from the start, pending ones not
+        assert self.queue.enqueue(['/tmp/dip_1'], 'other') == 1
+        assert self.queue.enqueue(['/tmp/dip_1'], 'other') == 0
+
+    def test_enqueue_trailing_slash(self):
+        """Test that paths are stored without trailing slash."""
+        assert self.queue.enqueue(['/tmp/dip_1/', '/tmp/dip_1'], 'slug') == 1
+        assert self.queue.due(upload_queue.QUEUED) == [('/tmp/dip_1', 'slug')]
+
+    def test_failure_backoff(self):
+        """Test that failed stages are retried after a backoff, and only
+        them, until the DIP is failed."""
+        self.queue.enqueue(['/tmp/dip_1'], 'slug')
+        self.queue.mark_transferred('/tmp/dip_1')
+        now = time.time()
+        assert self.queue.mark_failure('/tmp/dip_1', 'error', max_attempts=2, response_status=500)
+        assert self.queue.due(upload_queue.TRANSFERRED, now=now) == []
+        assert self.queue.due(upload_queue.TRANSFERRED, now=now + upload_queue.BACKOFF + 1) == [
+            ('/tmp/dip_1', 'slug')]
+        assert self.queue.next_attempt() >= now + upload_queue.BACKOFF
+
+        assert not self.queue.mark_failure('/tmp/dip_1', 'error', max_attempts=2)
+        stats = self.queue.stats()
+        assert stats['failed'] == 1
+        assert stats['depth'] == 0
+        # The deposit is retried, not the transfer
+        assert self.queue.retry_failed() == 1
+        assert self.queue.due(upload_queue.TRANSFERRED) == [('/tmp/dip_1', 'slug')]
+        assert self.queue.due(upload_queue.QUEUED) == []
+
+    def test_backoff(self):
+        assert upload_queue.backoff(1) == upload_queue.BACKOFF
+        assert upload_queue.backoff(2) == 2 * upload_queue.BACKOFF
+        assert upload_queue.backoff(20) == upload_queue.MAX_BACKOFF
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+
+from aips import zip_writer
+
+TIMESTAMP = 1510849507
+
+
+class TestZipWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_file(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_write_zip(self):
+        """Test that the entries can be read by zipfile, stored or deflated
+        by format, with their modification times."""
+        text = b'Lorem ipsum dolor sit amet. ' * 1000
+        image = os.urandom(4096)
+        entries = [
+            (self._write_file('file.txt', text), 'transfer/file.txt', TIMESTAMP),
+            (self._write_file('file.jpg', image), 'transfer/folder/file.jpg', None),
+            (self._write_file('random.txt', image), u'transfer/fïle.txt', TIMESTAMP),
+        ]
+        zip_path = os.path.join(self.tmp_dir, 'transfer.zip')
+        assert zip_writer.write_zip(zip_path, entries, workers=2) == 3
+
+        with zipfile.ZipFile(zip_path) as zip_file:
+            assert zip_file.testzip() is None
+            infos = zip_file.infolist()
+            assert [info.filename for info in infos] == [
+                'transfer/file.txt', 'transfer/folder/file.jpg',
+                u'transfer/fïle.txt']
+            assert zip_file.read('transfer/file.txt') == text
+            assert zip_file.read('transfer/folder/file.jpg') == image
+            # Deflated, stored by extension and stored as it does not shrink
+            assert [info.compress_type for info in infos] == [
+                zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED, zipfile.ZIP_STORED]
+            assert infos[0].compress_size < infos[0].file_size
+            # DOS times have a resolution of two seconds
+            mtime = time.mktime(infos[0].date_time + (0, 0, -1))
+            assert TIMESTAMP - 2 <= mtime <= TIMESTAMP
+            mtime = time.mktime(infos[1].date_time + (0, 0, -1))
+            file_mtime = os.path.getmtime(entries[1][0])
+            assert file_mtime - 2 <= mtime <= file_mtime
+
+    def test_write_zip_many_entries(self):
+        """Test that more entries than the workers keep their order."""
+        entries = [
+            (self._write_file('{}.txt'.format(i), str(i).encode()),
+             'transfer/{}.txt'.format(i), TIMESTAMP)
+            for i in range(50)]
+        zip_path = os.path.join(self.tmp_dir, 'transfer.zip')
+        zip_writer.write_zip(zip_path, entries, workers=4)
+
+        with zipfile.ZipFile(zip_path) as zip_file:
+            assert zip_file.namelist() == [e[1] for e in entries]
+            assert zip_file.read('transfer/42.txt') == b'42'
+        # No temporary files are left behind
+        assert sorted(os.listdir(self.tmp_dir)) == sorted(
+            ['{}.txt'.format(i) for i in range(50)] + ['transfer.zip'])
+
+    def test_write_zip_digests(self):
+        """Test that entries are hashed in the same read when asked."""
+        data = b'Lorem ipsum'
+        entries = [
+            (self._write_file('file.txt', data), 'transfer/file.txt', None, 'md5'),
+            (self._write_file('file.jpg', data), 'transfer/file.jpg', None, 'sha256'),
+            (self._write_file('other.txt', data), 'transfer/other.txt', None),
+        ]
+        digests = {}
+        zip_writer.write_zip(os.path.join(self.tmp_dir, 'transfer.zip'),
+                             entries, digests=digests)
+        assert digests == {
+            'transfer/file.txt': hashlib.md5(data).hexdigest(),
+            'transfer/file.jpg': hashlib.sha256(data).hexdigest(),
+        }
+
+    def test_write_zip_out_of_range_times(self):
+        """Test that times past 2038 and 2107 are written, clamped."""
+        entries = [
+            (self._write_file('2100.txt', b'2100'), 'transfer/2100.txt', 4102444800),
+            (self._write_file('2200.txt', b'2200'), 'transfer/2200.txt', 7258118400),
+        ]
+        zip_path = os.path.join(self.tmp_dir, 'transfer.zip')
+        zip_writer.write_zip(zip_path, entries)
+
+        with zipfile.ZipFile(zip_path) as zip_file:
+            assert zip_file.testzip() is None
+            infos = zip_file.infolist()
+            assert infos[0].date_time[0] in (2099, 2100)
+            assert infos[1].date_time == (2107, 12, 31, 23, 59, 58)
+            # No extended timestamp, which would not fit
+            assert [info.extra for info in infos] == [b'', b'']
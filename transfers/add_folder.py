@@ -3,17 +3,26 @@
 Create folders
 
 Helper script to add upload folders.
+
+Accession numbers whose folder was created (or found) before are recorded in
+the database and skipped on later runs, so each run only touches the
+accessions that are new in the catalog.
 """
 
 from __future__ import print_function
+import errno
 import os
 import logging
+from multiprocessing.pool import ThreadPool
 
-import utils
+import utils, models
 
 LOG_NAME = 'add_folder'
 LOGGER = logging.getLogger(LOG_NAME)
 
+WORKERS = 4
+BATCH_SIZE = 100
+
 
 def get_source_location(ss_url, ss_user, ss_api_key, ts_location_uuid):
     """
@@ -37,37 +46,162 @@ def get_source_location(ss_url, ss_user, ss_api_key, ts_location_uuid):
         return location_info['path']
 
 
-def _add_directory(source_location, accession_number):
+def _add_directory(source_location, accession_number, stat_info=None):
+    """
+    Create the folder for accession_number with the owner and mode of the
+    source location.
+
+    :param str source_location: Path to the TS Location
+    :param str accession_number: Relative path of the folder
+    :param stat_info: os.stat of source_location, to avoid one stat per call
+    :returns: True if the folder was created, False if it already existed
+    """
     directory = os.path.join(source_location, accession_number)
     if os.path.exists(directory):
         LOGGER.info('Directory exists, skipping: ' + directory)
-    else:
-        LOGGER.info('Creating: ' + directory)
+        return False
+
+    LOGGER.info('Creating: ' + directory)
+    # Only the directories created here need their ownership set
+    new_dirs = []
+    cur_dir = accession_number
+    while cur_dir and not os.path.exists(os.path.join(source_location, cur_dir)):
+        new_dirs.append(cur_dir)
+        cur_dir = os.path.dirname(cur_dir)
+    try:
         os.makedirs(directory)
+    except OSError as e:
+        # Another worker may have created a shared parent in the meantime
+        if e.errno != errno.EEXIST or not os.path.isdir(directory):
+            raise
+    if stat_info is None:
         stat_info = os.stat(source_location)
-        cur_dir = accession_number
-        while cur_dir:
-            os.chown(os.path.join(source_location, cur_dir), stat_info.st_uid, stat_info.st_gid)
-            os.chmod(os.path.join(source_location, cur_dir), stat_info.st_mode)
-            cur_dir, dir = os.path.split(cur_dir)
+    for cur_dir in new_dirs:
+        os.chown(os.path.join(source_location, cur_dir), stat_info.st_uid, stat_info.st_gid)
+        os.chmod(os.path.join(source_location, cur_dir), stat_info.st_mode)
+    return True
 
 
-def main(ss_user, ss_api_key, ts_uuid, ss_url, config_file=None, log_level='INFO', **kwargs):
+def get_new_accessions(session, collections, full=False):
+    """
+    Return the accession numbers in collections without a recorded folder.
+
+    :param session: SQLAlchemy session with the DB
+    :param list collections: Accession numbers from the catalog
+    :param bool full: If True, ignore the record and return all of them
+    :returns: List of accession numbers, in catalog order and without duplicates
+    """
+    known = set() if full else {row[0] for row in session.query(models.Folder.accession_number)}
+    new = []
+    for accession_number in collections:
+        if accession_number not in known:
+            known.add(accession_number)
+            new.append(accession_number)
+    return new
+
+
+def diff_report(session, source_location, collections, full=False):
+    """
+    Describe what a run would do, without touching the filesystem or the DB.
+
+    :returns: Dict with lists 'create' (folders to create), 'exists' (new
+        accessions whose folder already exists) and 'removed' (recorded
+        accessions no longer in the catalog)
+    """
+    report = {'create': [], 'exists': [], 'removed': []}
+    for accession_number in get_new_accessions(session, collections, full):
+        directory = os.path.join(source_location, accession_number.replace('.', '/'))
+        report['exists' if os.path.exists(directory) else 'create'].append(accession_number)
+    catalog = set(collections)
+    report['removed'] = [row[0] for row in session.query(models.Folder.accession_number).order_by(
+        models.Folder.accession_number) if row[0] not in catalog]
+    return report
+
+
+def sync_folders(session, source_location, collections, workers=WORKERS, full=False):
+    """
+    Create the folders of new accessions in a pool of workers and record them.
+
+    :param session: SQLAlchemy session with the DB
+    :param str source_location: Path to the TS Location
+    :param list collections: Accession numbers from the catalog
+    :param int workers: Number of folders created in parallel
+    :param bool full: If True, check every accession and not only new ones
+    :returns: Dict with the number of folders 'created', 'existing' and 'failed'
+    """
+    new = get_new_accessions(session, collections, full)
+    LOGGER.info('%s accessions in the catalog, %s to check', len(collections), len(new))
+    summary = {'created': 0, 'existing': 0, 'failed': 0}
+    if not new:
+        return summary
+    stat_info = os.stat(source_location)
+
+    def add(accession_number):
+        try:
+            return accession_number, _add_directory(source_location, accession_number.replace('.', '/'), stat_info)
+        except OSError:
+            LOGGER.error('Unable to create folder for %s', accession_number, exc_info=True)
+            return accession_number, None
+
+    pool = ThreadPool(max(workers, 1))
+    try:
+        pending = 0
+        for accession_number, created in pool.imap_unordered(add, new):
+            if created is None:
+                summary['failed'] += 1
+                continue
+            summary['created' if created else 'existing'] += 1
+            session.merge(models.Folder(accession_number=accession_number))
+            pending += 1
+            if pending >= BATCH_SIZE:
+                session.commit()
+                pending = 0
+    finally:
+        pool.close()
+        pool.join()
+        session.commit()
+    return summary
+
+
+def add_arguments(parser):
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only report the folders that would be created, do not create or record anything.')
+    parser.add_argument('--full', action='store_true',
+                        help='Check the folders of all accessions in the catalog, not only those not seen before.')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='Number of folders created in parallel. Default: {}'.format(WORKERS))
+
+
+def main(ss_user, ss_api_key, ts_uuid, ss_url, config_file=None, log_level='INFO', dry_run=False, full=False,
+         workers=WORKERS, **kwargs):
     """
     Find the accession number and create the appropriate folder for it.
     """
     utils.setup(config_file, LOG_NAME, log_level)
     source_location = get_source_location(ss_url, ss_user, ss_api_key, ts_uuid)
+    if source_location is None:
+        return 1
     url = utils.get_setting('catalog_endpoint', 'http://localhost:8080') + '/service/all'
     params = {'access_token': utils.get_setting('catalog_key', 'dummy')}
     data = utils.call_url_json(url, params)
-    if data['collections']:
-        for accession_number in data['collections']:
-            _add_directory(source_location, accession_number.replace('.', '/'))
-    else:
+    if not data or not data['collections']:
         LOGGER.warning('Empty list')
         return None
 
+    session = models.Session()
+    if dry_run:
+        report = diff_report(session, source_location, data['collections'], full)
+        for key, prefix in (('create', '+'), ('exists', '='), ('removed', '-')):
+            for accession_number in report[key]:
+                print(prefix, accession_number)
+        LOGGER.info('Dry run: %s to create, %s already existing, %s no longer in the catalog',
+                    len(report['create']), len(report['exists']), len(report['removed']))
+        return 0
+
+    summary = sync_folders(session, source_location, data['collections'], workers, full)
+    LOGGER.info('Created %(created)s folders, %(existing)s already existed, %(failed)s failed', summary)
+    return 0
+
 
 if __name__ == '__main__':
-    utils.main(main)
+    utils.main(main, add_arguments)
@@ -12,12 +12,17 @@ from __future__ import print_function, unicode_literals
 import binascii
 import base64
 from collections import defaultdict
+import fnmatch
+import hashlib
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import pprint
 import re
 import sys
+import threading
+import time
 
 import requests
 
@@ -28,50 +33,102 @@ import requests
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from transfers import loggingconfig, defaults, amclientargs, errors, utils
+from transfers import package_mirror
 
 LOGGER = logging.getLogger('transfers')
 
 
-def b64decode_ts_location_browse(result):
-    """Base64-decode the results of a call to SS GET
-    /location/UUID/browse/.
+class _NameDecoder(object):
+    """Decode the base64-encoded names of a SS browse result.
+
+    Names that are not UTF-8 are decoded with the encoding last guessed for
+    a sibling name if possible, so ``chardet`` is imported once and only runs
+    again for names that encoding cannot decode.
     """
-    def dec(thing):
+
+    def __init__(self, result):
+        self.result = result
+        self.encoding = None
+        self.chardet = None
+
+    def guess(self, thing):
+        if self.chardet is None:
+            try:
+                import chardet
+            except ImportError:
+                chardet = False
+            self.chardet = chardet
+        if not self.chardet:
+            return None
+        return self.chardet.detect(thing).get('encoding')
+
+    def __call__(self, thing):
         try:
             thing = base64.b64decode(thing.encode('utf8'))
         except UnicodeEncodeError:
             LOGGER.warning('Failed to UTF8-encode output from GET call to SS'
-                           ' /location/UUID/browse/: %s', result)
+                           ' /location/UUID/browse/: %s', self.result)
         except (binascii.Error, TypeError):
             LOGGER.warning('Failed to base64-decode file or directory names in'
                            ' output from GET call to SS'
-                           ' /location/UUID/browse/: %s', result)
+                           ' /location/UUID/browse/: %s', self.result)
         try:
             return thing.decode('utf8')
         except ValueError:
-            LOGGER.debug('Unable to decode a transfer source component using'
-                         ' the UTF-8 codec; trying to guess the encoding...')
+            pass
+        if self.encoding:
             try:
-                import chardet
-            except ImportError:
-                LOGGER.debug(defaults.UNDEC_MSG)
-                return defaults.UNDECODABLE
-            encoding = chardet.detect(thing).get('encoding')
-            if encoding:
-                try:
-                    return thing.decode(encoding)
-                except ValueError:
-                    LOGGER.debug(defaults.UNDEC_MSG)
-                    return defaults.UNDECODABLE
-            LOGGER.debug(defaults.UNDEC_MSG)
-            return defaults.UNDECODABLE
+                return thing.decode(self.encoding)
+            except ValueError:
+                pass
+        LOGGER.debug('Unable to decode a transfer source component using'
+                     ' the UTF-8 codec; trying to guess the encoding...')
+        encoding = self.guess(thing)
+        if encoding:
+            try:
+                name = thing.decode(encoding)
+                self.encoding = encoding
+                return name
+            except ValueError:
+                pass
+        LOGGER.debug(defaults.UNDEC_MSG)
+        return defaults.UNDECODABLE
+
+
+def b64decode_ts_location_browse(result, limit=None, offset=0, pattern=None):
+    """Base64-decode the results of a call to SS GET
+    /location/UUID/browse/.
 
+    The entries can be restricted to those whose decoded name matches the
+    shell-style pattern, then paged with offset and limit. Decoding stops
+    once limit entries are found, and directories and properties are only
+    kept for the entries returned.
+    """
+    dec = _NameDecoder(result)
     try:
-        result['directories'] = [dec(d) for d in result['directories']]
-        result['entries'] = [dec(e) for e in result['entries']]
-        result['properties'] = {dec(key): val for key, val in
-                                result['properties'].items()}
-    except ValueError as error:
+        raw_directories = set(result['directories'])
+        entries = []
+        directories = []
+        properties = {}
+        skip = offset or 0
+        for raw in result['entries']:
+            if limit is not None and len(entries) >= limit:
+                break
+            name = dec(raw)
+            if pattern and not fnmatch.fnmatch(name, pattern):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            entries.append(name)
+            if raw in raw_directories:
+                directories.append(name)
+            if raw in result['properties']:
+                properties[name] = result['properties'][raw]
+        result['directories'] = directories
+        result['entries'] = entries
+        result['properties'] = properties
+    except (ValueError, KeyError, TypeError) as error:
         LOGGER.warning('GET call to SS /location/UUID/browse/ returned an'
                        ' unrecognized data structure: %s', result)
         LOGGER.warning(error)
@@ -82,10 +139,71 @@ def is_uuid(thing):
     return defaults.UUID_PATT.search(thing) is not None
 
 
+def dip_aip_uuid(dip):
+    """Return the UUID of the AIP a DIP was created from, which is the end of
+    the DIP's current_path, or None.
+    """
+    candidate = (dip.get('current_path') or '')[-36:]
+    if is_uuid(candidate):
+        return candidate
+    return None
+
+
+def build_dip_index(dips):
+    """Map AIP UUIDs to the list of DIPs created from them in one pass over
+    dips, keeping their order.
+    """
+    index = defaultdict(list)
+    for dip in dips:
+        aip_uuid = dip_aip_uuid(dip)
+        if aip_uuid:
+            index[aip_uuid].append(dip)
+    return dict(index)
+
+
 class AMClient(object):
 
     reingest_type = "FULL"
     transfer_type = "standard"
+    # transferables: only the entries matching a shell-style pattern, from
+    # the offset one on, and at most limit of them (None for all).
+    browse_pattern = None
+    browse_offset = 0
+    browse_limit = None
+    # Closing completed units: concurrent requests, timeout in seconds of
+    # each request (0 for none) and maximum number of units closed per call,
+    # 0 for all.
+    close_workers = 4
+    close_timeout = 60
+    close_limit = 0
+    # Packages per SS API page. Tastypie caps it with its max_limit setting.
+    package_page_size = 1000
+    # JSON file caching the AIP to DIPs index, disabled if None, and the
+    # number of seconds it is reused for.
+    dip_index_cache = None
+    dip_index_max_age = 3600
+    # SQLite file mirroring the SS package list, disabled if None, and the
+    # number of seconds after which it is synced again before a query.
+    package_mirror = None
+    package_mirror_max_age = 600
+    # Package downloads: bytes per read and write, whether to resume partial
+    # downloads, and the default algorithm of expected checksums.
+    download_chunk_size = 8 * 1024 * 1024
+    download_resume = True
+    download_checksum_algorithm = 'sha256'
+    # Optional requests.Session to download packages with, to reuse its
+    # connection pool, e.g. shared with amclient_async.AsyncAMClient.
+    session = None
+    # Batch downloads: UUIDs to download, given directly or one per line in
+    # a file, or else all the packages of a type; number of concurrent
+    # downloads, total size limit in bytes (0 for none) and JSON lines
+    # result manifest.
+    batch_uuids = None
+    batch_uuids_file = None
+    batch_package_type = None
+    batch_workers = 4
+    batch_max_bytes = 0
+    batch_manifest = None
 
     def __init__(self, **kwargs):
         """Construct an Archivematica client. Provide any of the following
@@ -102,6 +220,27 @@ class AMClient(object):
         param: aip_uuid
         param: dip_uuid
         param: directory
+        param: browse_pattern
+        param: browse_offset
+        param: browse_limit
+        param: close_workers
+        param: close_timeout
+        param: close_limit
+        param: package_page_size
+        param: dip_index_cache
+        param: dip_index_max_age
+        param: package_mirror
+        param: package_mirror_max_age
+        param: download_chunk_size
+        param: download_resume
+        param: download_checksum_algorithm
+        param: session
+        param: batch_uuids
+        param: batch_uuids_file
+        param: batch_package_type
+        param: batch_workers
+        param: batch_max_bytes
+        param: batch_manifest
         """
         for key, val in kwargs.items():
             setattr(self, key, val)
@@ -110,8 +249,22 @@ class AMClient(object):
     # formatting in a useful way, e.g. returning user friendly error messages
     # from any failed calls to the AM or SS servers.
     def stdout(self, stuff):
-        """Print to stdout, either as JSON or pretty-printed Python."""
-        if self.output_mode.lower() == 'json':
+        """Print to stdout, either as JSON, JSON lines or pretty-printed
+        Python.
+
+        In JSON lines mode, each item of a list or iterator is printed on its
+        own line as soon as it is available; other values are printed on one
+        line.
+        """
+        mode = self.output_mode.lower()
+        if mode == 'jsonl':
+            is_iterator = hasattr(stuff, '__next__') or hasattr(stuff, 'next')
+            if not (is_iterator or isinstance(stuff, (list, tuple))):
+                stuff = [stuff]
+            for item in stuff:
+                sys.stdout.write(json.dumps(item) + '\n')
+                sys.stdout.flush()
+        elif mode == 'json':
             print(json.dumps(stuff))
         else:
             pprint.pprint(stuff)
@@ -120,6 +273,10 @@ class AMClient(object):
         if name.startswith('print_'):
             try:
                 method = name.replace('print_', '', 1)
+                if (self.output_mode.lower() == 'jsonl' and
+                        hasattr(type(self), 'iter_{0}'.format(method))):
+                    # Stream the records instead of building the result
+                    method = 'iter_{0}'.format(method)
                 res = getattr(self, method)()
                 # Shortening variable for PEP8 conformance.
                 err_lookup = errors.error_lookup
@@ -164,13 +321,28 @@ class AMClient(object):
         return {"Authorization": "ApiKey {0}:{1}".format(self.ss_user_name,
                                                          self.ss_api_key)}
 
-    def hide_unit(self, unit_uuid, unit_type):
-        """GET <unit_type>/<unit_uuid>/delete/."""
-        return utils._call_url_json(
-            '{}/api/{}/{}/delete/'.format(self.am_url, unit_type, unit_uuid),
-            params=self._am_auth(),
-            method=utils.METHOD_DELETE
-        )
+    def hide_unit(self, unit_uuid, unit_type, timeout=None):
+        """GET <unit_type>/<unit_uuid>/delete/.
+
+        With a ``timeout``, the request is abandoned if the server does not
+        answer within that many seconds, raising a requests Timeout, and an
+        error response is returned as its status code.
+        """
+        url = '{}/api/{}/{}/delete/'.format(self.am_url, unit_type, unit_uuid)
+        if timeout is None:
+            return utils._call_url_json(
+                url,
+                params=self._am_auth(),
+                method=utils.METHOD_DELETE
+            )
+        response = (self.session or requests).delete(
+            url, params=self._am_auth(), timeout=timeout)
+        if not response.ok:
+            return response.status_code
+        try:
+            return response.json()
+        except ValueError:
+            return response.status_code
 
     def close_completed_transfers(self):
         """Close all completed transfers::
@@ -191,7 +363,13 @@ class AMClient(object):
         return self._close_completed_units('ingest')
 
     def _close_completed_units(self, unit_type):
-        """Close all completed transfers/ingests.  """
+        """Close all completed transfers/ingests, or the first
+        ``close_limit`` of them, with ``close_workers`` concurrent requests.
+
+        Each request times out after ``close_timeout`` seconds without an
+        answer. Its unit may have been closed anyway, so it is reported as
+        ``close_unknown`` rather than ``close_failed``.
+        """
         try:
             _completed_units = getattr(
                 self, 'completed_{0}s'.format(unit_type))().get('results')
@@ -202,17 +380,40 @@ class AMClient(object):
             msg = ('Something went wrong when attempting to retrieve the'
                    ' completed {0}s.'.format(unit_type))
             LOGGER.warning(msg)
-        else:
-            for unit_uuid in _completed_units:
+            return ret
+        if self.close_limit:
+            _completed_units = _completed_units[:int(self.close_limit)]
+        pool = ThreadPool(max(int(self.close_workers), 1))
+        try:
+            requests_ = [
+                (unit_uuid,
+                 pool.apply_async(self.hide_unit, (unit_uuid, unit_type),
+                                  {'timeout': self.close_timeout or None}))
+                for unit_uuid in _completed_units]
+            for unit_uuid, request in requests_:
                 ret['completed_{0}s'.format(unit_type)].append(unit_uuid)
-                response = self.hide_unit(unit_uuid, unit_type)
-                if isinstance(response, int):
+                try:
+                    response = request.get()
+                except requests.exceptions.Timeout as err:
+                    ret['close_unknown'].append(unit_uuid)
+                    LOGGER.warning('Timed out closing %s %s, it may be'
+                                   ' closed or not: %r',
+                                   unit_type, unit_uuid, err)
+                    continue
+                except Exception as err:
+                    LOGGER.warning('FAILED to close %s %s: %r',
+                                   unit_type, unit_uuid, err)
+                    response = None
+                if response is None or isinstance(response, int):
                     ret['close_failed'].append(unit_uuid)
                     LOGGER.warning('FAILED to close %s %s.',
                                    unit_type, unit_uuid)
                 else:
                     ret['close_succeeded'].append(unit_uuid)
                     LOGGER.info('Closed %s %s.', unit_type, unit_uuid)
+        finally:
+            pool.close()
+            pool.join()
         return ret
 
     def completed_transfers(self):
@@ -246,7 +447,9 @@ class AMClient(object):
             '{}/api/transfer/unapproved'.format(self.am_url), self._am_auth())
 
     def transferables(self, b64decode=True):
-        """Return all transferable entities in the Storage Service.
+        """Return all transferable entities in the Storage Service, or the
+        page of them set with ``browse_pattern``, ``browse_offset`` and
+        ``browse_limit``.
 
         GET location/<TS_LOC_UUID>/browse/::
 
@@ -263,7 +466,9 @@ class AMClient(object):
             params['path'] = base64.b64encode(self.transfer_path)
         result = utils._call_url_json(url, params)
         if b64decode:
-            return b64decode_ts_location_browse(result)
+            return b64decode_ts_location_browse(
+                result, limit=self.browse_limit, offset=self.browse_offset,
+                pattern=self.browse_pattern)
         return result
 
     def get_package(self, params=None):
@@ -301,22 +506,91 @@ class AMClient(object):
             final_params.update(params)
         return self.get_all_packages(final_params)
 
+    def iter_aips(self, params=None):
+        """Yield the AIPs one by one as the pages arrive, see ``aips``."""
+        final_params = {'package_type': 'AIP'}
+        if params:
+            final_params.update(params)
+        return self.query_packages(final_params)
+
+    def iter_dips(self, params=None):
+        """Yield the DIPs one by one as the pages arrive, see ``dips``."""
+        final_params = {'package_type': 'DIP'}
+        if params:
+            final_params.update(params)
+        return self.query_packages(final_params)
+
+    def iter_package_pages(self, params=None, next_=None):
+        """Yield the lists of packages (AIPs or DIPs) in the Storage Service
+        page by page, following the pagination trail.
+
+        The next page is requested in a background thread while the current
+        one is being consumed. Pages hold ``package_page_size`` packages.
+        """
+        final_params = {'limit': self.package_page_size}
+        if params:
+            final_params.update(params)
+
+        def fetch(next_path):
+            if next_path:
+                return self.get_next_package_page(next_path)
+            return self.get_package(final_params)
+
+        pool = ThreadPool(1)
+        try:
+            pending = pool.apply_async(fetch, (next_,))
+            while pending is not None:
+                response = pending.get()
+                if not response:
+                    raise Exception('Error connecting to the SS')
+                next_ = response['meta']['next']
+                pending = pool.apply_async(fetch, (next_,)) if next_ else None
+                yield response['objects']
+        finally:
+            # Also stops prefetching if the caller does not exhaust the pages
+            pool.terminate()
+
+    def iter_packages(self, params=None, next_=None):
+        """Yield all packages (AIPs or DIPs) in the Storage Service one by
+        one, see ``iter_package_pages``.
+        """
+        for page in self.iter_package_pages(params, next_):
+            for package in page:
+                yield package
+
+    def sync_package_mirror(self, force=False):
+        """Sync the local package mirror with the Storage Service if it is
+        older than ``package_mirror_max_age`` seconds, or if force is True.
+
+        Returns the mirror, or None if ``package_mirror`` is not set.
+        """
+        if not self.package_mirror:
+            return None
+        mirror = package_mirror.PackageMirror(self.package_mirror,
+                                              self.ss_url)
+        if force or not mirror.is_fresh(self.package_mirror_max_age):
+            mirror.sync(self.iter_packages())
+        return mirror
+
+    def query_packages(self, params=None):
+        """Yield the packages matching params, from the local package mirror
+        if one is configured and can answer the query, otherwise from the
+        Storage Service.
+        """
+        if self.package_mirror and package_mirror.PackageMirror.can_answer(
+                params):
+            return self.sync_package_mirror().iter_packages(params)
+        return self.iter_packages(params)
+
     def get_all_packages(self, params=None, packages=None, next_=None):
         """Get all packages (AIPs or DIPs) in the Storage Service, following
         the pagination trail if necessary.
         """
-        if not packages:
-            packages = []
+        packages = list(packages) if packages else []
         if next_:
-            response = self.get_next_package_page(next_)
+            packages.extend(self.iter_packages(params, next_))
         else:
-            response = self.get_package(params)
-        if not response:
-            raise Exception('Error connecting to the SS')
-        packages = packages + response['objects']
-        if response['meta']['next']:
-            packages = self.get_all_packages(
-                params, packages, response['meta']['next'])
+            packages.extend(self.query_packages(params))
         return packages
 
     def get_all_compressed_aips(self):
@@ -327,7 +601,7 @@ class AMClient(object):
         aips.values().
         """
         compressed_aips = {}
-        for aip in self.aips():
+        for aip in self.query_packages({'package_type': 'AIP'}):
             if aip['status'] == u"UPLOADED":
                 path = aip["current_full_path"]
                 compressed = self.find_compressed(path)
@@ -352,6 +626,37 @@ class AMClient(object):
         LOGGER.warning("Status of AIP compression is unconfirmed")
         return None
 
+    def dip_index(self):
+        """Get a dict mapping AIP UUIDs to the DIPs created from them.
+
+        The index is built from one listing of all DIPs. If
+        ``dip_index_cache`` is set, it is stored in that file and reused for
+        ``dip_index_max_age`` seconds instead of listing the DIPs again.
+        """
+        cache = self.dip_index_cache
+        if cache and os.path.isfile(cache):
+            try:
+                with open(cache) as file_:
+                    cached = json.load(file_)
+                if (cached['ss_url'] == self.ss_url and
+                        time.time() - cached['created'] <
+                        self.dip_index_max_age):
+                    LOGGER.debug('Using DIP index cache %s', cache)
+                    return cached['index']
+            except (IOError, ValueError, KeyError, TypeError):
+                LOGGER.warning('Ignoring unreadable DIP index cache %s', cache)
+        index = build_dip_index(self.query_packages({'package_type': 'DIP'}))
+        if cache:
+            tmp_cache = '{}.{}.tmp'.format(cache, os.getpid())
+            try:
+                with open(tmp_cache, 'w') as file_:
+                    json.dump({'ss_url': self.ss_url, 'created': time.time(),
+                               'index': index}, file_)
+                os.rename(tmp_cache, cache)
+            except (IOError, OSError):
+                LOGGER.warning('Unable to write DIP index cache %s', cache)
+        return index
+
     def aip2dips(self):
         """Get all DIPS created from AIP with UUID ``self.aip_uuid``.
 
@@ -360,46 +665,145 @@ class AMClient(object):
         tastypie's filters. That is, the current SS API does not allow a filter
         like 'current_path__endswith': self.aip_uuid nor does the
         related_packages m2m resource attribute appear to be useful in this
-        area. Please inform if this is inaccurate.
+        area. Please inform if this is inaccurate. Set ``dip_index_cache``
+        to avoid listing all DIPs on every call.
         """
-        _dips = self.dips()
-        return [d for d in _dips if
-                d['current_path'].endswith(self.aip_uuid)]
+        return list(self.dip_index().get(self.aip_uuid, []))
 
     def aips2dips(self):
         """Get all AIP UUIDs and map them to their DIP UUIDs, if any."""
-        _dips = self.dips()
-        return {a['uuid']: [d['uuid'] for d in _dips
-                            if d['current_path'].endswith(a['uuid'])]
-                for a in self.aips()}
-
-    def download_package(self, uuid):
-        """Download the package from SS by UUID."""
+        mapping = {}
+        for item in self.iter_aips2dips():
+            mapping.update(item)
+        return mapping
+
+    def iter_aips2dips(self):
+        """Yield a ``{aip_uuid: [dip_uuids]}`` dict per AIP, see
+        ``aips2dips``.
+        """
+        index = self.dip_index()
+        for aip in self.iter_aips():
+            yield {aip['uuid']: [d['uuid'] for d in index.get(aip['uuid'], [])]}
+
+    def _download_directory(self):
+        """Directory packages are downloaded to, the current one by default."""
+        dir_ = getattr(self, 'directory', None)
+        if not dir_:
+            return os.getcwd()
+        if not os.path.isdir(dir_):
+            LOGGER.warning('There is no directory %s; saving to %s instead',
+                           dir_, os.getcwd())
+            return os.getcwd()
+        return dir_
+
+    def download_package(self, uuid, checksum=None, checksum_algorithm=None,
+                         progress=None):
+        """Download the package from SS by UUID.
+
+        The package is streamed to a partial file in the download directory,
+        named after the UUID, and renamed to its final name once complete.
+        If a partial file is left over by an interrupted download, only the
+        missing bytes are requested with an HTTP Range header.
+
+        :param str uuid: UUID of the package
+        :param str checksum: Optional expected hex digest of the package
+        :param str checksum_algorithm: hashlib algorithm of checksum,
+            ``download_checksum_algorithm`` by default
+        :param progress: Optional callable, called after each chunk with the
+            package UUID, the bytes downloaded so far, the total size or
+            None if unknown, and the seconds elapsed
+        :returns: Path to the downloaded package, or None on failure
+        """
         url = '{}/api/v2/file/{}/download/'.format(self.ss_url, uuid)
-        response = requests.get(url, params=self._ss_auth(), stream=True)
+        dir_ = self._download_directory()
+        part_filename = os.path.join(dir_, '.{}.part'.format(uuid))
+        offset = 0
+        if self.download_resume and os.path.isfile(part_filename):
+            offset = os.path.getsize(part_filename)
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        http = self.session or requests
+        response = http.get(url, params=self._ss_auth(), headers=headers,
+                            stream=True)
+        if response.status_code == 416:
+            # The partial file cannot be resumed, e.g. the package changed
+            LOGGER.warning('Unable to resume download of package %s; starting'
+                           ' over', uuid)
+            response.close()
+            offset = 0
+            response = http.get(url, params=self._ss_auth(), stream=True)
         if response.status_code == 200:
-            try:
-                local_filename = re.findall(
-                    'filename="(.+)"',
-                    response.headers['content-disposition'])[0]
-            except KeyError:
-                # NOTE: assuming that packages are always stored as .7z
-                local_filename = 'package-{}.7z'.format(uuid)
-            if getattr(self, 'directory', None):
-                dir_ = self.directory
-                if os.path.isdir(dir_):
-                    local_filename = os.path.join(dir_, local_filename)
-                else:
-                    LOGGER.warning(
-                        'There is no directory %s; saving %s to %s instead',
-                        dir_, local_filename, os.getcwd())
-            with open(local_filename, 'wb') as file_:
-                for chunk in response.iter_content(chunk_size=1024):
-                    if chunk:
-                        file_.write(chunk)
-            return local_filename
-        else:
+            # The server sends the whole package, with or without a Range
+            offset = 0
+        elif response.status_code != 206:
             LOGGER.warning('Unable to download package %s', uuid)
+            return None
+        elif not response.headers.get('content-range', '').startswith(
+                'bytes {}-'.format(offset)):
+            LOGGER.warning('Unexpected range %s resuming download of package'
+                           ' %s at byte %s',
+                           response.headers.get('content-range'), uuid, offset)
+            response.close()
+            return None
+        try:
+            local_filename = re.findall(
+                'filename="(.+)"',
+                response.headers['content-disposition'])[0]
+        except KeyError:
+            # NOTE: assuming that packages are always stored as .7z
+            local_filename = 'package-{}.7z'.format(uuid)
+        local_filename = os.path.join(dir_, local_filename)
+        total = response.headers.get('content-length')
+        total = int(total) + offset if total else None
+
+        hash_ = None
+        if checksum:
+            hash_ = hashlib.new(
+                checksum_algorithm or self.download_checksum_algorithm)
+        if offset:
+            LOGGER.info('Resuming download of package %s at byte %s',
+                        uuid, offset)
+            if hash_:
+                with open(part_filename, 'rb') as file_:
+                    for chunk in iter(
+                            lambda: file_.read(self.download_chunk_size),
+                            b''):
+                        hash_.update(chunk)
+        done = offset
+        start = time.time()
+        try:
+            with open(part_filename, 'ab' if offset else 'wb') as file_:
+                for chunk in response.iter_content(
+                        chunk_size=self.download_chunk_size):
+                    if not chunk:
+                        continue
+                    file_.write(chunk)
+                    if hash_:
+                        hash_.update(chunk)
+                    done += len(chunk)
+                    if progress:
+                        progress(uuid, done, total, time.time() - start)
+        except (requests.exceptions.RequestException, IOError) as err:
+            LOGGER.warning('Download of package %s interrupted after %s'
+                           ' bytes, it will resume from there: %s',
+                           uuid, done, err)
+            return None
+        finally:
+            response.close()
+        if total is not None and done != total:
+            LOGGER.warning('Download of package %s incomplete: %s of %s'
+                           ' bytes', uuid, done, total)
+            return None
+        if hash_ and hash_.hexdigest() != checksum.lower():
+            LOGGER.error('Checksum mismatch for package %s: expected %s,'
+                         ' got %s', uuid, checksum, hash_.hexdigest())
+            os.remove(part_filename)
+            return None
+        os.rename(part_filename, local_filename)
+        elapsed = time.time() - start
+        LOGGER.info('Downloaded package %s to %s: %s bytes in %.1f s'
+                    ' (%.1f MB/s)', uuid, local_filename, done - offset,
+                    elapsed, (done - offset) / 1e6 / max(elapsed, 1e-6))
+        return local_filename
 
     def get_pipelines(self):
         """GET Archivematica Pipelines (dashboard instances from the storage
@@ -496,6 +900,151 @@ class AMClient(object):
     def download_aip(self):
         return self.download_package(self.aip_uuid)
 
+    def _batch_packages(self):
+        """Yield the SS package dicts to download in a batch: the packages
+        in ``batch_uuids`` and ``batch_uuids_file`` if any, otherwise all the
+        uploaded packages of type ``batch_package_type``.
+        """
+        uuids = self.batch_uuids or []
+        if hasattr(uuids, 'split'):
+            uuids = uuids.replace(',', ' ').split()
+        uuids = list(uuids)
+        if self.batch_uuids_file:
+            with open(self.batch_uuids_file) as file_:
+                uuids.extend(line.strip() for line in file_ if line.strip())
+        if not uuids:
+            if not self.batch_package_type:
+                return
+            for package in self.query_packages(
+                    {'package_type': self.batch_package_type,
+                     'status': 'UPLOADED'}):
+                yield package
+            return
+        for uuid in uuids:
+            package = next(iter(self.query_packages({'uuid': uuid})), None)
+            yield package or {'uuid': uuid}
+
+    def _read_manifest(self, manifest):
+        """Map the UUIDs of the packages downloaded according to a batch
+        manifest to their latest result.
+        """
+        downloaded = {}
+        if not os.path.isfile(manifest):
+            return downloaded
+        with open(manifest) as file_:
+            for line in file_:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue  # Line cut short by an interrupted batch
+                if result.get('status') in ('downloaded', 'skipped'):
+                    downloaded[result['uuid']] = result
+        return downloaded
+
+    def download_packages(self):
+        """Download a batch of packages with ``batch_workers`` concurrent
+        downloads.
+
+        A package is skipped if the manifest of a previous batch records it
+        as downloaded and the file is still there with the size it had once
+        downloaded, which download_package checked against the Content-Length
+        of the response. The size reported by the SS is not used for this, as
+        DIPs and uncompressed AIPs are streamed as tar files. The packages
+        that would make the batch exceed ``batch_max_bytes`` are not
+        downloaded, unless failed downloads give back enough of the budget.
+        The result of each package is appended to the JSON lines manifest
+        ``batch_manifest``, by default download-manifest.jsonl in the
+        download directory.
+
+        :returns: Dict with the number of packages per result status
+        """
+        manifest = self.batch_manifest or os.path.join(
+            self._download_directory(), 'download-manifest.jsonl')
+        previous = self._read_manifest(manifest)
+        budget = int(self.batch_max_bytes or 0)
+        reserved = [0]
+        lock = threading.Lock()
+
+        def check(package):
+            """Return the result of a package which is not to be downloaded,
+            or None."""
+            uuid = package['uuid']
+            size = package.get('size')
+            result = {'uuid': uuid, 'size': size}
+            if 'package_type' not in package:
+                result.update(status='not_found')
+                return result
+            done = previous.get(uuid)
+            # Manifests of older batches only recorded the SS size
+            done_bytes = done and done.get('bytes', done.get('size'))
+            if (done and done_bytes is not None and
+                    os.path.isfile(done['path']) and
+                    os.path.getsize(done['path']) == done_bytes):
+                result.update(status='skipped', path=done['path'],
+                              bytes=done_bytes)
+                return result
+            if budget and size is not None:
+                with lock:
+                    if reserved[0] + size > budget:
+                        result.update(status='over_budget')
+                        return result
+                    reserved[0] += size
+            return None
+
+        def download(package):
+            start = time.time()
+            path = self.download_package(package['uuid'])
+            result = {'uuid': package['uuid'], 'size': package.get('size'),
+                      'path': path, 'seconds': round(time.time() - start, 3)}
+            if path is None:
+                result['status'] = 'failed'
+                if budget and package.get('size') is not None:
+                    with lock:
+                        reserved[0] -= package['size']
+            else:
+                result.update(status='downloaded',
+                              bytes=os.path.getsize(path))
+            return result
+
+        def results(pool):
+            to_download = []
+            over_budget = []
+            for package in self._batch_packages():
+                result = check(package)
+                if result is None:
+                    to_download.append(package)
+                elif result['status'] == 'over_budget':
+                    over_budget.append(package)
+                else:
+                    yield result
+            for result in pool.imap_unordered(download, to_download):
+                yield result
+            # Try again the packages over budget, with the budget given back
+            # by the failed downloads
+            to_download = []
+            for package in over_budget:
+                result = check(package)
+                if result is None:
+                    to_download.append(package)
+                else:
+                    yield result
+            for result in pool.imap_unordered(download, to_download):
+                yield result
+
+        summary = defaultdict(int)
+        pool = ThreadPool(max(int(self.batch_workers), 1))
+        try:
+            with open(manifest, 'a') as file_:
+                for result in results(pool):
+                    file_.write(json.dumps(result) + '\n')
+                    file_.flush()
+                    summary[result['status']] += 1
+                    LOGGER.info('Package %s: %s', result['uuid'],
+                                result['status'])
+        finally:
+            pool.terminate()
+        return dict(summary)
+
 
 def main():
 
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Asyncio Archivematica Client.
+
+Coroutine counterpart of ``amclient.AMClient`` for tools that track many
+units or packages at once, e.g.::
+
+    async with AsyncAMClient(am_url=..., am_user_name=..., am_api_key=...,
+                             workers=32) as client:
+        statuses = await client.get_transfer_statuses(transfer_uuids)
+
+The requests run in a thread pool executor of the standard library event
+loop, over one ``requests.Session`` whose connection pool is sized to the
+executor, so concurrent calls reuse their connections. ``run`` executes a
+coroutine from synchronous code; the CLI keeps using ``AMClient``.
+
+Python 3.6+ only.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from transfers import amclient, utils
+
+LOGGER = logging.getLogger('transfers')
+
+
+def run(coro):
+    """Run a coroutine to completion on a new event loop and return its
+    result, for synchronous callers.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class AsyncAMClient(object):
+
+    # Concurrent requests, and connections kept in the pool per host
+    workers = 16
+    # Seconds to wait for the server to send data
+    timeout = 60
+
+    def __init__(self, workers=None, timeout=None, **kwargs):
+        """Construct an asyncio Archivematica client.
+
+        :param int workers: Number of concurrent requests
+        :param timeout: Seconds to wait for the server to send data
+        :param kwargs: Arguments of ``amclient.AMClient``; the per-call
+            arguments (unit and package UUIDs...) are passed to the methods
+            instead
+        """
+        if workers:
+            self.workers = workers
+        if timeout:
+            self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.client = amclient.AMClient(session=self.session, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def _run(self, func, *args, **kwargs):
+        """Run a blocking call in the executor."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    def _call_json(self, url, method='GET', params=None, data=None,
+                   headers=None):
+        """Blocking request expecting JSON, made with the pooled session.
+
+        :returns: Dict of the returned JSON or None
+        """
+        LOGGER.debug('URL: %s; params: %s; method: %s', url, params, method)
+        try:
+            response = self.session.request(
+                method, url, params=params, data=data, headers=headers,
+                timeout=self.timeout)
+        except requests.exceptions.RequestException as err:
+            LOGGER.warning('Request to %s failed: %s', url, err)
+            return None
+        if not response.ok:
+            LOGGER.warning('Request to %s returned %s %s', url,
+                           response.status_code, response.reason)
+            LOGGER.debug('Response: %s', response.text)
+            return None
+        try:
+            return response.json()
+        except ValueError:  # JSON could not be decoded
+            LOGGER.warning('Could not parse JSON from response: %s',
+                           response.text)
+            return None
+
+    async def _json(self, *args, **kwargs):
+        return await self._run(self._call_json, *args, **kwargs)
+
+    # Archivematica
+
+    async def get_transfer_status(self, transfer_uuid):
+        """GET the status of a transfer."""
+        return await self._json(
+            '{0}/api/transfer/status/{1}/'.format(self.client.am_url,
+                                                  transfer_uuid),
+            headers=self.client._am_auth_headers())
+
+    async def get_ingest_status(self, sip_uuid):
+        """GET the status of an ingest."""
+        return await self._json(
+            '{0}/api/ingest/status/{1}/'.format(self.client.am_url, sip_uuid),
+            headers=self.client._am_auth_headers())
+
+    async def get_transfer_statuses(self, transfer_uuids):
+        """GET the statuses of many transfers concurrently, in order."""
+        return await asyncio.gather(
+            *[self.get_transfer_status(uuid) for uuid in transfer_uuids])
+
+    async def get_ingest_statuses(self, sip_uuids):
+        """GET the statuses of many ingests concurrently, in order."""
+        return await asyncio.gather(
+            *[self.get_ingest_status(uuid) for uuid in sip_uuids])
+
+    async def completed_transfers(self):
+        return await self._json(
+            '{}/api/transfer/completed'.format(self.client.am_url),
+            params=self.client._am_auth())
+
+    async def completed_ingests(self):
+        return await self._json(
+            '{}/api/ingest/completed'.format(self.client.am_url),
+            params=self.client._am_auth())
+
+    async def unapproved_transfers(self):
+        return await self._json(
+            '{}/api/transfer/unapproved'.format(self.client.am_url),
+            params=self.client._am_auth())
+
+    async def hide_unit(self, unit_uuid, unit_type):
+        """DELETE <unit_type>/<unit_uuid>/delete/."""
+        return await self._json(
+            '{}/api/{}/{}/delete/'.format(self.client.am_url, unit_type,
+                                          unit_uuid),
+            method='DELETE', params=self.client._am_auth())
+
+    async def approve_transfer(self, directory, transfer_type=None):
+        """Approve a transfer, see ``AMClient.approve_transfer``."""
+        data = {'type': transfer_type or self.client.transfer_type,
+                'directory': utils.fsencode(directory)}
+        return await self._json(
+            '{0}/api/transfer/approve/'.format(self.client.am_url),
+            method='POST', data=data,
+            headers=self.client._am_auth_headers())
+
+    # Storage Service
+
+    async def get_package(self, params=None):
+        """SS GET /api/v2/file/?<GET_PARAMS>."""
+        payload = self.client._ss_auth()
+        payload.update(params or {})
+        return await self._json(
+            '{}/api/v2/file/'.format(self.client.ss_url), params=payload)
+
+    async def iter_packages(self, params=None):
+        """Yield all packages matching params, following the pagination
+        trail. The next page is requested while the current one is consumed.
+        """
+        final_params = {'limit': self.client.package_page_size}
+        final_params.update(params or {})
+        pending = asyncio.ensure_future(self.get_package(final_params))
+        try:
+            while pending is not None:
+                response = await pending
+                if not response:
+                    raise Exception('Error connecting to the SS')
+                next_ = response['meta']['next']
+                pending = None
+                if next_:
+                    pending = asyncio.ensure_future(self._json(
+                        '{}{}'.format(self.client.ss_url, next_)))
+                for package in response['objects']:
+                    yield package
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def get_all_packages(self, params=None):
+        return [package async for package in self.iter_packages(params)]
+
+    async def aips(self, params=None):
+        final_params = {'package_type': 'AIP'}
+        final_params.update(params or {})
+        return await self.get_all_packages(final_params)
+
+    async def dips(self, params=None):
+        final_params = {'package_type': 'DIP'}
+        final_params.update(params or {})
+        return await self.get_all_packages(final_params)
+
+    async def get_package_details(self, package_uuid):
+        return await self._json(
+            '{0}/api/v2/file/{1}'.format(self.client.ss_url, package_uuid),
+            headers=self.client._ss_auth_headers())
+
+    async def reingest_aip(self, aip_uuid, pipeline_uuid,
+                           processing_config='default', reingest_type=None):
+        """Start the reingest of an AIP, see ``AMClient.reingest_aip``."""
+        params = {'pipeline': pipeline_uuid,
+                  'reingest_type': reingest_type or self.client.reingest_type,
+                  'processing_config': processing_config}
+        return await self._json(
+            '{0}/api/v2/file/{1}/reingest/'.format(self.client.ss_url,
+                                                   aip_uuid),
+            method='POST', data=json.dumps(params),
+            headers=self.client._ss_auth_headers())
+
+    async def download_package(self, uuid, **kwargs):
+        """Download a package, see ``AMClient.download_package`` for the
+        arguments.
+        """
+        return await self._run(self.client.download_package, uuid, **kwargs)
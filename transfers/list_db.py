@@ -1,13 +1,23 @@
 #!/usr/bin/env python
 #
 # List the contents of the database.
+#
+# Rows are streamed from the database in batches, so the listing uses constant
+# memory regardless of the size of the database. Output can be the unit repr
+# (default), JSON lines or CSV, optionally filtered, or a count summary.
 
 from __future__ import print_function, unicode_literals
 
+import csv
+import datetime
+import json
 import logging
 import os
 import sys
 
+import six
+from sqlalchemy import func
+
 import utils, models
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -16,16 +26,188 @@ sys.path.append(THIS_DIR)
 LOG_NAME = 'list_db'
 LOGGER = logging.getLogger(LOG_NAME)
 
-def main(config_file=None, log_level='INFO', **kwargs):
+COUNT_FIELDS = ('unit_type', 'status', 'current', 'count')
+FIELDS = ('id', 'uuid', 'path', 'unit_type', 'status', 'microservice', 'current', 'created', 'updated')
+OUTPUT_FORMATS = ('repr', 'jsonl', 'csv')
+BATCH_SIZE = 1000
+
+
+def parse_date(value):
+    """Parse a YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS command line date."""
+    for date_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date: {}'.format(value))
+
+
+def parse_bool(value):
+    """Parse a true/false command line value."""
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise ValueError('Invalid boolean: {}'.format(value))
+
+
+def filter_units(query, status=None, unit_type=None, current=None, path_prefix=None, since=None, until=None):
+    """
+    Apply the optional filters to a query on models.Unit.
+
+    :param query: SQLAlchemy query on models.Unit
+    :param str status: Only units with this status
+    :param str unit_type: Only units of this type, 'ingest' or 'transfer'
+    :param bool current: Only units with this current flag
+    :param bytes path_prefix: Only units whose path starts with this prefix
+    :param datetime since: Only units updated on or after this date
+    :param datetime until: Only units updated before this date
+    :returns: Filtered query
+    """
+    if status is not None:
+        query = query.filter(models.Unit.status == status)
+    if unit_type is not None:
+        query = query.filter(models.Unit.unit_type == unit_type)
+    if current is not None:
+        query = query.filter(models.Unit.current == current)
+    if path_prefix:
+        # Paths are binary, compare on the prefix instead of using LIKE
+        path_prefix = utils.fsencode(path_prefix)
+        query = query.filter(func.substr(models.Unit.path, 1, len(path_prefix)) == path_prefix)
+    if since is not None:
+        query = query.filter(models.Unit.updated >= since)
+    if until is not None:
+        query = query.filter(models.Unit.updated < until)
+    return query
+
+
+def stream_units(session, batch_size=BATCH_SIZE, **filters):
+    """
+    Yield the units matching filters, fetching batch_size rows at a time.
+
+    :param session: SQLAlchemy session with the DB
+    :param int batch_size: Number of rows fetched per round trip
+    :param filters: Keyword arguments for filter_units
+    """
+    query = filter_units(session.query(models.Unit), **filters)
+    return query.order_by(models.Unit.id).yield_per(batch_size)
+
+
+def count_units(session, **filters):
+    """
+    Count the units matching filters, grouped by type, status and current flag.
+
+    :param session: SQLAlchemy session with the DB
+    :param filters: Keyword arguments for filter_units
+    :returns: List of dicts with unit_type, status, current and count
+    """
+    columns = (models.Unit.unit_type, models.Unit.status, models.Unit.current)
+    query = filter_units(session.query(*(columns + (func.count(models.Unit.id),))), **filters)
+    return [
+        {'unit_type': unit_type, 'status': status, 'current': current, 'count': count}
+        for unit_type, status, current, count in query.group_by(*columns).order_by(*columns)
+    ]
+
+
+def unit_to_dict(unit):
+    """Return a JSON serializable dict with the FIELDS of a unit."""
+    record = {field: getattr(unit, field) for field in FIELDS}
+    if record['path'] is not None:
+        record['path'] = utils.fsdecode(record['path'])
+    for field in ('created', 'updated'):
+        if record[field] is not None:
+            record[field] = record[field].isoformat()
+    return record
+
+
+def _csv_row(values):
+    """Python 2's csv module only writes bytes."""
+    if six.PY2:
+        return [v.encode('utf8') if isinstance(v, six.text_type) else v for v in values]
+    return values
+
+
+def write_units(units, output_format, out=None):
+    """
+    Write units to out, one per line, as they are read.
+
+    :param units: Iterable of models.Unit
+    :param str output_format: One of OUTPUT_FORMATS
+    :param out: File-like object. Default: stdout
+    :returns: Number of units written
+    """
+    out = out or sys.stdout
+    writer = None
+    if output_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(_csv_row(FIELDS))
+    written = 0
+    for unit in units:
+        if output_format == 'jsonl':
+            print(json.dumps(unit_to_dict(unit), sort_keys=True), file=out)
+        elif output_format == 'csv':
+            record = unit_to_dict(unit)
+            writer.writerow(_csv_row([record[field] for field in FIELDS]))
+        else:
+            print(unit, file=out)
+        written += 1
+    return written
+
+
+def write_counts(rows, output_format, out=None):
+    """
+    Write the rows of count_units to out, one per line.
+
+    :param rows: List of dicts from count_units
+    :param str output_format: One of OUTPUT_FORMATS
+    :param out: File-like object. Default: stdout
+    """
+    out = out or sys.stdout
+    if output_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(_csv_row(COUNT_FIELDS))
+    for row in rows:
+        if output_format == 'jsonl':
+            print(json.dumps(row, sort_keys=True), file=out)
+        elif output_format == 'csv':
+            writer.writerow(_csv_row([row[field] for field in COUNT_FIELDS]))
+        else:
+            print('{unit_type}\t{status}\t{current}\t{count}'.format(**row), file=out)
+
+
+def add_arguments(parser):
+    parser.add_argument('--status', help='Only list units with this status, e.g. COMPLETE, FAILED.')
+    parser.add_argument('--unit-type', choices=['ingest', 'transfer'], help='Only list units of this type.')
+    parser.add_argument('--current', type=parse_bool, metavar='BOOL', default=None,
+                        help='Only list units with this current flag (true or false).')
+    parser.add_argument('--path-prefix', help='Only list units whose path starts with this prefix.')
+    parser.add_argument('--since', type=parse_date, metavar='DATE',
+                        help='Only list units updated on or after DATE (YYYY-MM-DD[THH:MM:SS], UTC).')
+    parser.add_argument('--until', type=parse_date, metavar='DATE',
+                        help='Only list units updated before DATE (YYYY-MM-DD[THH:MM:SS], UTC).')
+    parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS, default='repr',
+                        help='Output format. Default: repr')
+    parser.add_argument('--count', action='store_true',
+                        help='Print the number of matching units per type, status and current flag instead.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Number of rows fetched from the database at a time. Default: {}'.format(BATCH_SIZE))
+
+
+def main(config_file=None, log_level='INFO', status=None, unit_type=None, current=None, path_prefix=None, since=None,
+         until=None, output_format='repr', count=False, batch_size=BATCH_SIZE, **kwargs):
     utils.setup(config_file, LOG_NAME, log_level)
     LOGGER.info("Database content")
 
     session = models.Session()
-    records = session.query(models.Unit).all()
-    for record in records:
-        print(record)
+    filters = dict(status=status, unit_type=unit_type, current=current, path_prefix=path_prefix, since=since,
+                   until=until)
+    if count:
+        write_counts(count_units(session, **filters), output_format)
+    else:
+        written = write_units(stream_units(session, batch_size, **filters), output_format)
+        LOGGER.info('Listed %s units', written)
 
     return 0  # always return a zero.
 
 if __name__ == '__main__':
-    utils.main(main)
+    utils.main(main, add_arguments)
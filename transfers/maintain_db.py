@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+#
+# Maintain the database.
+#
+# Refreshes the SQLite query planner statistics (ANALYZE), rebuilds the
+# database file to reclaim the space left by deleted units (VACUUM) and
+# truncates the write-ahead log. Run it from cron when the transfer scripts
+# are idle, VACUUM needs an exclusive lock for its whole duration.
+
+from __future__ import print_function, unicode_literals
+
+import logging
+import os
+import sys
+
+import utils, models
+
+THIS_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(THIS_DIR)
+
+LOG_NAME = 'maintain_db'
+LOGGER = logging.getLogger(LOG_NAME)
+
+
+def add_arguments(parser):
+    parser.add_argument('--no-analyze', dest='analyze', action='store_false', help='Do not run ANALYZE.')
+    parser.add_argument('--no-vacuum', dest='vacuum', action='store_false', help='Do not run VACUUM.')
+
+
+def main(config_file=None, log_level='INFO', analyze=True, vacuum=True, **kwargs):
+    utils.setup(config_file, LOG_NAME, log_level)
+    LOGGER.info('Database maintenance: analyze=%s, vacuum=%s', analyze, vacuum)
+
+    try:
+        models.maintain(analyze=analyze, vacuum=vacuum)
+    except Exception:
+        LOGGER.error('Database maintenance failed', exc_info=True)
+        return 1
+
+    LOGGER.info('Database maintenance finished')
+    return 0
+
+
+if __name__ == '__main__':
+    utils.main(main, add_arguments)
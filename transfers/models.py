@@ -1,8 +1,11 @@
+from datetime import datetime
 from os.path import isfile
 
 from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import inspect
 from sqlalchemy import Sequence
-from sqlalchemy import Column, Binary, Boolean, Integer, String
+from sqlalchemy import Column, Binary, Boolean, DateTime, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -18,17 +21,102 @@ class Unit(Base):
     status = Column(String(20), nullable=True)
     microservice = Column(String(50))
     current = Column(Boolean(create_constraint=False))
+    created = Column(DateTime, default=datetime.utcnow)
+    updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return "<Unit(id={s.id}, uuid={s.uuid}, unit_type={s.unit_type}, path={s.path}, status={s.status}, current={s.current})>".format(s=self)
 
 
-def init(databasefile):
+class Folder(Base):
+    """An accession number whose upload folder was created by add_folder."""
+    __tablename__ = 'folder'
+    accession_number = Column(String(255), primary_key=True)
+    created = Column(DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<Folder(accession_number={s.accession_number}, created={s.created})>".format(s=self)
+
+
+class Deletion(Base):
+    """Progress of the deletion of an entry in the trash directory."""
+    __tablename__ = 'deletion'
+    name = Column(String(255), primary_key=True)
+    files = Column(Integer, default=0)
+    bytes = Column(Integer, default=0)
+    started = Column(DateTime, default=datetime.utcnow)
+    finished = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return "<Deletion(name={s.name}, files={s.files}, bytes={s.bytes}, started={s.started}, finished={s.finished})>".format(s=self)
+
+
+def _upgrade(engine):
+    """Add columns introduced after the database file was first created.
+
+    ``create_all`` only creates missing tables, so columns added to existing
+    models have to be added to old database files by hand.
+    """
+    existing = {c['name'] for c in inspect(engine).get_columns(Unit.__tablename__)}
+    for column in Unit.__table__.columns:
+        if column.name in existing:
+            continue
+        engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            Unit.__tablename__, column.name, column.type.compile(engine.dialect)))
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Use write-ahead logging so readers never block the writer and the other
+    way round. NORMAL synchronous is durable in WAL mode apart from the last
+    transactions before a power loss.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def init(databasefile, timeout=30):
+    """
+    Create the engine and Session factory for databasefile.
+
+    :param str databasefile: Path to the SQLite database file
+    :param float timeout: Seconds to wait for a lock held by another process
+        before failing with 'database is locked'
+    """
     if not isfile(databasefile):
         # We create the file
         with open(databasefile, "a"):
             pass
-    engine = create_engine('sqlite:///{}'.format(databasefile), echo=False)
+    global engine
+    engine = create_engine('sqlite:///{}'.format(databasefile), echo=False, connect_args={'timeout': timeout})
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
     global Session
     Session = sessionmaker(bind=engine)
     Base.metadata.create_all(engine)
+    _upgrade(engine)
+
+
+def maintain(analyze=True, vacuum=True):
+    """
+    Run database maintenance: refresh the query planner statistics, rebuild
+    the database file to reclaim free pages and truncate the WAL file.
+
+    :param bool analyze: Run ANALYZE
+    :param bool vacuum: Run VACUUM
+    """
+    connection = engine.raw_connection()
+    isolation_level = connection.connection.isolation_level
+    try:
+        # VACUUM cannot run inside a transaction
+        connection.connection.isolation_level = None
+        cursor = connection.cursor()
+        if analyze:
+            cursor.execute('ANALYZE')
+        if vacuum:
+            cursor.execute('VACUUM')
+        cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        cursor.close()
+    finally:
+        connection.connection.isolation_level = isolation_level
+        connection.close()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Local mirror of the Storage Service package list.
+
+Listing every package of a large Storage Service takes minutes, so AMClient
+can answer package queries from a SQLite copy of the list instead. The copy
+is synced when it is older than a freshness bound. The SS API v2 file
+resource has no filter on modification time, so a sync pages through the
+full list, but it only writes the packages whose content changed and removes
+the ones that are gone, which keeps it cheap next to the download itself.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import json
+import logging
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy import Column, Float, String, Text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+LOGGER = logging.getLogger('transfers')
+
+Base = declarative_base()
+
+# Query parameters the mirror can answer, mapped to Package columns
+FILTERS = {
+    'uuid': 'uuid',
+    'package_type': 'package_type',
+    'status': 'status',
+    'origin_pipeline': 'origin_pipeline',
+}
+BATCH_SIZE = 1000
+
+
+class Package(Base):
+    __tablename__ = 'package'
+    uuid = Column(String(36), primary_key=True)
+    package_type = Column(String(8), index=True)
+    status = Column(String(64), index=True)
+    origin_pipeline = Column(String(36), index=True)
+    digest = Column(String(40))
+    data = Column(Text)
+
+    def __repr__(self):
+        return "<Package(uuid={s.uuid}, package_type={s.package_type}, status={s.status}, origin_pipeline={s.origin_pipeline})>".format(s=self)
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    ss_url = Column(String(255), primary_key=True)
+    synced = Column(Float)
+
+
+def _pipeline_uuid(origin_pipeline):
+    """'/api/v2/pipeline/<uuid>/' -> '<uuid>'."""
+    if not origin_pipeline:
+        return None
+    return origin_pipeline.rstrip('/').rsplit('/', 1)[-1]
+
+
+def _digest(package):
+    return hashlib.sha1(json.dumps(package, sort_keys=True).encode('utf8')).hexdigest()
+
+
+class PackageMirror(object):
+    """SQLite mirror of the packages of one Storage Service."""
+
+    def __init__(self, path, ss_url):
+        self.ss_url = ss_url
+        engine = create_engine('sqlite:///{}'.format(path), echo=False)
+        Base.metadata.create_all(engine)
+        self.Session = sessionmaker(bind=engine)
+
+    def last_sync(self):
+        """Return the time of the last complete sync, or None."""
+        session = self.Session()
+        try:
+            state = session.query(SyncState).get(self.ss_url)
+            return state.synced if state else None
+        finally:
+            session.close()
+
+    def is_fresh(self, max_age):
+        synced = self.last_sync()
+        return synced is not None and time.time() - synced < max_age
+
+    def sync(self, packages):
+        """
+        Update the mirror from an iterable of SS package dicts covering all
+        packages.
+
+        :returns: Dict with the number of packages 'added', 'updated',
+            'deleted' and 'unchanged'
+        """
+        started = time.time()
+        session = self.Session()
+        summary = {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        try:
+            digests = dict(session.query(Package.uuid, Package.digest))
+            pending = 0
+            for package in packages:
+                uuid = package['uuid']
+                digest = _digest(package)
+                old_digest = digests.pop(uuid, None)
+                if old_digest == digest:
+                    summary['unchanged'] += 1
+                    continue
+                summary['updated' if old_digest else 'added'] += 1
+                session.merge(Package(
+                    uuid=uuid,
+                    package_type=package.get('package_type'),
+                    status=package.get('status'),
+                    origin_pipeline=_pipeline_uuid(package.get('origin_pipeline')),
+                    digest=digest,
+                    data=json.dumps(package)))
+                pending += 1
+                if pending >= BATCH_SIZE:
+                    session.flush()
+                    pending = 0
+            # What was not listed any more is gone from the SS
+            gone = list(digests)
+            for i in range(0, len(gone), BATCH_SIZE):
+                session.query(Package).filter(Package.uuid.in_(gone[i:i + BATCH_SIZE])).delete(
+                    synchronize_session=False)
+            summary['deleted'] = len(gone)
+            session.merge(SyncState(ss_url=self.ss_url, synced=started))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        LOGGER.info('Synced package mirror with %s: %s', self.ss_url, summary)
+        return summary
+
+    @staticmethod
+    def can_answer(params):
+        """Return True if all query params are filters the mirror supports."""
+        return all(key in FILTERS for key in (params or {}))
+
+    def iter_packages(self, params=None):
+        """Yield the SS package dicts matching params, see FILTERS."""
+        session = self.Session()
+        try:
+            query = session.query(Package.data)
+            for key, value in (params or {}).items():
+                if key == 'origin_pipeline':
+                    value = _pipeline_uuid(value)
+                query = query.filter(getattr(Package, FILTERS[key]) == value)
+            for (data,) in query.order_by(Package.uuid).yield_per(BATCH_SIZE):
+                yield json.loads(data)
+        finally:
+            session.close()
@@ -7,33 +7,23 @@ import datetime
 import argparse
 import subprocess
 import dateutil.parser
-from xml.etree import ElementTree
-
-fitsNS = "http://hul.harvard.edu/ois/xml/ns/fits/fits_output"
-mediaInfoNS = "https://mediaarea.net/mediainfo"
-metsNS = "http://www.loc.gov/METS/"
-premisNS = "info:lc/xmlns/premis-v2"
-premisV3NS = "http://www.loc.gov/premis/v3"
-xlinkNS = "http://www.w3.org/1999/xlink"
-systemNS = "http://ns.exiftool.ca/File/System/1.0/"
-
-fitsBNS = "{" + fitsNS + "}"
-mediaInfoBNS = "{" + mediaInfoNS + "}"
-metsBNS = "{" + metsNS + "}"
-premisBNS = "{" + premisNS + "}"
-premisV3BNS = "{" + premisV3NS + "}"
-xlinkBNS = "{" + xlinkNS + "}"
-systemBNS = "{" + systemNS + "}"
-
-NSMAP = {
-    'fits': fitsNS,
-    'mediainfo': mediaInfoNS,
-    'mets': metsNS,
-    'premis': premisNS,
-    'premisv3': premisV3NS,
-    'xlink': xlinkNS,
-    'System': systemNS,
-}
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from aips import mets_index  # noqa: E402
+
+ORIGINAL_NAME_PREFIXES = (
+    '%SIPDirectory%objects/',
+    '%SIPDirectory%data/',
+    '%transferDirectory%objects/',
+    '%transferDirectory%data/',
+)
+
+
+def strip_original_name(original_name):
+    for prefix in ORIGINAL_NAME_PREFIXES:
+        original_name = original_name.replace(prefix, '')
+    return original_name
 
 
 class AipReverter:
@@ -45,79 +35,41 @@ class AipReverter:
                          filename.startswith("METS") and filename.endswith(".xml")][0]
         mets_path = os.path.join(self.__aip_location, mets_filename)
 
-        self.__tree = ElementTree.parse(mets_path)
-        self.__physical_structmap = self.__tree.find('mets:structMap[@TYPE="physical"]/mets:div/mets:div',
-                                                     namespaces=NSMAP)
+        # Compact table of the original files, read in one streaming pass
+        self.__index = mets_index.index_mets(mets_path)
 
     def revert_aip(self):
-        cur_node = self.__tree.find('mets:structMap[@TYPE="logical"]/mets:div/mets:div', namespaces=NSMAP)
-        self.__walk_tree(cur_node, [])
-
-    def __walk_tree(self, cur_node, parents):
-        for node in cur_node.findall('./mets:div', namespaces=NSMAP):
-            if node.get('TYPE') == 'Directory':
-                self.__restore_folder(node, parents)
-                updated_parents = list(parents) + [node.get('LABEL')]
-                self.__walk_tree(node, updated_parents)
-            else:
-                self.__restore_file(node, parents)
-
-    def __restore_folder(self, node, parents):
-        dmd_id = node.get('DMDID')
-        if not dmd_id:
-            label = node.get('LABEL')
-            dmd_id = self.__find_in_physical_structmap(parents) \
-                .find('./mets:div[@LABEL="' + label + '"]', namespaces=NSMAP) \
-                .get('DMDID')
-
-        if dmd_id:
-            new_folder = self.__tree \
-                .findtext('mets:dmdSec[@ID="' + dmd_id + '"]//premisv3:originalName', namespaces=NSMAP) \
-                .replace('%SIPDirectory%objects/', '') \
-                .replace('%SIPDirectory%data/', '') \
-                .replace('%transferDirectory%objects/', '') \
-                .replace('%transferDirectory%data/', '')
-            os.makedirs(os.path.join(self.__reverted_location, new_folder))
-
-    def __restore_file(self, node, parents):
-        label = node.get('LABEL')
-        file_id = self.__find_in_physical_structmap(parents) \
-            .find('./mets:div[@LABEL="' + label + '"]/mets:fptr', namespaces=NSMAP) \
-            .get('FILEID')
-
-        file_node = self.__tree.find('mets:fileSec/mets:fileGrp[@USE="original"]/mets:file[@ID="' + file_id + '"]',
-                                     namespaces=NSMAP)
-        if file_node is not None:
-            file_path = file_node.find('./mets:FLocat', namespaces=NSMAP).get(xlinkBNS + 'href')
-
-            amd_id = file_node.get('ADMID')
-            premis_node = self.__tree.find('mets:amdSec[@ID="' + amd_id + '"]/mets:techMD//premis:object',
-                                           namespaces=NSMAP)
-            new_file = premis_node \
-                .findtext('premis:originalName', namespaces=NSMAP) \
-                .replace('%transferDirectory%objects/', '') \
-                .replace('%transferDirectory%data/', '')
-
-            aip_file_path = os.path.join(self.__aip_location, file_path)
-            reverted_file_path = os.path.join(self.__reverted_location, new_file)
-            shutil.copyfile(aip_file_path, reverted_file_path)
-
-            object_characteristics = premis_node.find('premis:objectCharacteristics', namespaces=NSMAP)
-            dates = self.__find_access_and_modification_dates(object_characteristics, aip_file_path)
-            os.utime(reverted_file_path, dates)
-
-    def __find_access_and_modification_dates(self, object_characteristics, aip_file_path):
+        for directory in self.__index.directories:
+            self.__restore_folder(directory)
+        for original in self.__index.files:
+            self.__restore_file(original)
+
+    def __restore_folder(self, original_name):
+        new_folder = os.path.join(self.__reverted_location, strip_original_name(original_name))
+        if not os.path.isdir(new_folder):
+            os.makedirs(new_folder)
+
+    def __restore_file(self, original):
+        if not original.path or not original.original_name:
+            return
+        new_file = strip_original_name(original.original_name)
+
+        aip_file_path = os.path.join(self.__aip_location, original.path)
+        reverted_file_path = os.path.join(self.__reverted_location, new_file)
+        if not os.path.isdir(os.path.dirname(reverted_file_path)):
+            os.makedirs(os.path.dirname(reverted_file_path))
+        shutil.copyfile(aip_file_path, reverted_file_path)
+
+        dates = self.__find_access_and_modification_dates(original, aip_file_path)
+        os.utime(reverted_file_path, dates)
+
+    def __find_access_and_modification_dates(self, original, aip_file_path):
         access_date = None
         modify_date = None
 
         # First try the EXIF tool
-        exif_access_date = object_characteristics.findtext('.//System:FileAccessDate', namespaces=NSMAP)
-        if not exif_access_date:
-            exif_access_date = object_characteristics.findtext('.//FileAccessDate', namespaces=NSMAP)
-
-        exif_modify_date = object_characteristics.findtext('.//System:FileModifyDate', namespaces=NSMAP)
-        if not exif_modify_date:
-            exif_modify_date = object_characteristics.findtext('.//FileModifyDate', namespaces=NSMAP)
+        exif_access_date = original.exif_access_date
+        exif_modify_date = original.exif_modify_date
 
         # TODO: Dirty hack to make parsing easier
         if exif_access_date and exif_modify_date:
@@ -132,14 +84,14 @@ class AipReverter:
 
         # Then try the FITS tool
         if not modify_date:
-            fits_modify_date = object_characteristics.findtext('.//fits:fileinfo/fits:fslastmodified', namespaces=NSMAP)
+            fits_modify_date = original.fslastmodified
 
             if fits_modify_date:
                 modify_date = int(fits_modify_date) // 1000
 
         # Then try the MediaInfo tool
         if not modify_date:
-            mediainfo_modify_date = object_characteristics.findtext('.//mediainfo:File_Modified_Date', namespaces=NSMAP)
+            mediainfo_modify_date = original.mediainfo_modify_date
             if mediainfo_modify_date and mediainfo_modify_date.startswith('UTC'):
                 mediainfo_modify_date = mediainfo_modify_date.replace('UTC ', '') + ' UTC'
 
@@ -157,12 +109,6 @@ class AipReverter:
             modify_date if modify_date else file_modify_date
         )
 
-    def __find_in_physical_structmap(self, parents):
-        elem = self.__physical_structmap
-        for label in parents:
-            elem = elem.find('./mets:div[@LABEL="' + label + '"]', namespaces=NSMAP)
-        return elem
-
     @staticmethod
     def __print_dates(aip_file_path, modify_date, file_modify_date):
         if modify_date:
@@ -11,9 +11,11 @@ import logging
 import os
 import shutil
 import sys
+from multiprocessing.pool import ThreadPool
+
 import requests
 
-import utils, models
+import utils, models, trash
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(THIS_DIR)
@@ -21,6 +23,8 @@ sys.path.append(THIS_DIR)
 LOG_NAME = 'remove_folder'
 LOGGER = logging.getLogger(LOG_NAME)
 
+WORKERS = 4
+
 
 def get_source_location(ss_url, ss_user, ss_api_key, ts_location_uuid):
     """
@@ -60,16 +64,88 @@ def get_status(am_url, am_user, am_api_key, unit_uuid, hide_on_complete=False):
 
     # If complete, hide in dashboard
     if hide_on_complete and unit_info and unit_info['status'] == 'COMPLETE':
-        LOGGER.info('Hiding SIP %s in dashboard', unit_uuid)
-        url = am_url + '/api/ingest/' + unit_uuid + '/delete/'
-        LOGGER.debug('Method: DELETE; URL: %s; params: %s;', url, params)
-        response = requests.delete(url, params=params, verify=(utils.get_setting('ssl_verification', 'True')) == 'True')
-        LOGGER.debug('Response: %s', response)
+        hide_ingest(am_url, am_user, am_api_key, unit_uuid)
 
     return unit_info
 
 
-def remove_folder(directory, depth):
+def get_completed_ingests(am_url, am_user, am_api_key):
+    """
+    Get the UUIDs of all completed SIPs that are not hidden in the dashboard.
+
+    :returns: Set of SIP UUIDs or None if the request failed.
+    """
+    url = am_url + '/api/ingest/completed'
+    params = {'username': am_user, 'api_key': am_api_key}
+    completed = utils.call_url_json(url, params)
+    if completed is None or 'results' not in completed:
+        return None
+    return set(completed['results'])
+
+
+def hide_ingest(am_url, am_user, am_api_key, unit_uuid):
+    """
+    Hide the SIP with unit_uuid in the dashboard.
+
+    :returns: True if the request succeeded.
+    """
+    LOGGER.info('Hiding SIP %s in dashboard', unit_uuid)
+    url = am_url + '/api/ingest/' + unit_uuid + '/delete/'
+    params = {'username': am_user, 'api_key': am_api_key}
+    LOGGER.debug('Method: DELETE; URL: %s; params: %s;', url, params)
+    try:
+        response = requests.delete(url, params=params,
+                                   verify=(utils.get_setting('ssl_verification', 'True')) == 'True')
+    except requests.exceptions.RequestException:
+        LOGGER.warning('Unable to hide SIP %s', unit_uuid, exc_info=True)
+        return False
+    LOGGER.debug('Response: %s', response)
+    return response.ok
+
+
+def get_statuses(am_url, am_user, am_api_key, unit_uuids, pool):
+    """
+    Get the status of all the SIPs with unit_uuids.
+
+    SIPs in the completed ingests listing are COMPLETE without further
+    requests; only the others are queried one by one, concurrently.
+
+    :param list unit_uuids: UUIDs of the SIPs to query for.
+    :param pool: ThreadPool used for the individual status requests.
+    :returns: Dict of UUID to status. SIPs whose status could not be fetched
+        are left out.
+    """
+    if not unit_uuids:
+        return {}
+    completed = get_completed_ingests(am_url, am_user, am_api_key)
+    if completed is None:
+        LOGGER.warning('Could not fetch completed ingests, fetching the status of each SIP')
+        completed = set()
+    statuses = {unit_uuid: 'COMPLETE' for unit_uuid in unit_uuids if unit_uuid in completed}
+    remaining = [unit_uuid for unit_uuid in unit_uuids if unit_uuid not in completed]
+    LOGGER.info('%s of %s SIPs completed, fetching the status of %s', len(statuses), len(unit_uuids), len(remaining))
+
+    def status(unit_uuid):
+        return unit_uuid, get_status(am_url, am_user, am_api_key, unit_uuid)
+
+    for unit_uuid, status_info in pool.imap_unordered(status, remaining):
+        LOGGER.info('Status info for %s: %s', unit_uuid, status_info)
+        if not status_info:
+            LOGGER.error('Could not fetch status for %s.', unit_uuid)
+            continue
+        statuses[unit_uuid] = status_info.get('status')
+    return statuses
+
+
+def remove_folder(directory, depth, trash_dir=None):
+    """
+    Remove directory, by moving it to trash_dir if given.
+
+    Moving to the trash is a rename, the actual deletion is left to
+    trash.purge. If the rename fails, the directory is deleted right away.
+
+    :returns: True if the directory is gone from its location
+    """
     assert directory
     # Better be damned sure this is a path with a couple of separators
     separators = sum(1 for sep in directory if sep == '/')
@@ -78,6 +154,8 @@ def remove_folder(directory, depth):
         return False
 
     if os.path.exists(directory):
+        if trash_dir and trash.move_to_trash(directory, trash_dir):
+            return True
         try:
             LOGGER.info('Remove directory attempt %s', directory)
             shutil.rmtree(directory, ignore_errors=False)
@@ -90,13 +168,76 @@ def remove_folder(directory, depth):
         return True
 
 
+def trash_enabled():
+    """Whether completed packages are moved to the trash instead of deleted, off unless set in the config file."""
+    return utils.get_setting('trash', 'False') == 'True'
+
+
+def get_trash_dir(source_location):
+    """Trash directory from the config file, or the default one in the source location."""
+    default = trash.get_trash_dir(source_location) if source_location else None
+    return utils.get_setting('trash_directory', default)
+
+
+def empty_trash(session, source_location, workers=None, max_mb_per_second=None, max_files_per_second=None):
+    """
+    Delete the contents of the trash directory, under its own PID file so it
+    can run alongside the status checks. It works even if the trash is
+    disabled, to empty what was moved there before.
+    """
+    trash_dir = get_trash_dir(source_location)
+    if not trash_dir:
+        LOGGER.error('No trash directory configured')
+        return 1
+
+    default_pidfile = os.path.join(THIS_DIR, LOG_NAME + '-trash.pid.lck')
+    pid_file = utils.get_setting('trash_pidfile', default_pidfile)
+    if not utils.set_pid_file(pid_file):
+        return 0
+
+    if workers is None:
+        workers = int(utils.get_setting('trash_workers', trash.WORKERS))
+    if max_mb_per_second is None:
+        max_mb_per_second = float(utils.get_setting('trash_max_mb_per_second', 0))
+    if max_files_per_second is None:
+        max_files_per_second = float(utils.get_setting('trash_max_files_per_second', 0))
+
+    try:
+        summary = trash.purge(session, trash_dir, workers, max_mb_per_second * 1024 * 1024, max_files_per_second)
+        LOGGER.info('Emptied trash %s: %s entries deleted, %s failed', trash_dir, summary['deleted'],
+                    summary['failed'])
+    finally:
+        os.remove(pid_file)
+    return 0
+
+
+def add_arguments(parser):
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='Number of concurrent requests to Archivematica. Default: {}'.format(WORKERS))
+    parser.add_argument('--empty-trash', dest='empty_trash_only', action='store_true',
+                        help='Delete the packages moved to the trash directory instead of checking ingest status.')
+    parser.add_argument('--trash-workers', type=int, default=None,
+                        help='Number of files deleted in parallel when emptying the trash. Default: 4')
+    parser.add_argument('--trash-max-mb-per-second', type=float, default=None,
+                        help='Maximum size in MB of the files deleted per second when emptying the trash. '
+                             'Default: no limit')
+    parser.add_argument('--trash-max-files-per-second', type=float, default=None,
+                        help='Maximum number of files deleted per second when emptying the trash. Default: no limit')
+
+
 def main(am_user, am_api_key, ss_user, ss_api_key, ts_uuid, am_url, ss_url, depth, hide_on_complete=False,
-         see_files=False, config_file=None, log_level='INFO', **kwargs):
+         see_files=False, config_file=None, log_level='INFO', workers=WORKERS, empty_trash_only=False, trash_workers=None,
+         trash_max_mb_per_second=None, trash_max_files_per_second=None, **kwargs):
     utils.setup(config_file, LOG_NAME, log_level)
     LOGGER.info("Waking up")
 
     session = models.Session()
 
+    if empty_trash_only:
+        source_location = get_source_location(ss_url, ss_user, ss_api_key, ts_uuid)
+        return empty_trash(session, source_location, trash_workers, trash_max_mb_per_second,
+                           trash_max_files_per_second)
+
     # Check for evidence that this is already running
     default_pidfile = os.path.join(THIS_DIR, LOG_NAME + '.pid.lck')
     pid_file = utils.get_setting('remove_pidfile', default_pidfile)
@@ -104,6 +245,7 @@ def main(am_user, am_api_key, ss_user, ss_api_key, ts_uuid, am_url, ss_url, dept
         return 0
 
     source_location = get_source_location(ss_url, ss_user, ss_api_key, ts_uuid)
+    trash_dir = get_trash_dir(source_location) if trash_enabled() else None
 
     current_units = []
     try:
@@ -112,27 +254,30 @@ def main(am_user, am_api_key, ss_user, ss_api_key, ts_uuid, am_url, ss_url, dept
         LOGGER.debug('Query failed for current units', exc_info=True)
         LOGGER.info('Assuming new run.')
 
-    for current_unit in current_units:
-        LOGGER.info('Current unit: %s', current_unit)
-
-        unit_uuid = current_unit.uuid
-        unit_path = current_unit.path
-
-        # Get status
-        status_info = get_status(am_url, am_user, am_api_key, unit_uuid, hide_on_complete)
-        LOGGER.info('Status info: %s', status_info)
-        if not status_info:
-            LOGGER.error('Could not fetch status for %s. Exiting.', unit_uuid)
-            break
+    pool = ThreadPool(max(workers, 1))
+    try:
+        statuses = get_statuses(am_url, am_user, am_api_key, [u.uuid for u in current_units], pool)
+        completed = [u for u in current_units if statuses.get(u.uuid) == 'COMPLETE']
+        if hide_on_complete and completed:
+            hidden = pool.map(lambda unit_uuid: hide_ingest(am_url, am_user, am_api_key, unit_uuid),
+                              [u.uuid for u in completed])
+            LOGGER.info('Hid %s of %s completed SIPs in dashboard', sum(hidden), len(completed))
+    finally:
+        pool.close()
+        pool.join()
 
-        status = status_info.get('status')
+    # All changes to the units are committed in one transaction
+    for current_unit in current_units:
+        status = statuses.get(current_unit.uuid)
+        if status is None:
+            continue
         current_unit.status = status
 
         if status == 'COMPLETE':
-            unit = os.path.dirname(unit_path) if see_files else unit_path
+            unit = os.path.dirname(current_unit.path) if see_files else current_unit.path
             directory = source_location + '/' + unit
             LOGGER.info('Current transfer completed. Removing package from transfer source %s', directory)
-            if remove_folder(directory, depth):
+            if remove_folder(directory, depth, trash_dir):
                 session.delete(current_unit)
 
     session.commit()
@@ -141,4 +286,4 @@ def main(am_user, am_api_key, ss_user, ss_api_key, ts_uuid, am_url, ss_url, dept
 
 
 if __name__ == '__main__':
-    utils.main(main)
+    utils.main(main, add_arguments)
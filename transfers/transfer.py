@@ -15,7 +15,7 @@ import subprocess
 import sys
 import time
 
-import utils, models, offload, storage
+import utils, models, offload, storage, trash
 
 THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(THIS_DIR)
@@ -186,6 +186,8 @@ def get_next_transfer(ss_url, ss_user, ss_api_key, ts_location_uuid, path_prefix
     else:
         entries = browse_info['directories']
     entries = [base64.b64decode(e.encode('utf8')) for e in entries]
+    # Never start transfers from packages waiting to be deleted by remove_folder
+    entries = [e for e in entries if e != utils.fsencode(trash.TRASH_DIRNAME)]
     LOGGER.debug('Entries: %s', entries)
     entries = [os.path.join(path_prefix, e) for e in entries]
     # If at the correct depth, check if any of these have not been made into transfers yet
@@ -357,6 +359,9 @@ def main(am_user, am_api_key, ss_user, ss_api_key, ts_uuid, ts_path, depth, am_u
         return 0
 
     transfers_limit = transfers_remaining = int(utils.get_setting('transfers_limit', 1))
+    # Commit status updates in small batches so a crash loses at most one batch
+    batch_size = max(int(utils.get_setting('database_batch_size', 10)), 1)
+    pending = 0
     try:
         current_units = session.query(models.Unit).filter_by(current=True).limit(transfers_limit).all()
     except Exception:
@@ -364,6 +369,10 @@ def main(am_user, am_api_key, ss_user, ss_api_key, ts_uuid, ts_path, depth, am_u
         LOGGER.info('Assuming new run.')
 
     for current_unit in current_units:
+        if pending >= batch_size:
+            session.commit()
+            pending = 0
+        pending += 1
         LOGGER.info('Current unit: %s', current_unit)
 
         unit_uuid = current_unit.uuid
@@ -406,16 +415,18 @@ def main(am_user, am_api_key, ss_user, ss_api_key, ts_uuid, ts_path, depth, am_u
         # If failed, rejected, completed etc, start new transfer
         current_unit.current = False
 
+    session.commit()
     LOGGER.info("%s of %s transfers to process.", transfers_remaining, transfers_limit)
     for i in range(transfers_remaining):
         LOGGER.info("Starting transfer %s of %s", i + 1, transfers_remaining)
         new_transfer = start_transfer(ss_url, ss_user, ss_api_key, ts_uuid, ts_path, depth, am_url, am_user, am_api_key,
                                       transfer_type, see_files, session)
+        # The transfer is already started in the pipeline, record it right away
+        session.commit()
         if not new_transfer:
             LOGGER.info("No new transfers found.")
             break
 
-    session.commit()
     os.remove(pid_file)
     return 0  # always return a zero.
 
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# Trash
+#
+# Deferred deletion of packages from the transfer source location.
+#
+# Removing a multi-TB package takes hours and loads the NFS server that also
+# feeds the next transfers. Instead, the package is renamed into a trash
+# directory on the same filesystem, which is instant, and purge() deletes the
+# trash later with a limited number of workers and an optional I/O rate
+# limit. The trash directory itself is the queue, so purging resumes where it
+# stopped after a restart; progress per entry is recorded in the database.
+
+from __future__ import print_function, unicode_literals
+import datetime
+import errno
+import logging
+import os
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import models
+
+LOGGER = logging.getLogger('remove_folder')
+
+TRASH_DIRNAME = '.trash'
+WORKERS = 4
+PROGRESS_INTERVAL = 1000  # Files deleted between two progress records
+
+
+class Throttle(object):
+    """Pace consumers shared between threads to at most rate units per second."""
+
+    def __init__(self, rate):
+        self.rate = float(rate or 0)
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + amount / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def get_trash_dir(source_location):
+    """Default trash directory: hidden, inside the source location so that
+    renaming into it never crosses filesystems."""
+    return os.path.join(source_location, TRASH_DIRNAME)
+
+
+def move_to_trash(directory, trash_dir):
+    """
+    Rename directory into trash_dir.
+
+    :param str directory: Absolute path to the package to delete
+    :param str trash_dir: Trash directory, on the same filesystem as directory
+    :returns: New path of the package, or None if it could not be renamed
+    """
+    try:
+        if not os.path.isdir(trash_dir):
+            os.makedirs(trash_dir)
+        # Unique entry per package, named so that entries sort oldest first
+        entry = tempfile.mkdtemp(prefix=time.strftime('%Y%m%d%H%M%S-'), dir=trash_dir)
+        trash_path = os.path.join(entry, os.path.basename(directory.rstrip('/')))
+        os.rename(directory, trash_path)
+    except OSError:
+        LOGGER.warning('Unable to move %s to trash %s', directory, trash_dir, exc_info=True)
+        return None
+    LOGGER.info('Moved %s to trash: %s', directory, trash_path)
+    return trash_path
+
+
+def _iter_files(entry):
+    """Yield all files and symlinks under entry, directories excluded."""
+    for dirpath, dirnames, filenames in os.walk(entry):
+        for name in filenames:
+            yield os.path.join(dirpath, name)
+        for name in dirnames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                yield path
+
+
+def _remove_dirs(entry):
+    """Remove the, by now empty, directory tree under entry bottom-up."""
+    for dirpath, dirnames, filenames in os.walk(entry, topdown=False):
+        os.rmdir(dirpath)
+
+
+def purge_entry(session, trash_dir, name, pool, bytes_throttle, files_throttle):
+    """
+    Delete one trash entry, recording progress in a models.Deletion row.
+
+    :returns: True if the entry was completely deleted
+    """
+    entry = os.path.join(trash_dir, name)
+    deletion = session.query(models.Deletion).get(name)
+    if deletion is None:
+        deletion = models.Deletion(name=name, files=0, bytes=0)
+        session.add(deletion)
+        session.commit()
+    elif deletion.files:
+        LOGGER.info('Resuming deletion of %s after %s files, %s bytes', entry, deletion.files, deletion.bytes)
+
+    def unlink(path):
+        try:
+            size = os.lstat(path).st_size
+            bytes_throttle.consume(size)
+            files_throttle.consume(1)
+            os.unlink(path)
+            return size
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return 0
+            LOGGER.error('Unable to delete %s: %s', path, e)
+            return None
+
+    if not os.path.isdir(entry) or os.path.islink(entry):
+        # Not put there by move_to_trash, but deleted all the same
+        entry_iter = iter([entry])
+    else:
+        entry_iter = _iter_files(entry)
+
+    failed = 0
+    pending = 0
+    for size in pool.imap_unordered(unlink, entry_iter):
+        if size is None:
+            failed += 1
+            continue
+        deletion.files += 1
+        deletion.bytes += size
+        pending += 1
+        if pending >= PROGRESS_INTERVAL:
+            session.commit()
+            pending = 0
+    session.commit()
+    if failed:
+        LOGGER.error('%s files could not be deleted from %s, will retry on the next run', failed, entry)
+        return False
+
+    try:
+        if os.path.isdir(entry):
+            _remove_dirs(entry)
+    except OSError:
+        LOGGER.error('Unable to remove directories of %s', entry, exc_info=True)
+        return False
+    deletion.finished = datetime.datetime.utcnow()
+    session.commit()
+    LOGGER.info('Deleted %s: %s files, %s bytes', entry, deletion.files, deletion.bytes)
+    return True
+
+
+def purge(session, trash_dir, workers=WORKERS, bytes_per_second=0, files_per_second=0):
+    """
+    Delete everything in trash_dir, oldest entries first.
+
+    :param session: SQLAlchemy session with the DB
+    :param str trash_dir: Trash directory
+    :param int workers: Number of files deleted in parallel
+    :param bytes_per_second: Maximum size of the files deleted per second, 0 for no limit
+    :param files_per_second: Maximum number of files deleted per second, 0 for no limit
+    :returns: Dict with the number of entries 'deleted' and 'failed'
+    """
+    summary = {'deleted': 0, 'failed': 0}
+    if not os.path.isdir(trash_dir):
+        LOGGER.info('No trash directory %s, nothing to delete', trash_dir)
+        return summary
+    bytes_throttle = Throttle(bytes_per_second)
+    files_throttle = Throttle(files_per_second)
+    pool = ThreadPool(max(workers, 1))
+    try:
+        for name in sorted(os.listdir(trash_dir)):
+            if purge_entry(session, trash_dir, name, pool, bytes_throttle, files_throttle):
+                summary['deleted'] += 1
+            else:
+                summary['failed'] += 1
+    finally:
+        pool.close()
+        pool.join()
+    return summary
@@ -137,7 +137,8 @@ def set_pid_file(pid_file):
 def setup(config_file, log_name, log_level):
     global CONFIG_FILE
     CONFIG_FILE = config_file
-    models.init(get_setting('databasefile', os.path.join(THIS_DIR, 'transfers.db')))
+    models.init(get_setting('databasefile', os.path.join(THIS_DIR, 'transfers.db')),
+                float(get_setting('database_timeout', 30)))
 
     # Configure logging
     default_logfile = os.path.join(THIS_DIR, 'automate-transfer.log')
@@ -179,8 +180,20 @@ def setup(config_file, log_name, log_level):
     add_env()
 
 
-def main(script):
-    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+def main(script, add_arguments=None):
+    """
+    Parse the common command line arguments and run script with them.
+
+    :param script: Callable receiving the parsed arguments as keyword arguments.
+    :param add_arguments: Optional callable receiving an ArgumentParser to add
+        script specific arguments to. They are passed to script as keyword
+        arguments named after their destination.
+    """
+    script_parser = argparse.ArgumentParser(add_help=False)
+    if add_arguments is not None:
+        add_arguments(script_parser)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     parents=[script_parser])
     parser.add_argument('-u', '--user', metavar='USERNAME', required=True,
                         help='Username of the Archivematica dashboard user to authenticate as.')
     parser.add_argument('-k', '--api-key', metavar='KEY', required=True,
@@ -215,6 +228,7 @@ def main(script):
                         help='Set the debugging output level. This will override -q and -v')
 
     args = parser.parse_args()
+    script_args = vars(script_parser.parse_known_args()[0])
 
     log_levels = {
         2: 'ERROR',
@@ -245,4 +259,5 @@ def main(script):
         hide_on_complete=args.hide,
         config_file=args.config_file,
         log_level=log_level,
+        **script_args
     ))